@@ -0,0 +1,66 @@
+import argparse
+import re
+import time
+import tracemalloc
+
+import numpy as np
+
+from ridsans.sansdata import SansData
+
+# Compares the bulk byte parser used by SansData against the previous approach of reading
+# the .mpa file as a list of lines and converting the count sequence string by string.
+# Also reports the peak memory allocated while parsing, as SansData groups the pixels while
+# decoding instead of building the full 1024 x 1024 image first.
+
+
+def parse_lines(filename, image_code="CDAT2"):
+    """Reference implementation of the line based parse of the count sequence."""
+    with open(filename) as f:
+        lines = list(f)
+    r = re.compile(r"\[.DAT.,\d* \]")
+    sequence_headers = list(filter(lambda x: r.match(x[1]), enumerate(lines)))
+    for line, sequence_header in sequence_headers:
+        (id, length) = re.findall(r"\[([0-9a-zA-Z]+),(\d+) \]", sequence_header)[0]
+        if id == image_code:
+            return np.array(lines[line + 1 : line + 1 + int(length)], dtype=np.int16)
+    return None
+
+
+def time_call(f, repeat):
+    """Returns the best wall time of repeat calls of f."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def peak_memory(f):
+    """Returns the peak memory in bytes allocated by NumPy and Python during a call of f."""
+    tracemalloc.start()
+    try:
+        f()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark parsing of .mpa files by SansData against a line based parse."
+    )
+    parser.add_argument("files", nargs="+", help=".mpa files to parse")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    for filename in args.files:
+        t_lines = time_call(lambda filename=filename: parse_lines(filename), args.repeat)
+        t_sansdata = time_call(lambda filename=filename: SansData(filename), args.repeat)
+        m_lines = peak_memory(lambda filename=filename: parse_lines(filename))
+        m_sansdata = peak_memory(lambda filename=filename: SansData(filename))
+        print(
+            f"{filename}: line based {t_lines:.3f} s, SansData {t_sansdata:.3f} s "
+            f"({t_lines / t_sansdata:.1f}x), peak memory {m_lines / 1024**2:.1f} MB "
+            f"vs {m_sansdata / 1024**2:.1f} MB"
+        )
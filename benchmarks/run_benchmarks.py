@@ -0,0 +1,368 @@
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+
+from ridsans.correct import correct_measurements
+from ridsans.export import text_file_name, write_text_1D
+from ridsans.load_util import load_measurement_files, shutdown_pool
+from ridsans.nxcansas import bin_centers, write_nxcansas_1D, write_nxcansas_2D
+from ridsans.qreduce import *
+from ridsans.qstitch import stitch_arrays
+from ridsans.sansdata import SansData
+from ridsans.synthetic import write_measurement_set, write_pixel_efficiency
+
+# Benchmarks the stages of the reduction on a synthetic measurement set (see ridsans.synthetic) for several batch sizes,
+# given as the number of samples measured in each of the four Q ranges. The parsing, loading, correction, beam center
+# finding, masking, NumPy reductions, stitching and NXcanSAS and text writing run without Mantid; the Mantid reduction,
+# beam center finding, stitching of workspaces and saving are only benchmarked if Mantid can be imported. Results are
+# printed and optionally written as JSON.
+
+Q_ranges = (1, 2, 3, 4)
+
+try:
+    from mantid.simpleapi import FindCenterOfMassPosition
+
+    from ridsans.batch_processing import load_batchfile_rows_workspaces
+    from ridsans.reduce import (
+        clear_beam_center_cache,
+        find_center_workspace,
+        reduce_RIDSANS_1D,
+        reduce_RIDSANS_2D,
+        reduction_setup_RIDSANS,
+    )
+    from ridsans.save import save, save_1D_samples, save_2D, save_text_samples
+    from ridsans.stitch import stitch_Q_ranges_1D, stitch_samples_1D
+
+    mantid_available = True
+except ImportError:
+    mantid_available = False
+
+
+def time_call(f, repeat, memory=False):
+    """Returns the best and mean wall time of repeat calls of f, together with the peak memory allocated during an additional
+    call if memory is set."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    peak = None
+    if memory:
+        tracemalloc.start()
+        try:
+            f()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return min(times), sum(times) / len(times), peak
+
+
+def batch_rows(samples, total_samples):
+    """Indices of the batchfile rows of the first samples, as written by write_measurement_set with total_samples samples."""
+    return [q * total_samples + i for q in range(len(Q_ranges)) for i in range(samples)]
+
+
+def row_files(directory, samples):
+    """Measurement files (sample scatter, sample trans, can scatter, can trans, direct, background) per row of the first
+    samples, grouped per Q range."""
+    groups = []
+    for q in Q_ranges:
+        groups.append(
+            [
+                [
+                    directory / f"scattering_sample_{i}_Q{q}.mpa",
+                    directory / f"transmission_sample_{i}_Q{q}.mpa",
+                    directory / f"scattering_empty_can_Q{q}.mpa",
+                    directory / f"transmission_empty_can_Q{q}.mpa",
+                    directory / f"empty_beam_no_sample_Q{q}.mpa",
+                    directory / f"Background_Q{q}.mpa",
+                ]
+                for i in range(samples)
+            ]
+        )
+    return groups
+
+
+def numpy_benchmarks(directory, samples, output_directory):
+    """Benchmarks of the stages that run without Mantid, as (name, function) pairs."""
+    groups = row_files(directory, samples)
+    files = [str(file) for group in groups for row in group for file in row]
+    distinct_files = list(dict.fromkeys(files))
+
+    # The later stages start from loaded and corrected measurements
+    loaded_files = load_measurement_files(distinct_files, use_cache=False)
+    loaded = dict(zip(distinct_files, loaded_files))
+    corrected = []
+    for group in groups:
+        measurements = [[loaded[str(file)] for file in row] for row in group]
+        columns = list(zip(*measurements))
+        corrected.append((columns, correct_measurements(*columns[:4], columns[4][0], columns[5][0])))
+
+    x, y, _ = pixel_grid(loaded[files[0]].pixel_count)
+    shapes = [
+        {"shape": "circle", "r": 0.01},
+        {"shape": "rectangle", "w": 0.02, "h": 0.2, "offset_y": -0.1},
+        {"shape": "sector", "phi_min": 80, "phi_max": 100, "r_inner": 0.05},
+    ]
+
+    def correct():
+        for columns, _ in corrected:
+            correct_measurements(*columns[:4], columns[4][0], columns[5][0])
+
+    def beam_center():
+        # Without caching, the center is found on the direct measurement of every row
+        for group in groups:
+            for row in group:
+                find_beam_center(loaded[str(row[4])].I)
+
+    def mask():
+        for _ in range(samples * len(Q_ranges)):
+            region = np.zeros(len(x), dtype=bool)
+            for shape in shapes:
+                region |= shape_region(x, y, shape)
+
+    def reduce(reduce_arrays):
+        def f():
+            for columns, (I, dI, _, _) in corrected:
+                for sample_scatter, I_row, dI_row in zip(columns[0], I, dI):
+                    reduce_arrays(I_row, dI_row, sample_scatter.d, sample_scatter.L0)
+
+        return f
+
+    # The 1D reductions of all samples are stacked per Q range for stitching
+    reduced = []
+    reduced_1D = []
+    for columns, (I, dI, _, _) in corrected:
+        results = [
+            reduce_arrays_1D(I_row, dI_row, sample_scatter.d, sample_scatter.L0)
+            for sample_scatter, I_row, dI_row in zip(columns[0], I, dI)
+        ]
+        reduced.append((results[0][0], np.array([r[1] for r in results]), np.array([r[2] for r in results])))
+        for sample_scatter, (bin_edges, I_Q, dI_Q) in zip(columns[0], results):
+            reduced_1D.append(
+                {
+                    "name": f"{sample_scatter.name}_1D",
+                    "Q_edges": bin_edges,
+                    "I": I_Q,
+                    "dI": dI_Q,
+                    "Q_range_index": sample_scatter.Q_range_index,
+                }
+            )
+
+    def stitch():
+        stitch_arrays(*zip(*reduced))
+
+    def save_text_savetxt():
+        # Baseline for write_text_1D: a np.savetxt call per curve
+        for sample in reduced_1D:
+            valid = np.isfinite(sample["I"])
+            np.savetxt(
+                output_directory / text_file_name(sample["name"], "_savetxt.txt"),
+                np.column_stack([bin_centers(sample["Q_edges"]), sample["I"], sample["dI"]])[valid],
+                header="Q (1/A)  I (1/cm)  dI (1/cm)",
+            )
+
+    def save_nxcansas_1D():
+        for sample in reduced_1D:
+            write_nxcansas_1D(output_directory / f"{sample['name']}.h5", sample)
+
+    reduced_2D = []
+    for columns, (I, dI, _, _) in corrected:
+        for sample_scatter, I_row, dI_row in zip(columns[0], I, dI):
+            bin_edges, I_Qxy, dI_Qxy = reduce_arrays_2D(I_row, dI_row, sample_scatter.d, sample_scatter.L0)
+            reduced_2D.append(
+                {
+                    "name": f"{sample_scatter.name}_2D",
+                    "Qx_edges": bin_edges,
+                    "I": I_Qxy,
+                    "dI": dI_Qxy,
+                    "Q_range_index": sample_scatter.Q_range_index,
+                }
+            )
+
+    def save_nxcansas():
+        for sample in reduced_2D:
+            write_nxcansas_2D(output_directory / f"{sample['name']}.h5", sample)
+
+    def save_nxcansas_batch():
+        write_nxcansas_2D(output_directory / "reduced_2D.h5", reduced_2D)
+
+    return [
+        ("parse", lambda: [SansData(file) for file in distinct_files]),
+        ("batch_load", lambda: load_measurement_files(distinct_files, use_cache=False)),
+        ("correction", correct),
+        ("beam_center", beam_center),
+        ("masking", mask),
+        ("reduce_1D", reduce(reduce_arrays_1D)),
+        ("reduce_2D", reduce(reduce_arrays_2D)),
+        ("stitch_numpy", stitch),
+        ("save_text_1D_savetxt", save_text_savetxt),
+        ("save_text_1D", lambda: write_text_1D(output_directory, reduced_1D)),
+        ("save_nxcansas_1D", save_nxcansas_1D),
+        ("save_nxcansas_1D_batch", lambda: write_nxcansas_1D(output_directory / "reduced_1D.h5", reduced_1D)),
+        ("save_nxcansas_2D", save_nxcansas),
+        ("save_nxcansas_2D_batch", save_nxcansas_batch),
+    ]
+
+
+def mantid_benchmarks(directory, samples, output_directory):
+    """Benchmarks of the Mantid reduction, stitching and saving, as (name, function) pairs."""
+    # The batchfile is read from the data directory, not from the working directory
+    batch_filename = str(directory / "sans-batchfile.csv")
+    efficiency_file = str(directory / "pixel-efficiency.npy")
+    with open(batch_filename) as f:
+        total_samples = (sum(1 for _ in f) - 1) // len(Q_ranges)
+    indices = batch_rows(samples, total_samples)
+
+    def load():
+        return load_batchfile_rows_workspaces(
+            indices, efficiency_file, batch_filename, str(directory), force_reload=True
+        )
+
+    workspaces = load()
+    for ws_sample, ws_direct, _, _, _ in workspaces:
+        reduction_setup_RIDSANS(ws_sample, ws_direct)
+
+    def beam_center_cached():
+        clear_beam_center_cache()
+        for _, ws_direct, _, _, _ in workspaces:
+            find_center_workspace(ws_direct)
+
+    def reduce(reduce_RIDSANS):
+        def f():
+            return [
+                reduce_RIDSANS(ws_sample, ws_pixel_adj)
+                for ws_sample, _, _, ws_pixel_adj, _ in workspaces
+            ]
+
+        return f
+
+    reduced_1D = reduce(reduce_RIDSANS_1D)()
+    reduced_2D = reduce(reduce_RIDSANS_2D)()
+    # The rows are ordered by Q range, with the samples in the same order within each Q range
+    per_sample = [reduced_1D[i :: samples] for i in range(samples)]
+
+    def stitch():
+        return [stitch_Q_ranges_1D(workspaces_1D) for workspaces_1D in per_sample]
+
+    def save_all_1D():
+        for i, ws in enumerate(reduced_1D):
+            save(ws, str(output_directory / f"reduced_{i}.xml"))
+
+    def save_all_2D():
+        for i, ws in enumerate(reduced_2D):
+            save_2D(ws, str(output_directory / f"reduced_{i}.h5"))
+
+    def save_all_native():
+        for i, ws in enumerate(reduced_2D):
+            save_2D(ws, str(output_directory / f"reduced_{i}.h5"), backend="numpy")
+
+    return [
+        ("mantid_load", load),
+        (
+            "mantid_beam_center",
+            lambda: [
+                FindCenterOfMassPosition(ws_direct, Output="center", Tolerance=0.0005)
+                for _, ws_direct, _, _, _ in workspaces
+            ],
+        ),
+        ("beam_center_cached", beam_center_cached),
+        ("mantid_reduce_1D", reduce(reduce_RIDSANS_1D)),
+        ("mantid_reduce_2D", reduce(reduce_RIDSANS_2D)),
+        ("stitch", stitch),
+        ("stitch_numpy_workspaces", lambda: stitch_samples_1D(per_sample)),
+        ("save_1D", save_all_1D),
+        ("save_1D_batch", lambda: save_1D_samples(reduced_1D, str(output_directory / "reduced_1D.h5"))),
+        ("save_1D_text", lambda: save_text_samples(reduced_1D, output_directory)),
+        ("save_2D", save_all_2D),
+        ("save_2D_native", save_all_native),
+    ]
+
+
+def run_benchmarks(directory, sizes, repeat=3, memory=False, mantid=True):
+    """Runs all benchmarks for each batch size on the measurement set in directory, which holds at least the largest number
+    of samples. Returns a list with a result per benchmark and size."""
+    directory = Path(directory)
+    results = []
+    with tempfile.TemporaryDirectory() as output_directory:
+        for samples in sizes:
+            benchmarks = numpy_benchmarks(directory, samples, Path(output_directory))
+            if mantid and mantid_available:
+                benchmarks += mantid_benchmarks(directory, samples, Path(output_directory))
+            rows = samples * len(Q_ranges)
+            for name, f in benchmarks:
+                best, mean, peak = time_call(f, repeat, memory)
+                result = {
+                    "benchmark": name,
+                    "samples": samples,
+                    "rows": rows,
+                    "repeat": repeat,
+                    "best_s": best,
+                    "mean_s": mean,
+                    "per_row_s": best / rows,
+                    "peak_traced_bytes": peak,
+                }
+                results.append(result)
+                peak = "" if peak is None else f", peak {peak / 1024**2:.1f} MB"
+                print(f"{name} ({rows} rows): best {best:.3f} s, mean {mean:.3f} s, {best / rows * 1e3:.1f} ms per row{peak}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the reduction stages on synthetic .mpa files for several batch sizes."
+    )
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1, 4],
+        help="batch sizes as number of samples, each measured in all four Q ranges",
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--memory", action="store_true", help="also record the peak traced memory of each benchmark"
+    )
+    parser.add_argument("--no-mantid", action="store_true", help="skip the Mantid benchmarks")
+    parser.add_argument(
+        "--data-dir",
+        help="directory of the synthetic measurement set, which is reused if it holds enough samples (a temporary directory by default)",
+    )
+    parser.add_argument("--output", help="JSON file to write the results to")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        directory = Path(args.data_dir or temporary_directory)
+        total_samples = max(args.sizes)
+        if not (directory / f"scattering_sample_{total_samples - 1}_Q4.mpa").exists():
+            print(f"Writing synthetic measurement set with {total_samples} samples to {directory}")
+            write_measurement_set(directory, samples=total_samples, Q_ranges=Q_ranges)
+            write_pixel_efficiency(directory / "pixel-efficiency.npy")
+        if not args.no_mantid and not mantid_available:
+            print("Mantid is not available, skipping the Mantid benchmarks")
+        try:
+            results = run_benchmarks(
+                directory, args.sizes, args.repeat, args.memory, not args.no_mantid
+            )
+        finally:
+            shutdown_pool()
+
+    if args.output:
+        report = {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "mantid": mantid_available and not args.no_mantid,
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
@@ -1,6 +1,8 @@
 import argparse
 import os
 
+from ridsans.mpa import read_mpa_header
+
 
 def rename_files_in_directory(directory):
     for filename in os.listdir(directory):
@@ -9,16 +11,16 @@ def rename_files_in_directory(directory):
 
         # Only process files (skip directories)
         if os.path.isfile(file_path):
-            with open(file_path) as file:
-                for line in file:
-                    if line.startswith("Sample="):
-                        # Extract the sample name
-                        sample_name = line.split("=", 1)[1].strip()
-                        break
-                else:
-                    # If no 'Sample=' line is found, skip renaming
-                    print(f"'Sample=' not found in {filename}. Skipping.")
-                    continue
+            # Only the header is read, the detector counts are skipped
+            for line in read_mpa_header(file_path):
+                if line.startswith("Sample="):
+                    # Extract the sample name
+                    sample_name = line.split("=", 1)[1].strip()
+                    break
+            else:
+                # If no 'Sample=' line is found, skip renaming
+                print(f"'Sample=' not found in {filename}. Skipping.")
+                continue
 
             # TODO: harden this properly to avoid future problems with special characters
             # Generate the new filename
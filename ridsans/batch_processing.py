@@ -12,16 +12,20 @@ def load_measurement_set_workspaces(
     batch_filename="sans-batchfile.csv",
     directory="data",
     force_reload=False,
+    rebin=True,
+    dtype=np.float64,
 ):
     """Given indices of a measurement set, this will read the provided batchfile and retrieve the workspaces either by loading them or
     retrieving them from the AnalysisDataService if available and force_reload is not set. It will automatically detect which of the
-    indices corresponds to the widest Q range and use its measurement files for transmission factor calculation."""
+    indices corresponds to the widest Q range and use its measurement files for transmission factor calculation. The rebin and dtype
+    options are passed on to load_RIDSANS."""
+    batch = get_batchfile(batch_filename, directory)
     try:
         # Emulate absent workspace when force_reload is set
         if force_reload:
             raise KeyError("force_reload is set")
         return [
-            retrieve_batchfile_index_workspaces(index, batch_filename, directory)
+            retrieve_batchfile_index_workspaces(index, batch, directory)
             for index in indices
         ]
     except KeyError:
@@ -29,7 +33,7 @@ def load_measurement_set_workspaces(
         index_to_Q = []
         for index in indices:
             Q_range = get_Q_range_id_from_batchfile_index(
-                index, batch_filename, directory
+                index, batch, directory
             )
             index_to_Q.append((index, int(Q_range)))
 
@@ -47,7 +51,7 @@ def load_measurement_set_workspaces(
                 direct_file,
                 background_file,
                 batch_file_thickness,
-            ) = get_file_data_from_batchfile_index(index, batch_filename, directory)
+            ) = get_file_data_from_batchfile_index(index, batch, directory)
             ws_sample, ws_direct, mon, ws_pixel_adj, Q_range_index = load_RIDSANS(
                 sample_scatter_file,
                 sample_transmission_file,
@@ -57,6 +61,9 @@ def load_measurement_set_workspaces(
                 background_file,
                 efficiency_file,
                 transmissions,
+                force_reload=force_reload,
+                rebin=rebin,
+                dtype=dtype,
             )
             # The measurement that is first reduced (with the highest Q range due to sorting) determines the used transmission
             # factor for the other measurements
@@ -80,14 +87,18 @@ def load_batchfile_index_workspaces(
     batch_filename="sans-batchfile.csv",
     directory="data",
     force_reload=False,
+    rebin=True,
+    dtype=np.float64,
 ):
     """Given a row index (starting at 0), this will read the provided batchfile and retrieve the workspaces either by loading them or
-    retrieving them from the AnalysisDataService if available and force_reload is not set."""
+    retrieving them from the AnalysisDataService if available and force_reload is not set. The rebin and dtype options are passed
+    on to load_RIDSANS."""
+    batch = get_batchfile(batch_filename, directory)
     try:
         # Emulate absent workspace when force_reload is set
         if force_reload:
             raise KeyError("force_reload is set")
-        return retrieve_batchfile_index_workspaces(index, batch_filename, directory)
+        return retrieve_batchfile_index_workspaces(index, batch, directory)
     except KeyError:
         (
             sample_scatter_file,
@@ -97,7 +108,7 @@ def load_batchfile_index_workspaces(
             direct_file,
             background_file,
             batch_file_thickness,
-        ) = get_file_data_from_batchfile_index(index, batch_filename, directory)
+        ) = get_file_data_from_batchfile_index(index, batch, directory)
         ws_sample, ws_direct, mon, ws_pixel_adj, Q_range_index = load_RIDSANS(
             sample_scatter_file,
             sample_transmission_file,
@@ -106,6 +117,9 @@ def load_batchfile_index_workspaces(
             direct_file,
             background_file,
             efficiency_file,
+            force_reload=force_reload,
+            rebin=rebin,
+            dtype=dtype,
         )
         # Divides out the thickness from the sample to get result in units of
         # macroscopic scattering crossection [cm^-1]
@@ -113,6 +127,103 @@ def load_batchfile_index_workspaces(
         ws_sample /= thickness
         return ws_sample, ws_direct, mon, ws_pixel_adj, Q_range_index
 
+
+def load_batchfile_rows_workspaces(
+    indices,
+    efficiency_file,
+    batch_filename="sans-batchfile.csv",
+    directory="data",
+    force_reload=False,
+    rebin=True,
+    dtype=np.float64,
+):
+    """Loads the workspaces of several batchfile rows at once, returning them per row in the order of indices like
+    load_batchfile_index_workspaces does. The measurement files of all rows are loaded together and rows that share their
+    direct and background measurements are corrected in a single pass using correct_measurements. Transmission factors are
+    computed for every row independently, unless they are found in the transmission cache."""
+    batch = get_batchfile(batch_filename, directory)
+    rows = [batch[index] for index in indices]
+    transmissions = []
+    file_list = []
+    for row in rows:
+        row_transmissions = lookup_transmissions(
+            row.sample_transmission_file,
+            row.can_transmission_file,
+            row.direct_file,
+            row.background_file,
+            rebin,
+        )
+        files = list(row.files)
+        if row_transmissions is not None:
+            # The transmission measurements are not needed
+            files[1], files[3] = None, None
+        transmissions.append(row_transmissions)
+        file_list.extend(files)
+    loaded = load_measurement_files(
+        file_list,
+        force_reload=force_reload,
+        rebin=rebin,
+        dtype=dtype,
+    )
+    measurements = [loaded[6 * i : 6 * i + 6] for i in range(len(rows))]
+    relative_pixel_efficiency = np.load(efficiency_file)
+
+    groups = {}
+    for i, row in enumerate(rows):
+        groups.setdefault((row.direct_file, row.background_file), []).append(i)
+
+    result_list = [None] * len(rows)
+    for group in groups.values():
+        (
+            sample_scatters,
+            sample_transmissions,
+            can_scatters,
+            can_transmissions,
+            directs,
+            backgrounds,
+        ) = zip(*[measurements[i] for i in group])
+        direct = directs[0]
+        I_corrected, dI_corrected, T_samples, T_cans = correct_measurements(
+            sample_scatters,
+            sample_transmissions,
+            can_scatters,
+            can_transmissions,
+            direct,
+            backgrounds[0],
+            [transmissions[i] for i in group],
+            [rows[i].can_transmission_file is not None for i in group],
+        )
+        ws_direct = None
+        for k, i in enumerate(group):
+            sample_scatter = sample_scatters[k]
+            bins = create_monochrom_bin_bounds(sample_scatter.L0)
+            detectors = sample_scatter.pixel_count
+            ws_pixel_adj = create_pixel_adj_workspace(
+                relative_pixel_efficiency, bins, detectors
+            )
+            ws_sample, mon = corrected_workspace(
+                sample_scatter,
+                I_corrected[k],
+                dI_corrected[k],
+                T_samples[k],
+                T_cans[k],
+                bins,
+                detectors,
+            )
+            Q_range_index = sample_scatter.Q_range_index
+            ws_sample.getRun().addProperty("Q_range_index", Q_range_index, True)
+            # The direct workspace is shared by all rows of the group
+            if ws_direct is None:
+                ws_direct, _ = workspace_from_sansdata(direct, bins, detectors)
+                ws_direct.getRun().addProperty("Q_range_index", Q_range_index, True)
+            # Divides out the thickness from the sample to get result in units of
+            # macroscopic scattering crossection [cm^-1]
+            thickness = retrieve_thickness(rows[i].thickness, ws_sample)
+            ws_sample /= thickness
+            result_list[i] = (ws_sample, ws_direct, mon, ws_pixel_adj, Q_range_index)
+    return result_list
+
+
 def retrieve_thickness(batch_file_thickness, ws_sample):
     """Determines the sample thickness from both the sample workspace and the value in the batch sheet entry"""
     thickness = batch_file_thickness
@@ -140,67 +251,150 @@ def dataframe_row_map(filename_list):
     return [None if pd.isna(x) else x for x in filename_list]
 
 
+class BatchRow:
+    """A single row of the batchfile, with the measurement names resolved to .mpa file paths (None for blank entries)."""
+
+    def __init__(self, index, row_list, directory="data"):
+        self.index = index
+        *self.names, self.thickness = row_list
+        directory_path = Path(directory)
+        self.files = [
+            None if fname is None else (directory_path / fname).with_suffix(".mpa")
+            for fname in self.names
+        ]
+        (
+            self.sample_scatter_file,
+            self.sample_transmission_file,
+            self.can_scatter_file,
+            self.can_transmission_file,
+            self.direct_file,
+            self.background_file,
+        ) = self.files
+        self.sample_scatter = self.names[0]
+        self.direct = self.names[4]
+        # Filled in by BatchFile.probe_row from the header of the sample scatter file
+        self.Q_range_index = None
+        self.sample = None
+
+
+class BatchFile:
+    """Batchfile spreadsheet that is read and validated once, with every row resolved to a BatchRow. Rows can be looked up
+    by index, by sample scatter name and, after probing the headers of the sample scatter files, by sample and Q range."""
+
+    columns = [
+        "sample scatter",
+        "sample trans",
+        "can scatter",
+        "can trans",
+        "direct",
+        "background",
+        "t",
+    ]
+
+    def __init__(self, batch_filename="sans-batchfile.csv", directory="data"):
+        self.batch_filename = batch_filename
+        self.directory = directory
+        batch = pd.read_csv(batch_filename)
+        if batch.shape[1] != len(self.columns):
+            raise ValueError(
+                f"Batchfile {batch_filename} has {batch.shape[1]} columns, expected {len(self.columns)}: {', '.join(self.columns)}"
+            )
+        self.rows = [
+            BatchRow(index, dataframe_row_map(row_list), directory)
+            for index, row_list in enumerate(batch.itertuples(index=False))
+        ]
+        for row in self.rows:
+            if row.sample_scatter is None or row.direct is None:
+                raise ValueError(
+                    f"Row {row.index} of batchfile {batch_filename} is missing a sample scatter or direct measurement"
+                )
+        self.by_scatter_name = {}
+        for row in self.rows:
+            self.by_scatter_name.setdefault(row.sample_scatter, []).append(row)
+        self.by_sample = None
+        self.by_Q_range = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        return self.rows[index]
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def probe_row(self, index):
+        """Reads the Q range and sample name of a row from the header of its sample scatter file, once per row."""
+        row = self.rows[index]
+        if row.Q_range_index is None:
+            metadata = probe_mpa(str(row.sample_scatter_file))
+            row.Q_range_index = metadata.Q_range_index
+            row.sample = metadata.sample
+        return row
+
+    def probe_rows(self):
+        """Probes every row (see probe_row), indexing the rows by sample and Q range. This is only done once, when rows are
+        first looked up by sample or Q range, and only reads the file headers."""
+        if self.by_Q_range is not None:
+            return
+        by_sample = {}
+        by_Q_range = {}
+        for index in range(len(self.rows)):
+            row = self.probe_row(index)
+            by_sample.setdefault(row.sample, []).append(row)
+            by_Q_range.setdefault(int(row.Q_range_index), []).append(row)
+        self.by_sample = by_sample
+        self.by_Q_range = by_Q_range
+
+    def Q_range_index(self, index):
+        """Gets the Q range of the row with the given index, only reading the header of its own sample scatter file."""
+        return self.probe_row(index).Q_range_index
+
+    def rows_for_sample(self, sample):
+        """Gets all rows measuring a sample, as named in the headers of the sample scatter files."""
+        self.probe_rows()
+        return self.by_sample.get(sample, [])
+
+    def rows_for_Q_range(self, Q_range_index):
+        """Gets all rows measured in a Q range."""
+        self.probe_rows()
+        return self.by_Q_range.get(int(Q_range_index), [])
+
+
+# Batchfiles that have been read in this session, keyed by path, modification time and data directory
+batchfiles = {}
+
+
+def get_batchfile(batch_filename="sans-batchfile.csv", directory="data"):
+    """Returns the BatchFile for a batchfile path, only reading it again if it was modified. BatchFile objects are passed through as is."""
+    if isinstance(batch_filename, BatchFile):
+        return batch_filename
+    path = Path(batch_filename).resolve()
+    key = (str(path), path.stat().st_mtime_ns, str(directory))
+    if key not in batchfiles:
+        batchfiles[key] = BatchFile(batch_filename, directory)
+    return batchfiles[key]
+
+
 def get_workspace_data_from_batchfile_index(
     index, batch_filename="sans-batchfile.csv", directory="data"
 ):
     """Gets the workspace names that can be used to retrieve previously loaded data."""
-    batch = pd.read_csv(batch_filename)
-    row_list = dataframe_row_map(batch.iloc[index].tolist())
-    *file_names, thickness = row_list
-    (
-        sample_scatter,
-        _,
-        _,
-        _,
-        direct,
-        _,
-    ) = tuple(file_names)
-    return (sample_scatter, direct, thickness)
+    row = get_batchfile(batch_filename, directory)[index]
+    return (row.sample_scatter, row.direct, row.thickness)
 
 
 def get_Q_range_id_from_batchfile_index(
     index, batch_filename="sans-batchfile.csv", directory="data"
 ):
     """Gets the Q range corresponding to a batchfile index."""
-    batch = pd.read_csv(batch_filename)
-    directory_path = Path(directory)
-    row_list = dataframe_row_map(batch.iloc[index].tolist())
-    *file_names, _ = row_list
-    x = [
-        None if fname is None else (directory_path / fname).with_suffix(".mpa")
-        for fname in file_names
-    ]
-    sample_scatter_file = x[0]
-    sansdata = SansData(str(sample_scatter_file))
-    return sansdata.Q_range_index
+    # Only the metadata is needed, so the detector image is not decoded
+    return get_batchfile(batch_filename, directory).Q_range_index(index)
 
 
 def get_file_data_from_batchfile_index(
     index, batch_filename="sans-batchfile.csv", directory="data"
 ):
     """Gets the filenames needed to load the measurement workspaces."""
-    batch = pd.read_csv(batch_filename)
-    directory_path = Path(directory)
-    row_list = dataframe_row_map(batch.iloc[index].tolist())
-    *file_names, thickness = row_list
-    x = [
-        None if fname is None else (directory_path / fname).with_suffix(".mpa")
-        for fname in file_names
-    ]
-    (
-        sample_scatter_file,
-        sample_transmission_file,
-        can_scatter_file,
-        can_transmission_file,
-        direct_file,
-        background_file,
-    ) = tuple(x)
-    return (
-        sample_scatter_file,
-        sample_transmission_file,
-        can_scatter_file,
-        can_transmission_file,
-        direct_file,
-        background_file,
-        thickness,
-    )
+    row = get_batchfile(batch_filename, directory)[index]
+    return (*row.files, row.thickness)
@@ -0,0 +1,327 @@
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+
+from ridsans import load_util, profiling
+from ridsans.batch_processing import *
+from ridsans.export import ExportQueue
+from ridsans.reduce import *
+from ridsans.save import *
+
+# Masks loaded by a worker process, keyed by mask file name
+loaded_masks = {}
+
+
+def init_worker(settings=None):
+    """Runs once in each worker process. The workers already run in parallel, so each loads its files serially. Spawned
+    workers only inherit environment variables, so the loader settings of the parent (see load_util.loader_settings),
+    e.g. from set_cache_dir or set_transmission_cache, are applied here."""
+    load_util.set_pool_size(1)
+    if settings is not None:
+        load_util.apply_loader_settings(settings)
+
+
+def worker_executor(max_workers):
+    """Creates the pool of worker processes of reduce_batchfile, which get the loader settings of this process."""
+    # Spawned workers start from a fresh interpreter, giving each its own Mantid framework instance
+    return ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=get_context("spawn"),
+        initializer=init_worker,
+        initargs=(load_util.loader_settings(),),
+    )
+
+
+def retrieve_mask(mask_file_pattern, Q_range_index):
+    """Loads the mask of a Q range once per worker process."""
+    mask_file = mask_file_pattern.format(Q_range_index=Q_range_index)
+    if mask_file not in loaded_masks:
+        loaded_masks[mask_file] = LoadMask(
+            "RIDSANS_Definition.xml",
+            mask_file,
+            OutputWorkspace=f"Q{Q_range_index}_mask",
+        )
+    return loaded_masks[mask_file]
+
+
+def reduce_shard(
+    indices,
+    efficiency_file,
+    batch_filename,
+    directory,
+    output_directory,
+    load_as_set=False,
+    mask_file_pattern=None,
+    number_of_bins=200,
+    dimensions=1,
+    rebin=True,
+    profile=False,
+    save_backend="mantid",
+    export_workers=0,
+    center_backend="mantid",
+):
+    """Runs reduce_rows for the rows of one shard, returning their status entries together with the stages recorded while
+    reducing them if profile is set (see ridsans.profiling)."""
+    was_enabled = profiling.profiling_enabled
+    first_record = len(profiling.records)
+    if profile:
+        profiling.enable_profiling()
+    try:
+        status = reduce_rows(
+            indices,
+            efficiency_file,
+            batch_filename,
+            directory,
+            output_directory,
+            load_as_set,
+            mask_file_pattern,
+            number_of_bins,
+            dimensions,
+            rebin,
+            save_backend,
+            export_workers,
+            center_backend,
+        )
+    finally:
+        if profile and not was_enabled:
+            profiling.enable_profiling(False)
+    if not profile:
+        return status, []
+    # The records are returned to the caller, which writes them to the report, so they are not kept in this process
+    shard_records = profiling.records[first_record:]
+    del profiling.records[first_record:]
+    return status, shard_records
+
+
+def reduce_rows(
+    indices,
+    efficiency_file,
+    batch_filename,
+    directory,
+    output_directory,
+    load_as_set=False,
+    mask_file_pattern=None,
+    number_of_bins=200,
+    dimensions=1,
+    rebin=True,
+    save_backend="mantid",
+    export_workers=0,
+    center_backend="mantid",
+):
+    """Loads, reduces and saves the batchfile rows of one shard, returning a status entry for each row. Rows of a shard are
+    loaded together as a measurement set if load_as_set is set, sharing the transmission factors of the widest Q range.
+    If export_workers is set, results are saved by that many background threads while the next rows are reduced."""
+    start = time.perf_counter()
+    batch = get_batchfile(batch_filename, directory)
+    try:
+        if load_as_set:
+            workspaces = load_measurement_set_workspaces(
+                indices, efficiency_file, batch, directory, force_reload=True, rebin=rebin
+            )
+        else:
+            workspaces = [
+                load_batchfile_index_workspaces(
+                    index, efficiency_file, batch, directory, force_reload=True, rebin=rebin
+                )
+                for index in indices
+            ]
+    except Exception as e:
+        elapsed = time.perf_counter() - start
+        return [
+            reduction_status(batch[index], "failed", error=e, seconds=elapsed)
+            for index in indices
+        ]
+
+    # Sample workspaces are named after the sample scatter file
+    rows = {Path(batch[index].sample_scatter_file).stem: batch[index] for index in indices}
+    status = []
+    queue = ExportQueue(export_workers) if export_workers else None
+    # Status entries of the rows that are being exported, with the future of their export
+    exports = []
+    exported_workspaces = []
+    for ws_sample, ws_direct, _, ws_pixel_adj, Q_range_index in workspaces:
+        row = rows[ws_sample.name()]
+        row_start = time.perf_counter()
+        try:
+            mask = None
+            if mask_file_pattern is not None:
+                mask = retrieve_mask(mask_file_pattern, Q_range_index)
+            reduction_setup_RIDSANS(
+                ws_sample, ws_direct, mask_workspace=mask, backend=center_backend
+            )
+            if dimensions == 1:
+                reduced = reduce_RIDSANS_1D(
+                    ws_sample, ws_pixel_adj, number_of_bins=number_of_bins
+                )
+                output_file = os.path.join(output_directory, f"{ws_sample.name()}_1D.xml")
+                if queue is None:
+                    save(reduced, output_file)
+                else:
+                    future = queue.submit(save, output_file, reduced)
+            else:
+                reduced = reduce_RIDSANS_2D(
+                    ws_sample, ws_pixel_adj, number_of_bins=number_of_bins
+                )
+                output_file = os.path.join(output_directory, f"{ws_sample.name()}_2D.h5")
+                if queue is None:
+                    save_2D(reduced, output_file, backend=save_backend)
+                elif save_backend == "numpy":
+                    # The arrays are copied from the workspace right away, so the writing thread does not use it
+                    future = queue.submit(
+                        write_nxcansas_2D, output_file, samples=nxcansas_sample_2D(reduced)
+                    )
+                else:
+                    future = queue.submit(save_2D, output_file, reduced)
+            status.append(
+                reduction_status(
+                    row,
+                    "ok",
+                    Q_range_index=Q_range_index,
+                    output_file=output_file,
+                    seconds=time.perf_counter() - row_start,
+                )
+            )
+            if queue is None:
+                # Results are on disk, so the workspaces are removed to keep the memory use of the worker flat
+                DeleteWorkspace(reduced)
+            else:
+                exports.append((status[-1], future))
+                exported_workspaces.append(reduced)
+        except Exception as e:
+            status.append(
+                reduction_status(
+                    row,
+                    "failed",
+                    Q_range_index=Q_range_index,
+                    error=e,
+                    seconds=time.perf_counter() - row_start,
+                )
+            )
+        DeleteWorkspace(ws_sample)
+    if queue is not None:
+        queue.close(raise_errors=False)
+        for entry, future in exports:
+            error = future.exception()
+            if error is not None:
+                entry["status"] = "failed"
+                entry["error"] = "".join(traceback.format_exception_only(type(error), error)).strip()
+        for reduced in exported_workspaces:
+            DeleteWorkspace(reduced)
+    return status
+
+
+def reduction_status(
+    row, status, Q_range_index=None, output_file=None, error=None, seconds=0.0
+):
+    """Creates the report entry of a single batchfile row."""
+    return {
+        "index": row.index,
+        "sample_scatter": row.sample_scatter,
+        "Q_range_index": Q_range_index,
+        "status": status,
+        "output_file": output_file,
+        "error": None
+        if error is None
+        else "".join(traceback.format_exception_only(type(error), error)).strip(),
+        "seconds": seconds,
+        "pid": os.getpid(),
+    }
+
+
+def batchfile_shards(batch, shard="row"):
+    """Splits the batchfile rows into shards of indices: one per row, or one per sample (measurement set) if shard is 'set'."""
+    if shard == "row":
+        return [[row.index] for row in batch]
+    elif shard == "set":
+        batch.probe_rows()
+        return [[row.index for row in rows] for rows in batch.by_sample.values()]
+    raise ValueError(f"Unknown shard type {shard}, expected 'row' or 'set'")
+
+
+def reduce_batchfile(
+    efficiency_file,
+    batch_filename="sans-batchfile.csv",
+    directory="data",
+    output_directory="reduced",
+    jobs=None,
+    shard="row",
+    mask_file_pattern=None,
+    number_of_bins=200,
+    dimensions=1,
+    report_file=None,
+    rebin=True,
+    profile_file=None,
+    save_backend="mantid",
+    export_workers=0,
+    center_backend="mantid",
+):
+    """Reduces all rows of a batchfile, sharding the rows over jobs worker processes (by default one per CPU) that each run
+    their own Mantid framework. Shards are single rows or, if shard is 'set', all rows of a sample which are then loaded as a
+    measurement set. Results are saved to output_directory by the workers and a status report of all rows is returned as a
+    DataFrame, which is also written to report_file (by default reduction-report.csv in output_directory).
+
+    mask_file_pattern, e.g. 'Q{Q_range_index}_mask.xml', gives the mask file used for each Q range. The rebin option sets the
+    pixel grouping as in SansData, e.g. 8 for quick looks or False for full resolution.
+
+    If profile_file is given, the time and memory used by each stage of every row are recorded in the workers and written
+    to it as a JSON (or CSV if it ends with .csv) report, see ridsans.profiling.
+
+    With save_backend="numpy", 2D results are written by the native NXcanSAS writer instead of SaveNXcanSAS (see save_2D).
+    With export_workers set, each worker saves its results in that many background threads (see ridsans.export).
+    With center_backend="numpy", the beam center is found once per direct file and Q range by find_center_workspace."""
+    batch = get_batchfile(batch_filename, directory)
+    shards = batchfile_shards(batch, shard)
+    os.makedirs(output_directory, exist_ok=True)
+    options = {
+        "efficiency_file": efficiency_file,
+        "batch_filename": batch.batch_filename,
+        "directory": directory,
+        "output_directory": output_directory,
+        "load_as_set": shard == "set",
+        "mask_file_pattern": mask_file_pattern,
+        "number_of_bins": number_of_bins,
+        "dimensions": dimensions,
+        "rebin": rebin,
+        "profile": profile_file is not None,
+        "save_backend": save_backend,
+        "export_workers": export_workers,
+        "center_backend": center_backend,
+    }
+    jobs = jobs or os.cpu_count()
+    status = []
+    stages = []
+    if jobs == 1:
+        for indices in shards:
+            shard_status, shard_stages = reduce_shard(indices, **options)
+            status.extend(shard_status)
+            stages.extend(shard_stages)
+    else:
+        with worker_executor(min(jobs, len(shards))) as executor:
+            futures = {
+                executor.submit(reduce_shard, indices, **options): indices
+                for indices in shards
+            }
+            for future in as_completed(futures):
+                try:
+                    shard_status, shard_stages = future.result()
+                    status.extend(shard_status)
+                    stages.extend(shard_stages)
+                except Exception as e:
+                    # The worker itself failed (e.g. it crashed), so none of the rows of the shard were reduced
+                    status.extend(
+                        reduction_status(batch[index], "failed", error=e)
+                        for index in futures[future]
+                    )
+
+    report = pd.DataFrame(status).sort_values("index").reset_index(drop=True)
+    if report_file is None:
+        report_file = os.path.join(output_directory, "reduction-report.csv")
+    report.to_csv(report_file, index=False)
+    failed = (report["status"] != "ok").sum()
+    print(f"Reduced {len(report) - failed} of {len(report)} rows, report written to {report_file}")
+    if profile_file is not None:
+        profiling.write_profile_report(profile_file, stages)
+        profiling.print_profile_summary(stages)
+    return report
@@ -0,0 +1,218 @@
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+from ridsans.export import atomic_file
+from ridsans.profiling import profiled
+from ridsans.sansdata import *
+
+# Bumped whenever the layout of cached entries changes, invalidating all older entries
+CACHE_FORMAT_VERSION = 3
+
+# The cache is opt-in: it is only used once a directory is set, either through the
+# RIDSANS_CACHE_DIR environment variable or by calling set_cache_dir
+cache_dir = os.environ.get("RIDSANS_CACHE_DIR")
+# Maximum total size of the cache directory in bytes, 2 GB by default
+cache_max_bytes = int(os.environ.get("RIDSANS_CACHE_MAX_BYTES", 2 * 1024**3))
+
+with open(os.path.join(os.path.dirname(__file__), "instrument_config.yaml"), "rb") as f:
+    # Changing the instrument configuration (e.g. the cropped extent) invalidates the cache
+    config_hash = hashlib.sha256(f.read()).hexdigest()
+
+
+def set_cache_dir(directory, max_bytes=None):
+    """Enables the on-disk cache of parsed SansData objects in the given directory, or disables it if None is passed."""
+    global cache_dir, cache_max_bytes
+    cache_dir = None if directory is None else str(directory)
+    if max_bytes is not None:
+        cache_max_bytes = int(max_bytes)
+
+
+def cache_key(filename, keep_all_counts=False, rebin=True, image_code="CDAT2"):
+    """Computes the cache key of a measurement file from its path, size and modification time together with
+    the parsing options and the instrument configuration."""
+    path = Path(filename).resolve()
+    stat = path.stat()
+    key = [
+        CACHE_FORMAT_VERSION,
+        str(path),
+        stat.st_size,
+        stat.st_mtime_ns,
+        keep_all_counts,
+        resolve_rebin_factor(rebin),
+        image_code,
+        config_hash,
+    ]
+    return hashlib.sha256(json.dumps(key).encode()).hexdigest()
+
+
+def entry_paths(key, directory=None):
+    """Gives the paths of the image array and metadata sidecar of a cache entry."""
+    directory = Path(directory or cache_dir)
+    return directory / f"{key}.npy", directory / f"{key}.json"
+
+
+def sansdata_metadata(sansdata):
+    """Collects all attributes of a SansData object except the detector arrays in a JSON serializable dictionary."""
+    metadata = {}
+    for name, value in vars(sansdata).items():
+        if isinstance(value, np.ndarray):
+            continue
+        if isinstance(value, Beamstop):
+            value = {"__beamstop__": vars(value)}
+        elif isinstance(value, Path):
+            value = str(value)
+        metadata[name] = value
+    return metadata
+
+
+def sansdata_from_cache(metadata, raw_intensity):
+    """Reconstructs a SansData object from cached metadata and raw counts without parsing the file. The intensities
+    are derived from the counts on first use as usual."""
+    sansdata = SansData.__new__(SansData)
+    for name, value in metadata.items():
+        if isinstance(value, dict) and "__beamstop__" in value:
+            beamstop = Beamstop.__new__(Beamstop)
+            beamstop.__dict__.update(value["__beamstop__"])
+            value = beamstop
+        setattr(sansdata, name, value)
+    sansdata.raw_intensity = raw_intensity
+    return sansdata
+
+
+def lookup(key, directory=None):
+    """Retrieves a cached SansData object, memory-mapping its raw counts. Returns None if there is no entry for the key."""
+    array_path, metadata_path = entry_paths(key, directory)
+    try:
+        with open(metadata_path) as f:
+            metadata = json.load(f)
+        raw_intensity = np.load(array_path, mmap_mode="r")
+    except (OSError, ValueError):
+        return None
+    # Marks the entry as recently used for eviction
+    os.utime(metadata_path)
+    return sansdata_from_cache(metadata, raw_intensity)
+
+
+def store(key, sansdata, directory=None):
+    """Stores the raw counts and metadata of a SansData object in the cache, evicting old entries if needed."""
+    directory = Path(directory or cache_dir)
+    directory.mkdir(parents=True, exist_ok=True)
+    array_path, metadata_path = entry_paths(key, directory)
+    raw_intensity = np.ascontiguousarray(sansdata.raw_intensity)
+    # Entries are written through temporary files, and the sidecar is written last as its presence marks the entry as complete
+    with atomic_file(array_path) as tmp_path, open(tmp_path, "wb") as f:
+        np.save(f, raw_intensity)
+    metadata = json.dumps(sansdata_metadata(sansdata), default=float).encode()
+    with atomic_file(metadata_path) as tmp_path, open(tmp_path, "wb") as f:
+        f.write(metadata)
+    evict(cache_max_bytes, directory)
+
+
+@profiled(file_arg="filename")
+def load_sansdata(
+    filename,
+    log_process=False,
+    keep_all_counts=False,
+    rebin=True,
+    image_code="CDAT2",
+    dtype=np.float64,
+    lazy=False,
+):
+    """Creates a SansData object, using the on-disk cache if it is enabled. On a cache miss the file is
+    parsed and the result is stored for later loads. With lazy set, a file that is not cached is not stored
+    either, as only its metadata is read."""
+    if cache_dir is None:
+        return SansData(filename, log_process, keep_all_counts, rebin, image_code, dtype, lazy)
+    key = cache_key(filename, keep_all_counts, rebin, image_code)
+    sansdata = lookup(key)
+    if sansdata is None:
+        sansdata = SansData(filename, log_process, keep_all_counts, rebin, image_code, dtype, lazy)
+        if not lazy:
+            store(key, sansdata)
+    else:
+        # Only the counts are cached, so the intensity type can differ between loads
+        sansdata.dtype = np.dtype(dtype).name
+        sansdata.filename = filename
+        sansdata.name = Path(filename).stem
+        sansdata.log_process = log_process
+        sansdata.log(f"=== Loaded RIDSANS measurement file from cache: {filename} ===")
+    return sansdata
+
+
+def cache_entries(directory=None):
+    """Lists the complete cache entries as (key, size in bytes, last use time), sorted from least to most recently used."""
+    directory = Path(directory or cache_dir)
+    entries = []
+    for metadata_path in directory.glob("*.json"):
+        array_path = metadata_path.with_suffix(".npy")
+        try:
+            size = metadata_path.stat().st_size + array_path.stat().st_size
+            last_use = metadata_path.stat().st_mtime
+        except OSError:
+            continue
+        entries.append((metadata_path.stem, size, last_use))
+    return sorted(entries, key=lambda entry: entry[2])
+
+
+def remove_entry(key, directory=None):
+    """Removes a single cache entry."""
+    for path in entry_paths(key, directory):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+
+
+def evict(max_bytes=None, directory=None):
+    """Removes the least recently used entries until the total size of the cache is at most max_bytes. Returns the number of removed entries."""
+    if max_bytes is None:
+        max_bytes = cache_max_bytes
+    entries = cache_entries(directory)
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for key, size, _ in entries:
+        if total <= max_bytes:
+            break
+        remove_entry(key, directory)
+        total -= size
+        removed += 1
+    return removed
+
+
+def purge_cache(directory=None):
+    """Removes all entries from the cache. Returns the number of removed entries."""
+    return evict(0, directory)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Inspect or clean the on-disk cache of parsed .mpa files."
+    )
+    parser.add_argument("command", choices=["info", "evict", "purge"])
+    parser.add_argument(
+        "--dir",
+        default=cache_dir,
+        help="Cache directory, defaults to the RIDSANS_CACHE_DIR environment variable.",
+    )
+    parser.add_argument(
+        "--max-bytes",
+        type=int,
+        default=cache_max_bytes,
+        help="Maximum cache size used by the evict command.",
+    )
+    args = parser.parse_args()
+    if args.dir is None:
+        parser.error("no cache directory given and RIDSANS_CACHE_DIR is not set")
+
+    if args.command == "info":
+        entries = cache_entries(args.dir)
+        total = sum(size for _, size, _ in entries)
+        print(f"{len(entries)} entries, {total / 1024**2:.1f} MB in {args.dir}")
+    elif args.command == "evict":
+        print(f"Removed {evict(args.max_bytes, args.dir)} entries")
+    else:
+        print(f"Removed {purge_cache(args.dir)} entries")
@@ -0,0 +1,214 @@
+import numpy as np
+
+from ridsans.profiling import profiled
+from ridsans.transmission_cache import *
+
+
+def compute_transmission_factor(sample_transmission, direct, background):
+    """Compute tranmission factor assuming that the same attenuator is used, needs to be adjusted otherwise."""
+    # Compensates for slight variations between beam intensity for sample and empty transmission measurements
+    beam_variation_factor = direct.I_0 / sample_transmission.I_0
+    # It is important to correct for background to avoid overestimating the transmission
+    return np.sum(
+        beam_variation_factor * (sample_transmission.I - background.I)
+    ) / np.sum(direct.I - background.I)
+
+
+def check_transmission_coefficients(T_sample, T_can):
+    """Checks transmission coefficients, giving hard errors for values outside of the 0 to 1 range and correctness warnings for low coefficients."""
+    # Hard errors for T_sample, T_can outside of 0 to 1 range
+    if T_sample < 0.0:
+        print(
+            f"Warning: T_sample is greater smaller than 0 (T_can = {T_can}), signal strength might be too low."
+        )
+    if T_sample > 1.0:
+        # In principle, there are samples that could give a netto increase in neutrons...
+        print(
+            f"Warning: T_sample is greater than one (T_can = {T_can}), signal strength might be too low."
+        )
+    if T_can < 0.0:
+        print(
+            f"Warning: T_can is greater smaller than 0 (T_can = {T_can}), signal strength might be too low."
+        )
+    if T_can > 1.0:
+        print(
+            f"Warning: T_can is greater than one (T_can = {T_can}), signal strength might be too low."
+        )
+
+    # Warnings for inadequate transmission coefficients, this indicates the single scattering limit does not exactly apply
+    if T_can < 0.8:
+        print(
+            f"Warning: T_can is low (T_can = {T_can} < 0.8), multiple scattering cannot be neglected."
+        )
+    if T_sample < 0.8:
+        print(
+            f"Warning: T_sample is low (T_sample = {T_sample} < 0.8), multiple scattering cannot be neglected."
+        )
+
+
+def measurement_transmission_factors(
+    sample_transmission,
+    can_transmission,
+    direct,
+    background,
+    sums,
+    direct_sum,
+    transmissions=None,
+):
+    """Determines (T_sample, T_can, T_sample_can) of a single row, either from the transmissions passed as [T_sample, T_can] or from
+    the transmission measurements. sums maps (the ids of) measurements to their summed intensity, so that measurements shared
+    between rows are only summed once, and direct_sum is the summed intensity of the direct beam minus background. Computed
+    factors are stored in the transmission cache if it is enabled."""
+    if transmissions is not None:
+        if len(transmissions) != 2:
+            raise ValueError(
+                "Length of transmissions passed to reduction should be two, a value of the form [T_sample, T_can] is expected."
+            )
+        T_sample, T_can = transmissions
+        return T_sample, T_can, T_sample * T_can
+
+    def transmission_factor(transmission):
+        # Same as compute_transmission_factor, using the sums of the intensities instead of the sum of their difference
+        if id(transmission) not in sums:
+            sums[id(transmission)] = np.sum(transmission.I)
+        beam_variation_factor = direct.I_0 / transmission.I_0
+        return (
+            beam_variation_factor
+            * (sums[id(transmission)] - sums[id(background)])
+            / direct_sum
+        )
+
+    # Transmission factor of sample and can together
+    T_sample_can = transmission_factor(sample_transmission)
+    # Can (container) transmission factor
+    T_can = 1.0  # Ideally to be computed from can_transmission measurement, not present?
+
+    # If can transmission measurement is included
+    if can_transmission is not None:
+        T_can = transmission_factor(can_transmission)
+    if T_can == 0.0:
+        raise ValueError("T_can is zero, please check your input workspaces.")
+    T_sample = T_sample_can / T_can
+    store_transmissions(
+        sample_transmission, can_transmission, direct, background, T_sample, T_can
+    )
+    return T_sample, T_can, T_sample_can
+
+
+@profiled()
+def correct_measurements(
+    sample_scatters,
+    sample_transmissions,
+    can_scatters,
+    can_transmissions,
+    direct,
+    background,
+    transmissions=None,
+    has_can_transmission=None,
+):
+    """Computes the corrected intensity and its error for several rows that share the same direct and background measurement,
+    following a formalism similar to that discussed in Dewhurst, C. D. (2023). J. Appl. Cryst. 56, 1595-1609. The arguments are
+    lists with an entry (SansData or None) per row, transmissions can be a list of [T_sample, T_can] (or None) per row.
+    has_can_transmission tells per row whether a can transmission was measured, which decides how the can is corrected. It
+    defaults to whether can_transmissions holds a measurement, but must be given when the transmission measurements were
+    not loaded because their factors were taken from the transmission cache.
+
+    The intensities of all rows are stacked and corrected with in-place operations on the stack, while the sums over the direct,
+    background and transmission measurements are only computed once. Returns the corrected intensities and errors as
+    (rows x pixels) arrays together with arrays of T_sample and T_can."""
+    rows = len(sample_scatters)
+    if transmissions is None:
+        transmissions = [None] * rows
+    if has_can_transmission is None:
+        has_can_transmission = [x is not None for x in can_transmissions]
+    sums = {id(background): np.sum(background.I)}
+    direct_sum = np.sum(direct.I - background.I)
+
+    # Each row is corrected as I = a * (sample - background) - b * (can - background)
+    a = np.zeros(rows)
+    b = np.zeros(rows)
+    # The weight of the background variance in the error, which depends on the case as described below
+    w = np.zeros(rows)
+    T_samples = np.zeros(rows)
+    T_cans = np.zeros(rows)
+    for i in range(rows):
+        T_sample, T_can, T_sample_can = measurement_transmission_factors(
+            sample_transmissions[i],
+            can_transmissions[i],
+            direct,
+            background,
+            sums,
+            direct_sum,
+            transmissions[i],
+        )
+        print(f"Transmission factors: T_sample = {T_sample}; T_can = {T_can}")
+        check_transmission_coefficients(T_sample, T_can)
+        T_samples[i], T_cans[i] = T_sample, T_can
+
+        # Compensate for a differing monitor flux-ratio between scatter and transmission measurement
+        # The monitor count indicates what the total rate of neutrons
+        # entering the instrument from the beamline is
+        flux_factor = sample_scatters[i].I_0 / direct.I_0
+
+        # Normalize scattering by the direct intensity
+        # times the monitor flux ratio of scatter/transmission measurements
+        # This effectively transforms the total detector count of the direct measurement
+        # to an estimate of what the total detector count would be at the adjusted flux
+
+        # In other words, this gives an estimate of the the total empty beam intensity
+        # at the flux of the scattering measurement
+        I_0 = flux_factor * direct_sum
+
+        if can_scatters[i] is not None:
+            # A can is used
+
+            # There can be slight differences in the beamline intensity between can and sample
+            # measurements, corrects for this
+            sample_can_ratio = can_scatters[i].I_0 / sample_scatters[i].I_0
+            if has_can_transmission[i]:
+                a[i] = 1 / (T_sample_can * I_0)
+                b[i] = sample_can_ratio / (T_can * I_0)
+                # TODO: correct formula as background contributions here are correlated and not independent
+                w[i] = a[i] ** 2 + b[i] ** 2
+            else:
+                # Per the formula, when the same transmission is used for sample and can scattering,
+                # the background cancels...
+                # TODO: verify this is allowed
+                a[i] = 1 / (T_sample * I_0)
+                b[i] = sample_can_ratio / (T_sample * I_0)
+                w[i] = (a[i] - b[i]) ** 2
+        else:
+            # Assume no can is used as when using solid samples, crystals etc. or that its effect is ignored
+            a[i] = 1 / (T_sample * I_0)
+            w[i] = a[i] ** 2
+
+    # Ignore errors of T_sample, T_can and I_0
+    # TODO: incorperate these errors for more accurate error calculation
+    # The images are flattened to rows of pixels (in spectrum order)
+    I_background = np.ravel(background.I)
+    I_corrected = np.stack([np.ravel(x.I) for x in sample_scatters])
+    I_corrected -= I_background
+    I_corrected *= a[:, None]
+    dI_corrected = np.stack([np.ravel(x.dI) for x in sample_scatters])
+    np.square(dI_corrected, out=dI_corrected)
+    dI_corrected *= (a**2)[:, None]
+
+    can_rows = [i for i in range(rows) if can_scatters[i] is not None]
+    if can_rows:
+        I_can = np.stack([np.ravel(can_scatters[i].I) for i in can_rows])
+        I_can -= I_background
+        I_can *= b[can_rows, None]
+        I_corrected[can_rows] -= I_can
+        del I_can
+        dI_can = np.stack([np.ravel(can_scatters[i].dI) for i in can_rows])
+        np.square(dI_can, out=dI_can)
+        dI_can *= (b[can_rows] ** 2)[:, None]
+        dI_corrected[can_rows] += dI_can
+        del dI_can
+
+    background_variance = np.square(np.ravel(background.dI))
+    buffer = np.empty_like(background_variance)
+    for row, weight in zip(dI_corrected, w):
+        row += np.multiply(background_variance, weight, out=buffer)
+    np.sqrt(dI_corrected, out=dI_corrected)
+    return I_corrected, dI_corrected, T_samples, T_cans
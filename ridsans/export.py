@@ -0,0 +1,142 @@
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+from ridsans.nxcansas import metadata_names, sample_Q
+
+# Mode of newly created files under the umask. mkstemp creates files that only the owner can read, which os.replace would
+# keep. Reading the umask means setting it, so this is done once on import rather than in the writer threads.
+umask = os.umask(0)
+os.umask(umask)
+file_mode = 0o666 & ~umask
+
+
+@contextmanager
+def atomic_file(file_name):
+    """Gives a temporary file name in the directory of file_name, with the same extension, that is renamed to file_name
+    when the enclosed code completes and removed if it fails. Readers therefore never see a partially written file. The file
+    gets the permissions of a file created normally. Used for all written results and cache files."""
+    path = Path(file_name)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=".tmp-", suffix=f"-{path.name}")
+    os.close(fd)
+    try:
+        yield tmp_path
+        os.chmod(tmp_path, file_mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class ExportQueue:
+    """Writes result files in a pool of background threads, so that a reduction loop can continue while files are written
+    to (slow) storage. Submitting blocks while max_pending files are waiting to be written, which bounds the memory held by
+    results in the queue. Every file is written through a temporary file that is renamed when complete. Errors are collected
+    and raised by flush, which waits until all submitted files are written.
+
+        with ExportQueue() as queue:
+            for ...:
+                queue.submit(save, f"{name}.xml", reduced)
+    """
+
+    def __init__(self, workers=2, max_pending=8):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ridsans-export")
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        # (future, file name) of the writes submitted since the last flush
+        self.pending = []
+
+    def write(self, write, file_name, args, kwargs):
+        """Runs a write in a worker thread, through a temporary file."""
+        with atomic_file(file_name) as tmp_path:
+            write(*args, file_name=tmp_path, **kwargs)
+
+    def submit(self, write, file_name, *args, **kwargs):
+        """Queues a call write(*args, file_name=..., **kwargs) writing the file file_name, e.g. submit(save, "x.xml", ws) or
+        submit(write_nxcansas_2D, "x.h5", samples=samples) for writers that take file_name as first argument. file_name must
+        include the extension, as the writer is given a temporary file name with the same extension. The arguments should not be modified until the file is written. Blocks while the
+        queue is full. Returns a future that holds the error if the write fails."""
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(self.write, write, str(file_name), args, kwargs)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        with self.lock:
+            self.pending.append((future, str(file_name)))
+        return future
+
+    def flush(self, raise_errors=True):
+        """Waits until all submitted files are written. Raises a RuntimeError describing the failed writes if raise_errors is
+        set, otherwise returns them as a list of (file name, exception)."""
+        with self.lock:
+            pending, self.pending = self.pending, []
+        errors = []
+        for future, file_name in pending:
+            error = future.exception()
+            if error is not None:
+                errors.append((file_name, error))
+        if errors and raise_errors:
+            file_name, error = errors[0]
+            raise RuntimeError(
+                f"{len(errors)} of {len(pending)} exports failed, first {file_name}: {error}"
+            ) from error
+        return errors
+
+    def close(self, raise_errors=True):
+        """Flushes the queue and stops its threads."""
+        try:
+            return self.flush(raise_errors)
+        finally:
+            self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Files are still written when the loop failed, but its error takes precedence over those of the writes
+        self.close(raise_errors=exc_type is None)
+
+
+def text_file_name(name, suffix=".txt"):
+    """File name for a sample, replacing the path separators found in workspace names like x_dSigma/dOmega_1D."""
+    return name.replace("/", "_").replace("\\", "_") + suffix
+
+
+def format_text_1D(sample):
+    """Formats a 1D sample (as written by write_nxcansas_1D) as text: a commented header with the name and metadata followed
+    by columns Q (1/A), I (1/cm) and dI (1/cm), leaving out bins without a finite intensity."""
+    Q = sample_Q(sample)
+    I = np.asarray(sample["I"], dtype=float)
+    dI = np.asarray(sample["dI"], dtype=float)
+    valid = np.isfinite(I) & np.isfinite(dI)
+    lines = [f"# {sample['name']}"]
+    lines += [f"# {name} = {sample[name]}" for name in metadata_names if sample.get(name) is not None]
+    lines.append("# Q (1/A)  I (1/cm)  dI (1/cm)")
+    values = np.char.mod("%.8e", np.column_stack([Q[valid], I[valid], dI[valid]]))
+    lines += [" ".join(row) for row in values.tolist()]
+    return ("\n".join(lines) + "\n").encode()
+
+
+def write_text_1D(directory, samples, suffix=".txt"):
+    """Writes 1D samples to a text file each in directory, named after the samples. Every file is formatted in memory and
+    written with a single write through a temporary file, which keeps exporting thousands of curves fast. Returns the
+    paths of the written files."""
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    file_names = []
+    for sample in samples:
+        file_name = directory / text_file_name(sample["name"], suffix)
+        content = format_text_1D(sample)
+        with atomic_file(file_name) as tmp_path, open(tmp_path, "wb") as f:
+            f.write(content)
+        file_names.append(file_name)
+    return file_names
@@ -3,13 +3,18 @@ from mantid.api import AnalysisDataService as ADS
 from mantid.kernel import *
 from mantid.simpleapi import *
 
+from ridsans.correct import *
 from ridsans.load_util import *
+from ridsans.profiling import profiled
 from ridsans.sansdata import *
 
 
 def create_pixel_adj_workspace(pixel_efficiencies, bins, detectors, force_reload=False):
-    """Creates a workspace from a NumPy array of pixel efficiencies to be used in Qxy or Q1D as PixelAdj. Retrieves it from the AnalysisDataService if it is already loaded and force_reload is not set."""
+    """Creates a workspace from a NumPy array of pixel efficiencies to be used in Qxy or Q1D as PixelAdj. The efficiencies are
+    rebinned to the number of detectors if needed. Retrieves it from the AnalysisDataService if it is already loaded for the same
+    number of detectors and force_reload is not set."""
     x = np.tile(bins, detectors)
+    pixel_efficiencies = rebin_pixel_efficiency(pixel_efficiencies, detectors)
     y = pixel_efficiencies[:, :, 0]
     e = pixel_efficiencies[:, :, 1]
     y[y <= 0] = 1
@@ -17,6 +22,8 @@ def create_pixel_adj_workspace(pixel_efficiencies, bins, detectors, force_reload
         if force_reload:
             raise KeyError("force_reload is set")
         pixel_adj = ADS.retrieve("PixelAdj")
+        if pixel_adj.getNumberHistograms() != detectors:
+            raise KeyError("PixelAdj was created for a different rebin factor")
     except KeyError:
         pixel_adj = CreateWorkspace(
             OutputWorkspace="PixelAdj",
@@ -29,14 +36,32 @@ def create_pixel_adj_workspace(pixel_efficiencies, bins, detectors, force_reload
     return pixel_adj
 
 
-def compute_transmission_factor(sample_transmission, direct, background):
-    """Compute tranmission factor assuming that the same attenuator is used, needs to be adjusted otherwise."""
-    # Compensates for slight variations between beam intensity for sample and empty transmission measurements
-    beam_variation_factor = direct.I_0 / sample_transmission.I_0
-    # It is important to correct for background to avoid overestimating the transmission
-    return np.sum(
-        beam_variation_factor * (sample_transmission.I - background.I)
-    ) / np.sum(direct.I - background.I)
+# Names of the hidden template workspaces holding a loaded instrument together with the output of LoadInstrument,
+# keyed by pixel count and instrument definition file
+instrument_templates = {}
+
+
+def instrument_template(detectors, instrument_file=None):
+    """Returns a workspace with the instrument loaded for a given number of detectors, creating it on first use. Parsing the
+    instrument definition and building the spectra map is only done once per session instead of for every measurement.
+    By default the instrument definition matching the number of detectors is generated from the template."""
+    if instrument_file is None:
+        instrument_file = instrument_definition_file(detectors)
+    key = (detectors, instrument_file)
+    if key not in instrument_templates or not ADS.doesExist(instrument_templates[key][0]):
+        # Workspaces starting with __ are hidden in the workbench
+        name = f"__{Path(instrument_file).stem}_template_{detectors}"
+        ws = CreateWorkspace(
+            OutputWorkspace=name,
+            UnitX="Wavelength",
+            DataX=np.tile([0.0, 1.0], detectors),
+            DataY=np.zeros(detectors),
+            NSpec=detectors,
+        )
+        mon = LoadInstrument(ws, FileName=instrument_file, RewriteSpectraMap=True)
+        instrument_templates[key] = (name, mon)
+    name, mon = instrument_templates[key]
+    return ADS.retrieve(name), mon
 
 
 def monochromatic_workspace(name, I, detector_position, bins, detectors, error=None):
@@ -44,15 +69,20 @@ def monochromatic_workspace(name, I, detector_position, bins, detectors, error=N
     # Use the same bin for each detector
     x = np.tile(bins, detectors)
 
+    # The instrument is taken from the template workspace, with spectrum i mapped to detector i
+    template, mon = instrument_template(detectors)
+    # Workspaces hold float64 data, so intensities computed in float32 are converted here
+    if error is not None:
+        error = np.asarray(error, dtype=np.float64)
     ws = CreateWorkspace(
         OutputWorkspace=name,
         UnitX="Wavelength",
         DataX=x,
-        DataY=I,
+        DataY=np.asarray(I, dtype=np.float64),
         DataE=error,
         NSpec=detectors,
+        ParentWorkspace=template,
     )
-    mon = LoadInstrument(ws, FileName="RIDSANS_Definition.xml", RewriteSpectraMap=True)
 
     # Move sample to right position relative to detector
     # This needs to be set correctly for later reduction steps (Qxy/Q1D)
@@ -69,43 +99,36 @@ def monochromatic_workspace(name, I, detector_position, bins, detectors, error=N
 
 def workspace_from_sansdata(sansdata, bins, detectors):
     """Helper function to pass SansData fields into monochromatic_workspace"""
-    return monochromatic_workspace(
+    ws, mon = monochromatic_workspace(
         sansdata.name, sansdata.I, sansdata.d, bins, detectors
     )
+    # The measurement file identifies the workspace for caches such as that of the beam center
+    ws.getRun().addProperty("filename", str(sansdata.filename), True)
+    return ws, mon
 
 
-def check_transmission_coefficients(T_sample, T_can):
-    """Checks transmission coefficients, giving hard errors for values outside of the 0 to 1 range and correctness warnings for low coefficients."""
-    # Hard errors for T_sample, T_can outside of 0 to 1 range
-    if T_sample < 0.0:
-        print(
-            f"Warning: T_sample is greater smaller than 0 (T_can = {T_can}), signal strength might be too low."
-        )
-    if T_sample > 1.0:
-        # In principle, there are samples that could give a netto increase in neutrons...
-        print(
-            f"Warning: T_sample is greater than one (T_can = {T_can}), signal strength might be too low."
-        )
-    if T_can < 0.0:
-        print(
-            f"Warning: T_can is greater smaller than 0 (T_can = {T_can}), signal strength might be too low."
-        )
-    if T_can > 1.0:
-        print(
-            f"Warning: T_can is greater than one (T_can = {T_can}), signal strength might be too low."
-        )
+def corrected_workspace(sample_scatter, I_corrected, dI_corrected, T_sample, T_can, bins, detectors):
+    """Creates the workspace of a corrected sample measurement, with the transmission factors, thickness and Q range as properties."""
+    ws, mon = monochromatic_workspace(
+        sample_scatter.name,
+        I_corrected,
+        sample_scatter.d,
+        bins,
+        detectors,
+        error=dI_corrected,
+    )
+    # Including the transmissions as property of the workspace enables easy retrieval for transmission factor reuse
+    ws.getRun().addProperty("T_sample", float(T_sample), True)
+    ws.getRun().addProperty("T_can", float(T_can), True)
 
-    # Warnings for inadequate transmission coefficients, this indicates the single scattering limit does not exactly apply
-    if T_can < 0.8:
-        print(
-            f"Warning: T_can is low (T_can = {T_can} < 0.8), multiple scattering cannot be neglected."
-        )
-    if T_sample < 0.8:
-        print(
-            f"Warning: T_sample is low (T_sample = {T_sample} < 0.8), multiple scattering cannot be neglected."
-        )
+    if sample_scatter.thickness is not None:
+        # Add the sample thickness as workspace property if it existed in the file, which makes
+        # it a field of sample_scatter
+        ws.getRun().addProperty("thickness", float(sample_scatter.thickness), True)
+    return ws, mon
 
 
+@profiled(file_arg="sample_scatter")
 def workspace_from_measurement(
     sample_scatter,
     sample_transmission,
@@ -116,111 +139,30 @@ def workspace_from_measurement(
     bins,
     detectors,
     transmissions=None,
+    has_can_transmission=None,
 ):
-    """Reduces the different measurements to a single corrected intensity following a formalism similar to that discussed in
-    Dewhurst, C. D. (2023). J. Appl. Cryst. 56, 1595-1609. It returns this reduced scattering workspace in addition to a monitor
-    object which is currently not used and the id of the Q range (1 - 4 currently).
+    """Reduces the different measurements to a single corrected intensity using correct_measurements. It returns this reduced
+    scattering workspace in addition to a monitor object which is currently not used and the id of the Q range (1 - 4 currently).
     """
-    if transmissions is not None:
-        if len(transmissions) != 2:
-            raise ValueError(
-                "Length of transmissions passed to reduction should be two, a value of the form [T_sample, T_can] is expected."
-            )
-        T_sample, T_can = transmissions
-        T_sample_can = T_sample * T_can
-    else:
-        # Transmission factor of sample and can together
-        T_sample_can = compute_transmission_factor(
-            sample_transmission, direct, background
-        )
-        # Can (container) transmission factor
-        T_can = 1.0  # Ideally to be computed from can_transmission measurement, not present?
-
-        # If can transmission measurement is included
-        if can_transmission is not None:
-            T_can = compute_transmission_factor(can_transmission, direct, background)
-        if T_can == 0.0:
-            raise ValueError("T_can is zero, please check your input workspaces.")
-        T_sample = T_sample_can / T_can
-    print(f"Transmission factors: T_sample = {T_sample}; T_can = {T_can}")
-
-    check_transmission_coefficients(T_sample, T_can)
-
-    # Compensate for a differing monitor flux-ratio between scatter and transmission measurement
-    # The monitor count indicates what the total rate of neutrons
-    # entering the instrument from the beamline is
-    flux_factor = sample_scatter.I_0 / direct.I_0
-
-    # Normalize scattering by the direct intensity
-    # times the monitor flux ratio of scatter/transmission measurements
-    # This effectively transforms the total detector count of the direct measurement
-    # to an estimate of what the total detector count would be at the adjusted flux
-
-    # In other words, this gives an estimate of the the total empty beam intensity
-    # at the flux of the scattering measurement
-    I_0 = flux_factor * np.sum(direct.I - background.I)
-
-    # Corrected intensity considering background and tranmission factors of sample and can.
-    if can_scatter is not None:
-        # A can is used
-
-        # There can be slight differences in the beamline intensity between can and sample
-        # measurements, corrects for this
-        sample_can_ratio = can_scatter.I_0 / sample_scatter.I_0
-        if can_transmission is not None:
-            I_corrected = (
-                1 / (T_sample_can) * (sample_scatter.I - background.I)
-                - 1 / T_can * sample_can_ratio * (can_scatter.I - background.I)
-            ) / I_0
-
-            # Ignore error T_sample, T_can and I_0
-            # TODO: incorperate these errors for more accurate error calculation
-            # TODO: correct formula as background contributions here are correlated and not independent
-            dI_corrected = (
-                np.sqrt(
-                    (sample_scatter.dI**2 + background.dI**2) / (T_sample_can) ** 2
-                    + sample_can_ratio ** 2 * (can_scatter.dI ** 2 + background.dI**2)
-                    / T_can ** 2
-                )
-                / I_0
-            )
-        else:
-            # Per the formula, when the same transmission is used for sample and can scattering,
-            # the background cancels...
-            # TODO: verify this is allowed
-            I_corrected = (
-                1 / T_sample * ((sample_scatter.I - background.I) - (can_scatter.I - background.I) * sample_can_ratio)
-            ) / I_0
-
-            # Ignore error T_sample, T_can and I_0
-            # TODO: incorperate these errors for more accurate error calculation
-            dI_corrected = np.sqrt(
-                sample_scatter.dI**2 + background.dI**2*(1 - sample_can_ratio)**2 + (can_scatter.dI * sample_can_ratio) ** 2
-            ) / (T_sample * I_0)
-    else:
-        # Assume no can is used as when using solid samples, crystals etc. or that its effect is ignored
-        I_corrected = 1 / T_sample * (sample_scatter.I - background.I) / I_0
-
-        # Ignore error T_sample and I_0
-        dI_corrected = np.sqrt(sample_scatter.dI**2 + background.dI**2) / (
-            T_sample * I_0
-        )
-    ws, mon = monochromatic_workspace(
-        sample_scatter.name,
-        I_corrected,
-        sample_scatter.d,
+    I_corrected, dI_corrected, T_samples, T_cans = correct_measurements(
+        [sample_scatter],
+        [sample_transmission],
+        [can_scatter],
+        [can_transmission],
+        direct,
+        background,
+        [transmissions],
+        None if has_can_transmission is None else [has_can_transmission],
+    )
+    ws, mon = corrected_workspace(
+        sample_scatter,
+        I_corrected[0],
+        dI_corrected[0],
+        T_samples[0],
+        T_cans[0],
         bins,
         detectors,
-        error=dI_corrected,
     )
-    # Including the transmissions as property of the workspace enables easy retrieval for transmission factor reuse
-    ws.getRun().addProperty("T_sample", float(T_sample), True)
-    ws.getRun().addProperty("T_can", float(T_can), True)
-
-    if sample_scatter.thickness is not None:
-        # Add the sample thickness as workspace property if it existed in the file, which makes
-        # it a field of sample_scatter
-        ws.getRun().addProperty("thickness", float(sample_scatter.thickness), True)
     return (
         ws,
         mon,
@@ -244,8 +186,10 @@ def load_RIDSANS_from_sansdata(
     background,
     relative_pixel_efficiency,
     transmissions=None,
+    has_can_transmission=None,
 ):
-    """This is used by load_RIDSANS, taking SansData objects instead of filenames."""
+    """This is used by load_RIDSANS, taking SansData objects instead of filenames. has_can_transmission is passed on to
+    correct_measurements."""
     bins = create_monochrom_bin_bounds(sample_scatter.L0)
     detectors = sample_scatter.pixel_count
     pixel_adj = create_pixel_adj_workspace(relative_pixel_efficiency, bins, detectors)
@@ -259,6 +203,7 @@ def load_RIDSANS_from_sansdata(
         bins,
         detectors,
         transmissions,
+        has_can_transmission,
     )
     ws_direct, _ = workspace_from_sansdata(direct, bins, detectors)
     ws_sample.getRun().addProperty("Q_range_index", Q_range_index, True)
@@ -266,6 +211,7 @@ def load_RIDSANS_from_sansdata(
     return ws_sample, ws_direct, mon, pixel_adj, Q_range_index
 
 
+@profiled(file_arg="sample_scatter_file")
 def load_RIDSANS(
     sample_scatter_file,
     sample_transmission_file,
@@ -275,6 +221,9 @@ def load_RIDSANS(
     background_file,
     efficiency_file,
     transmissions=None,
+    force_reload=False,
+    rebin=True,
+    dtype=np.float64,
 ):
     """Loads a RIDSANS measurement into a sample workspace (with corrected intensity),
     a direct measurement workspace for beam centre finding and a pixel adjustment workspace.
@@ -283,9 +232,27 @@ def load_RIDSANS(
     - A sample scatter and transmission (for samples that do not need a container)
     - A sample scatter and transmission and can scatter (neglects can transmission)
     - A sample and can scatter and transmission to make calculation of sample and can transmission factors possible
+
+    Measurement files that were loaded before in this session are reused unless force_reload is set. If the transmission cache
+    is enabled and holds the transmission factors of these files, the transmission measurements are not loaded at all. The detector is rebinned
+    into groups of rebin x rebin pixels (the configured rebin_factor if rebin is True, no rebinning if it is False) with the
+    pixel efficiencies and instrument definition following along. Setting dtype to np.float32 computes the intensities and
+    their correction in single precision, halving the memory used by the measurements.
     """
     print("Starting load_RIDSANS")
     relative_pixel_efficiency = np.load(efficiency_file)
+    # The can is corrected according to whether its transmission was measured, also when the measurement is not loaded
+    has_can_transmission = can_transmission_file is not None
+    if transmissions is None:
+        transmissions = lookup_transmissions(
+            sample_transmission_file,
+            can_transmission_file,
+            direct_file,
+            background_file,
+            rebin,
+        )
+        if transmissions is not None:
+            sample_transmission_file, can_transmission_file = None, None
     file_list = [
         sample_scatter_file,
         sample_transmission_file,
@@ -301,7 +268,9 @@ def load_RIDSANS(
         can_transmission,
         direct,
         background,
-    ) = load_measurement_files(file_list)
+    ) = load_measurement_files(
+        file_list, force_reload=force_reload, rebin=rebin, dtype=dtype
+    )
     ws_sample, ws_direct, mon, ws_pixel_adj, Q_range_index = load_RIDSANS_from_sansdata(
         sample_scatter,
         sample_transmission,
@@ -311,6 +280,7 @@ def load_RIDSANS(
         background,
         relative_pixel_efficiency,
         transmissions,
+        has_can_transmission,
     )
     del sample_scatter, sample_transmission, can_scatter, direct, background
     return ws_sample, ws_direct, mon, ws_pixel_adj, Q_range_index
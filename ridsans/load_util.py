@@ -1,28 +1,297 @@
-from multiprocessing import Pool
+import atexit
+import os
+import secrets
+import warnings
+from collections import OrderedDict
+from multiprocessing import Pool, resource_tracker, shared_memory
 
+from ridsans import cache, profiling, transmission_cache
+from ridsans.cache import load_sansdata
+from ridsans.profiling import profiled
 from ridsans.sansdata import *
 
 
-def option_map(file_name):
+class SansDataCache:
+    """In-process least-recently-used cache of loaded SansData objects, bounded by the memory used by their arrays.
+    This makes sure files that are shared between batchfile rows, like the direct and background measurements,
+    are only parsed once per session."""
+
+    def __init__(self, max_bytes=1024**3):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(file_name, rebin=True, dtype=np.float64):
+        """Files are identified by their resolved path together with their size and modification time, so that
+        changed files are reloaded, and the rebin factor and intensity type they were loaded with."""
+        path = Path(file_name).resolve()
+        stat = path.stat()
+        return (
+            str(path),
+            stat.st_size,
+            stat.st_mtime_ns,
+            resolve_rebin_factor(rebin),
+            np.dtype(dtype).name,
+        )
+
+    @staticmethod
+    def sansdata_size(sansdata):
+        """Memory used by the arrays of a SansData object in bytes. The counts, intensity and error are counted even
+        if they have not been decoded or computed yet (e.g. for lazy objects), as they are as soon as the object is used."""
+        arrays = vars(sansdata)
+        size = sum(x.nbytes for x in arrays.values() if isinstance(x, np.ndarray))
+        if "raw_intensity" not in arrays:
+            size += sansdata.pixel_count * np.dtype(np.uint32).itemsize
+        for name in ["I", "dI"]:
+            if name not in arrays:
+                size += sansdata.pixel_count * np.dtype(sansdata.dtype).itemsize
+        return size
+
+    def get(self, file_name, rebin=True, dtype=np.float64):
+        """Returns the cached SansData object for a file or None if it is not cached."""
+        key = self.key(file_name, rebin, dtype)
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key][0]
+
+    def put(self, file_name, sansdata, rebin=True, dtype=np.float64):
+        """Adds a SansData object to the cache, evicting the least recently used objects when it is full."""
+        key = self.key(file_name, rebin, dtype)
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[1]
+        size = self.sansdata_size(sansdata)
+        self.entries[key] = (sansdata, size)
+        self.size += size
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+
+    def invalidate(self, file_name=None):
+        """Removes a file from the cache, or all files if no file name is given."""
+        if file_name is None:
+            self.entries.clear()
+            self.size = 0
+            return
+        path = str(Path(file_name).resolve())
+        for key in [key for key in self.entries if key[0] == path]:
+            self.size -= self.entries.pop(key)[1]
+
+    def info(self):
+        """Returns the hit and miss statistics together with the current number of entries and their total size."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+        }
+
+
+# Shared by all loads in this process
+sansdata_cache = SansDataCache()
+
+
+# Worker pool shared by all loads in this process, created on first use
+pool = None
+pool_size = None
+
+
+def get_pool():
+    """Returns the worker pool used for loading files, creating it on first use. Its size defaults to the number of CPUs."""
+    global pool
+    if pool is None:
+        # Workers share the resource tracker of this process, which keeps track of the shared memory blocks they create
+        # until they are unlinked here
+        resource_tracker.ensure_running()
+        pool = Pool(pool_size or os.cpu_count())
+    return pool
+
+
+def shutdown_pool():
+    """Closes the worker pool, waiting for the workers to exit. A new pool is created when it is needed again."""
+    global pool
+    if pool is not None:
+        pool.close()
+        pool.join()
+        pool = None
+
+
+def set_pool_size(size):
+    """Sets the number of workers used to load files, replacing the current pool. A size of 1 loads files in the calling process."""
+    global pool_size
+    shutdown_pool()
+    pool_size = size
+
+
+atexit.register(shutdown_pool)
+
+
+def option_map(file_name, rebin=True, dtype=np.float64):
     """Conceptually, this is a map on an Option type. So it passes None's but turns strings into SansData objects"""
     if file_name is not None:
-        return SansData(str(file_name))
+        return load_sansdata(str(file_name), rebin=rebin, dtype=dtype)
     else:
         return None
 
 
+def loader_settings():
+    """Module settings that affect loading files. Pool workers keep the settings they were started with, so these are
+    passed along with every task."""
+    return {
+        "cache_dir": cache.cache_dir,
+        "cache_max_bytes": cache.cache_max_bytes,
+        "transmission_cache_file": transmission_cache.transmission_cache_file,
+        "profiling_enabled": profiling.profiling_enabled,
+        "trace_memory": profiling.trace_memory,
+    }
+
+
+def apply_loader_settings(settings):
+    """Applies settings collected by loader_settings in a pool worker."""
+    cache.set_cache_dir(settings["cache_dir"], settings["cache_max_bytes"])
+    if transmission_cache.transmission_cache_file != settings["transmission_cache_file"]:
+        transmission_cache.set_transmission_cache(settings["transmission_cache_file"])
+    profiling.enable_profiling(settings["profiling_enabled"], settings["trace_memory"])
+
+
+def share_arrays(sansdata, block_prefix):
+    """Moves the arrays of a SansData object into shared memory blocks named block_prefix_0, block_prefix_1, ..., so that
+    only the (small) remaining object needs to be pickled when it is returned from a worker. Returns the object and a
+    description of the blocks."""
+    shared = {}
+    for name, value in vars(sansdata).items():
+        if isinstance(value, np.ndarray):
+            shm = shared_memory.SharedMemory(
+                name=f"{block_prefix}_{len(shared)}",
+                create=True,
+                size=max(value.nbytes, 1),
+            )
+            np.ndarray(value.shape, value.dtype, buffer=shm.buf)[...] = value
+            shm.close()
+            shared[name] = (shm.name, value.shape, value.dtype.str)
+    for name in shared:
+        setattr(sansdata, name, None)
+    return sansdata, shared
+
+
+def attach_arrays(sansdata, shared):
+    """Restores the arrays moved into shared memory by share_arrays, releasing the shared memory blocks. This is not
+    zero-copy: each array is copied out of its block once, which replaces pickling it, and the block is unlinked right
+    after, so only one array is held twice at a time. Keeping the blocks mapped instead would tie the lifetime of the
+    arrays (and of any views of them) to blocks that can only be closed once no views remain."""
+    for name, (shm_name, shape, dtype) in shared.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        try:
+            setattr(sansdata, name, np.ndarray(shape, dtype, buffer=shm.buf).copy())
+        finally:
+            shm.close()
+            shm.unlink()
+    return sansdata
+
+
+def release_blocks(block_prefix):
+    """Unlinks the shared memory blocks created by share_arrays with the given prefix that were not attached, e.g. because
+    loading another file of the same map failed."""
+    index = 0
+    while True:
+        try:
+            shm = shared_memory.SharedMemory(name=f"{block_prefix}_{index}")
+        except FileNotFoundError:
+            return
+        shm.close()
+        shm.unlink()
+        index += 1
+
+
+def option_map_shared(file_name, block_prefix, rebin, dtype, settings):
+    """Variant of option_map used in pool workers that returns the arrays through shared memory instead of pickling them.
+    The stages recorded while loading (see ridsans.profiling) are taken out of the worker and returned as well."""
+    apply_loader_settings(settings)
+    first_record = len(profiling.records)
+    sansdata = option_map(file_name, rebin, dtype)
+    stage_records = profiling.records[first_record:]
+    del profiling.records[first_record:]
+    if sansdata is None:
+        return None, {}, stage_records
+    return (*share_arrays(sansdata, block_prefix), stage_records)
+
+
+def load_parallel_shared(files, rebin, dtype):
+    """Loads files in the worker pool, returning their arrays through shared memory. The blocks are named by this process,
+    so that blocks that were never attached can still be released if loading any of the files fails. Stages recorded by
+    the workers are added to the records of this process."""
+    prefix = f"rs_{secrets.token_hex(6)}"
+    block_prefixes = [f"{prefix}_{i}" for i in range(len(files))]
+    settings = loader_settings()
+    try:
+        tasks = [
+            (file, block_prefix, rebin, dtype, settings)
+            for file, block_prefix in zip(files, block_prefixes)
+        ]
+        results = get_pool().starmap(option_map_shared, tasks)
+        loaded = []
+        for sansdata, shared, stage_records in results:
+            profiling.records.extend(stage_records)
+            loaded.append(attach_arrays(sansdata, shared))
+        return loaded
+    finally:
+        for block_prefix in block_prefixes:
+            release_blocks(block_prefix)
+
+
+@profiled()
 def load_measurement_files(
-    file_list, plot_measurements=False, load_parallel=True, mp_pool_size=5
+    file_list,
+    plot_measurements=False,
+    load_parallel=True,
+    mp_pool_size=None,
+    use_cache=True,
+    force_reload=False,
+    rebin=True,
+    dtype=np.float64,
 ):
-    """Loads all needed measurement files as SansData objects and plots these if plot_measurements is set. Uses a multiprocessing pool by default to speed up loading of files."""
-    if load_parallel:
-        with Pool(mp_pool_size) as p:
-            loaded_list = p.map(
-                option_map,
-                file_list,
-            )
+    """Loads all needed measurement files as SansData objects and plots these if plot_measurements is set. Uses the shared worker pool by default to speed up loading of files.
+    Files that were loaded before are taken from the in-process cache if use_cache is set, unless force_reload is set.
+    The rebin and dtype options are passed on to SansData. mp_pool_size is deprecated, use set_pool_size instead."""
+    if mp_pool_size is not None:
+        warnings.warn(
+            "mp_pool_size is deprecated, use ridsans.load_util.set_pool_size instead",
+            DeprecationWarning,
+            stacklevel=2,
+        )
+        if mp_pool_size != pool_size:
+            set_pool_size(mp_pool_size)
+    if force_reload:
+        for file in file_list:
+            if file is not None:
+                sansdata_cache.invalidate(file)
+
+    # Each distinct file is only looked up and loaded once
+    distinct_files = list(dict.fromkeys(x for x in file_list if x is not None))
+    loaded = {}
+    if use_cache:
+        for file in distinct_files:
+            sansdata = sansdata_cache.get(file, rebin, dtype)
+            if sansdata is not None:
+                loaded[file] = sansdata
+    missing = [x for x in distinct_files if x not in loaded]
+
+    if load_parallel and len(missing) > 1 and pool_size != 1:
+        missing_list = load_parallel_shared(missing, rebin, dtype)
     else:
-        loaded_list = [option_map(file) for file in file_list]
+        missing_list = [option_map(file, rebin, dtype) for file in missing]
+    for file, sansdata in zip(missing, missing_list):
+        loaded[file] = sansdata
+        if use_cache:
+            sansdata_cache.put(file, sansdata, rebin, dtype)
+
+    loaded_list = [None if file is None else loaded[file] for file in file_list]
 
     if plot_measurements:
         for x in loaded_list:
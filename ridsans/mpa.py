@@ -0,0 +1,134 @@
+import io
+import mmap
+import re
+from contextlib import contextmanager
+
+import numpy as np
+
+# Measurement data sequences look like [CDAT2,1048576 ], followed by one value per line
+data_section_regex = re.compile(rb"^\[([0-9a-zA-Z]+),(\d+) \][^\n]*\n", re.MULTILINE)
+data_section_line_regex = re.compile(r"\[[0-9a-zA-Z]+,\d+ \]")
+
+
+def read_mpa(filename):
+    """Reads the raw bytes of an .mpa file."""
+    with open(filename, "rb") as f:
+        return f.read()
+
+
+@contextmanager
+def map_mpa(filename):
+    """Memory-maps an .mpa file for reading. The mapping supports the same slicing and searching as the
+    bytes returned by read_mpa, but its pages are backed by the file instead of being copied into memory."""
+    with open(filename, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        yield data
+    finally:
+        data.close()
+
+
+def read_mpa_header(filename):
+    """Reads the lines of an .mpa file up to the first data sequence. As the data sequences make up
+    nearly all of the file, this is a cheap way of getting to the metadata."""
+    lines = []
+    with open(filename, encoding="utf-8", errors="replace") as f:
+        for line in f:
+            if data_section_line_regex.match(line):
+                break
+            lines.append(line)
+    return lines
+
+
+def find_data_sections(data):
+    """Finds all data sequences in the raw bytes of an .mpa file in a single pass. Returns a dictionary
+    mapping the sequence id (e.g. CDAT2 or TDAT0) to a tuple (header offset, first value offset, length)."""
+    return {
+        match.group(1).decode("ascii"): (match.start(), match.end(), int(match.group(2)))
+        for match in data_section_regex.finditer(data)
+    }
+
+
+def header_lines(data, sections):
+    """Decodes the part of the file preceding the first data sequence into a list of lines, as would be
+    obtained by iterating over the file in text mode."""
+    header_end = min((start for start, _, _ in sections.values()), default=len(data))
+    text = io.TextIOWrapper(io.BytesIO(data[:header_end]), encoding="utf-8", errors="replace")
+    return list(text)
+
+
+def decode_counts(data, offset, length, dtype=np.uint32):
+    """Decodes a data sequence of a given length starting at a byte offset into a 1D NumPy array in one
+    bulk call, without creating intermediate Python strings for each value."""
+    end = data.find(b"[", offset)
+    if end == -1:
+        end = len(data)
+    values = np.fromstring(data[offset:end], dtype=dtype, sep=" ")
+    if values.size != length:
+        raise ValueError(
+            f"Expected {length} values in data sequence but found {values.size}"
+        )
+    return values
+
+
+def iter_counts(data, offset, length, dtype=np.uint32, chunk_bytes=1 << 18):
+    """Decodes a data sequence of a given length starting at a byte offset in chunks of about chunk_bytes,
+    yielding 1D arrays of consecutive values. Only a single chunk is decoded at a time."""
+    end = data.find(b"[", offset)
+    if end == -1:
+        end = len(data)
+    count = 0
+    position = offset
+    while position < end:
+        stop = min(position + chunk_bytes, end)
+        if stop < end:
+            # Chunks end on a line boundary so that no value is split between two chunks
+            newline = data.rfind(b"\n", position, stop)
+            if newline == -1:
+                newline = data.find(b"\n", stop, end)
+            stop = end if newline == -1 else newline + 1
+        values = np.fromstring(data[position:stop], dtype=dtype, sep=" ")
+        count += values.size
+        yield values
+        position = stop
+    if count != length:
+        raise ValueError(f"Expected {length} values in data sequence but found {count}")
+
+
+def decode_grouped_counts(
+    data, offset, length, width, row_range, col_range, factor, dtype=np.uint32
+):
+    """Decodes a data sequence holding an image with rows of width values, keeping only the rows and columns
+    in the (start, end) ranges and summing these in groups of factor x factor pixels while decoding. The
+    result equals cropping the full image, flipping it along the first axis and rebinning it with rebin2d,
+    but only the grouped image is ever allocated. As in rebin2d, a remainder of rows and columns that does
+    not fill a group is dropped (after flipping). The grouped counts are stored with the given dtype, which
+    should be wide enough to hold the sum of a group."""
+    row_start, row_end = row_range
+    col_start, col_end = col_range
+    n_rows = (row_end - row_start) // factor
+    n_cols = (col_end - col_start) // factor
+    # The flipped image is trimmed at its end, which is the start of the unflipped rows
+    row_start = row_end - n_rows * factor
+    col_end = col_start + n_cols * factor
+    grouped = np.zeros((n_rows, n_cols), dtype=dtype)
+
+    row = 0
+    remainder = np.empty(0, dtype=dtype)
+    for values in iter_counts(data, offset, length, dtype):
+        if remainder.size:
+            values = np.concatenate([remainder, values])
+        complete = values.size // width
+        remainder = values[complete * width :]
+        # Only the rows of this chunk within the cropped region are grouped
+        first = max(row, row_start)
+        last = min(row + complete, row_end)
+        if first < last:
+            rows = values[(first - row) * width : (last - row) * width].reshape(-1, width)
+            column_sums = (
+                rows[:, col_start:col_end].reshape(-1, n_cols, factor).sum(axis=2)
+            )
+            # Flipped output row of each input row
+            np.add.at(grouped, n_rows - 1 - (np.arange(first, last) - row_start) // factor, column_sums)
+        row += complete
+    return grouped
@@ -0,0 +1,167 @@
+import time
+
+import h5py
+import numpy as np
+
+# Writes reduced data as NXcanSAS (HDF5) files that can be read by SasView, directly from arrays and without Mantid.
+# Every sample is written as its own SASentry, so a batch of samples can be written to a single file in one pass. Next to
+# the data, an entry holds the instrument (RIDSANS), the sample with its thickness and transmission and a SASprocess with
+# the factors used in the reduction.
+
+# Metadata of the reduction that is stored with each sample, as set on the workspaces by load_RIDSANS
+metadata_names = ["T_sample", "T_can", "thickness", "Q_range_index"]
+
+
+def bin_centers(bin_edges):
+    """Centers of the bins with the given edges."""
+    bin_edges = np.asarray(bin_edges, dtype=float)
+    return (bin_edges[1:] + bin_edges[:-1]) / 2
+
+
+def write_string(group, name, value):
+    """Writes a string dataset as variable length UTF-8 string, as expected by NeXus readers."""
+    group.create_dataset(name, data=value, dtype=h5py.string_dtype())
+
+
+def create_group(parent, name, nx_class, canSAS_class):
+    """Creates a group with the NeXus and canSAS class attributes."""
+    group = parent.create_group(name)
+    group.attrs["NX_class"] = nx_class
+    group.attrs["canSAS_class"] = canSAS_class
+    return group
+
+
+def write_root_attributes(file, file_name):
+    """Writes the attributes of the root of an NXcanSAS file."""
+    file.attrs["NX_class"] = "NXroot"
+    file.attrs["file_name"] = str(file_name)
+    file.attrs["file_time"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+    file.attrs["creator"] = "ridsans"
+
+
+def write_metadata(entry, sample):
+    """Writes the instrument, sample and process groups of an entry."""
+    instrument = create_group(entry, "sasinstrument", "NXinstrument", "SASinstrument")
+    write_string(instrument, "name", "RIDSANS")
+    source = create_group(instrument, "sassource", "NXsource", "SASsource")
+    write_string(source, "radiation", "Reactor Neutron Source")
+    write_string(source, "probe", "neutron")
+    if sample.get("wavelength") is not None:
+        source.create_dataset("incident_wavelength", data=float(sample["wavelength"]))
+        source["incident_wavelength"].attrs["units"] = "A"
+
+    sas_sample = create_group(entry, "sassample", "NXsample", "SASsample")
+    write_string(sas_sample, "name", sample.get("sample") or sample["name"])
+    if sample.get("thickness") is not None:
+        sas_sample.create_dataset("thickness", data=float(sample["thickness"]))
+        sas_sample["thickness"].attrs["units"] = "cm"
+    if sample.get("T_sample") is not None:
+        sas_sample.create_dataset("transmission", data=float(sample["T_sample"]))
+
+    process = create_group(entry, "sasprocess", "NXprocess", "SASprocess")
+    write_string(process, "name", "ridsans")
+    write_string(process, "date", time.strftime("%Y-%m-%dT%H:%M:%S"))
+    for name in metadata_names:
+        value = sample.get(name)
+        if value is not None:
+            value = int(value) if name == "Q_range_index" else float(value)
+            process.create_dataset(name, data=value)
+
+
+def create_entry(file, index, sample):
+    """Creates entry sasentry{index:02d} of a sample, with its data group."""
+    entry = create_group(file, f"sasentry{index:02d}", "NXentry", "SASentry")
+    entry.attrs["version"] = "1.1"
+    write_string(entry, "definition", "NXcanSAS")
+    write_string(entry, "title", sample["name"])
+    write_string(entry, "run", sample["name"])
+    data = create_group(entry, "sasdata", "NXdata", "SASdata")
+    data.attrs["signal"] = "I"
+    return entry, data
+
+
+def write_entry_2D(file, index, sample, compression=None, compression_opts=None):
+    """Writes one sample as entry sasentry{index:02d}. See write_nxcansas_2D for the contents of sample."""
+    I = np.asarray(sample["I"], dtype=float)
+    dI = np.asarray(sample["dI"], dtype=float)
+    Qx = bin_centers(sample["Qx_edges"])
+    Qy = bin_centers(sample.get("Qy_edges", sample["Qx_edges"]))
+    if I.shape != (len(Qy), len(Qx)) or dI.shape != I.shape:
+        raise ValueError(
+            f"Intensity of {sample['name']} has shape {I.shape}, expected (Qy, Qx) = {(len(Qy), len(Qx))}"
+        )
+    Qx_2d, Qy_2d = np.meshgrid(Qx, Qy)
+
+    entry, data = create_entry(file, index, sample)
+    # Laid out as by SaveNXcanSAS, which is what LoadNXcanSAS and SasView expect for 2D data: both axes are Q, with the
+    # components given per point by the Qx and Qy datasets
+    data.attrs["I_axes"] = "Q,Q"
+    data.attrs["Q_indices"] = np.array([0, 1])
+    options = {"chunks": True, "compression": compression, "compression_opts": compression_opts}
+    for name, values, units in [
+        ("I", I, "1/cm"),
+        ("Idev", dI, "1/cm"),
+        ("Qx", Qx_2d, "1/A"),
+        ("Qy", Qy_2d, "1/A"),
+    ]:
+        dataset = data.create_dataset(name, data=values, **options)
+        dataset.attrs["units"] = units
+    data["I"].attrs["uncertainties"] = "Idev"
+    write_metadata(entry, sample)
+
+
+def sample_Q(sample):
+    """Q values of a 1D sample, given either as bin edges (Q_edges) or as points (Q)."""
+    if "Q_edges" in sample:
+        return bin_centers(sample["Q_edges"])
+    return np.asarray(sample["Q"], dtype=float)
+
+
+def write_entry_1D(file, index, sample, compression=None, compression_opts=None):
+    """Writes one sample as entry sasentry{index:02d}. See write_nxcansas_1D for the contents of sample."""
+    I = np.asarray(sample["I"], dtype=float)
+    dI = np.asarray(sample["dI"], dtype=float)
+    Q = sample_Q(sample)
+    if I.shape != Q.shape or dI.shape != I.shape:
+        raise ValueError(f"Intensity of {sample['name']} has shape {I.shape}, expected {Q.shape}")
+    entry, data = create_entry(file, index, sample)
+    data.attrs["I_axes"] = "Q"
+    data.attrs["Q_indices"] = 0
+    options = {"chunks": True, "compression": compression, "compression_opts": compression_opts}
+    for name, values, units in [("I", I, "1/cm"), ("Idev", dI, "1/cm"), ("Q", Q, "1/A")]:
+        dataset = data.create_dataset(name, data=values, **options)
+        dataset.attrs["units"] = units
+    data["I"].attrs["uncertainties"] = "Idev"
+    write_metadata(entry, sample)
+
+
+def write_nxcansas_1D(file_name, samples, compression=None, compression_opts=None):
+    """Writes the 1D reductions of one or more samples to an NXcanSAS file in a single pass, with one entry per sample. Each
+    sample is a dictionary with
+    - name: the title of the entry,
+    - Q_edges: the bin edges in 1/A (as from reduce_arrays_1D or stitch_arrays), or Q: the Q values of the points,
+    - I and dI: the intensity and its error in 1/cm,
+    - optionally sample, wavelength and the metadata T_sample, T_can, thickness and Q_range_index.
+    The data is stored in chunks, which are compressed if a compression filter (e.g. "gzip") is given."""
+    if isinstance(samples, dict):
+        samples = [samples]
+    with h5py.File(file_name, "w") as file:
+        write_root_attributes(file, file_name)
+        for index, sample in enumerate(samples, start=1):
+            write_entry_1D(file, index, sample, compression, compression_opts)
+
+
+def write_nxcansas_2D(file_name, samples, compression=None, compression_opts=None):
+    """Writes the 2D reductions of one or more samples to an NXcanSAS file, with one entry per sample. Each sample is a
+    dictionary with
+    - name: the title of the entry,
+    - Qx_edges (and Qy_edges if they differ): the bin edges in 1/A,
+    - I and dI: the intensity and its error in 1/cm as (Qy, Qx) arrays, as from reduce_arrays_2D,
+    - optionally sample, wavelength and the metadata T_sample, T_can, thickness and Q_range_index.
+    The data is stored in chunks, which are compressed if a compression filter (e.g. "gzip") is given."""
+    if isinstance(samples, dict):
+        samples = [samples]
+    with h5py.File(file_name, "w") as file:
+        write_root_attributes(file, file_name)
+        for index, sample in enumerate(samples, start=1):
+            write_entry_2D(file, index, sample, compression, compression_opts)
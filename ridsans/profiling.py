@@ -0,0 +1,212 @@
+import csv
+import functools
+import inspect
+import json
+import os
+import platform
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where the peak resident memory is not recorded
+    resource = None
+
+# Profiling is opt-in: stages are only recorded once it is enabled, either through the
+# RIDSANS_PROFILE environment variable or by calling enable_profiling
+profiling_enabled = bool(os.environ.get("RIDSANS_PROFILE"))
+# Whether peak memory is traced with tracemalloc, which slows down allocations
+trace_memory = True
+# Recorded stages of this process (including those of the file loading pool), in the order in which they finished. Records
+# are removed once they are written by write_profile_report.
+records = []
+# Stages that are currently running in each thread (e.g. the threads of an ExportQueue), innermost last
+thread_state = threading.local()
+
+
+def enable_profiling(enabled=True, memory=True):
+    """Enables (or disables) recording of stages. If memory is set, the peak memory allocated within each stage is traced."""
+    global profiling_enabled, trace_memory
+    profiling_enabled = enabled
+    trace_memory = memory
+    if not (enabled and memory) and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def clear_profile():
+    """Removes all recorded stages."""
+    records.clear()
+
+
+def active_stages():
+    """Stages that are currently running in the calling thread, innermost last."""
+    if not hasattr(thread_state, "stages"):
+        thread_state.stages = []
+    return thread_state.stages
+
+
+def current_rss():
+    """Resident memory of this process in bytes, or None if it cannot be determined."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def max_rss():
+    """Peak resident memory of this process in bytes, or None if it cannot be determined."""
+    if resource is None:
+        return None
+    # ru_maxrss is given in kilobytes on Linux but in bytes on macOS
+    scale = 1 if platform.system() == "Darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+@contextmanager
+def stage(name, file=None):
+    """Records the wall time, CPU time and memory use of the enclosed code as a stage with the given name and (optionally) the
+    file it works on. The traced peak is the largest amount of memory allocated on top of what was allocated when the stage
+    started, which includes the stages nested within it. tracemalloc traces the whole process, so memory is only traced for
+    stages of the main thread (where it includes allocations by other threads). Does nothing unless profiling is enabled."""
+    if not profiling_enabled:
+        yield
+        return
+    stages = active_stages()
+    traced = trace_memory and threading.current_thread() is threading.main_thread()
+    if traced:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        # The peak so far belongs to the enclosing stage, as it is reset for this one
+        if stages:
+            stages[-1]["peak"] = max(stages[-1]["peak"], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+    current = {"peak": 0, "traced": 0}
+    if traced:
+        current["traced"] = tracemalloc.get_traced_memory()[0]
+    stages.append(current)
+    start = time.time()
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - start_wall
+        cpu = time.process_time() - start_cpu
+        stages.pop()
+        peak = None
+        if traced and tracemalloc.is_tracing():
+            peak = max(current["peak"], tracemalloc.get_traced_memory()[1])
+            if stages:
+                stages[-1]["peak"] = max(stages[-1]["peak"], peak)
+        records.append(
+            {
+                "stage": name,
+                "file": None if file is None else str(file),
+                "start": start,
+                "wall_s": wall,
+                "cpu_s": cpu,
+                "peak_traced_bytes": None if peak is None else peak - current["traced"],
+                "rss_bytes": current_rss(),
+                "max_rss_bytes": max_rss(),
+                "depth": len(stages),
+                "pid": os.getpid(),
+                "thread": threading.current_thread().name,
+            }
+        )
+
+
+def file_label(value):
+    """Turns the argument a stage works on into a label: the name of a workspace, the stem of a file path or the name of a
+    SansData object."""
+    if value is None:
+        return None
+    if isinstance(value, (str, os.PathLike)):
+        return Path(value).stem
+    if hasattr(value, "name"):
+        name = value.name
+        return name() if callable(name) else name
+    return str(value)
+
+
+def profiled(name=None, file_arg=None):
+    """Decorator recording every call of a function as a stage (named after the function by default), labelled with the file
+    or workspace passed as argument file_arg."""
+
+    def decorator(f):
+        signature = inspect.signature(f)
+        stage_name = name or f.__name__
+
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if not profiling_enabled:
+                return f(*args, **kwargs)
+            file = None
+            if file_arg is not None:
+                arguments = signature.bind_partial(*args, **kwargs).arguments
+                file = file_label(arguments.get(file_arg))
+            with stage(stage_name, file):
+                return f(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def profile_summary(stage_records=None):
+    """Aggregates the records per stage into the number of calls, total wall and CPU time and the largest traced peak memory."""
+    summary = {}
+    for record in records if stage_records is None else stage_records:
+        entry = summary.setdefault(
+            record["stage"],
+            {"calls": 0, "wall_s": 0.0, "cpu_s": 0.0, "peak_traced_bytes": None},
+        )
+        entry["calls"] += 1
+        entry["wall_s"] += record["wall_s"]
+        entry["cpu_s"] += record["cpu_s"]
+        if record["peak_traced_bytes"] is not None:
+            entry["peak_traced_bytes"] = max(
+                entry["peak_traced_bytes"] or 0, record["peak_traced_bytes"]
+            )
+    return summary
+
+
+def print_profile_summary(stage_records=None):
+    """Prints the aggregated records per stage, slowest first."""
+    summary = profile_summary(stage_records)
+    for name, entry in sorted(summary.items(), key=lambda item: -item[1]["wall_s"]):
+        peak = entry["peak_traced_bytes"]
+        peak = "" if peak is None else f", peak {peak / 1024**2:.1f} MB"
+        print(
+            f"{name}: {entry['calls']} calls, {entry['wall_s']:.3f} s wall, {entry['cpu_s']:.3f} s CPU{peak}"
+        )
+
+
+def write_profile_report(file_name, stage_records=None):
+    """Writes the records to a report file: a CSV table with one row per stage if the file name ends with .csv, otherwise a
+    JSON document that also holds the summary per stage and a description of the environment. If no records are passed,
+    the records of this process are written and then cleared, so that they do not accumulate over a long session."""
+    if stage_records is None:
+        stage_records = list(records)
+        records.clear()
+    if str(file_name).endswith(".csv"):
+        columns = list(stage_records[0]) if stage_records else ["stage"]
+        with open(file_name, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(stage_records)
+        return
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "summary": profile_summary(stage_records),
+        "stages": stage_records,
+    }
+    with open(file_name, "w") as f:
+        json.dump(report, f, indent=1)
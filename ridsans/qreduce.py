@@ -0,0 +1,293 @@
+from collections import OrderedDict
+
+import numpy as np
+
+from ridsans.sansdata import active_w
+
+# Gravitational drop of a neutron per unit flight path squared and wavelength squared, g m_n^2 / (2 h^2)
+g = 9.80665  # m/s^2
+m_n = 1.67492750e-27  # kg
+h = 6.62607015e-34  # J s
+gravity_drop_constant = g * m_n**2 / (2 * h**2) * 1e-20  # m^-1 AA^-2
+
+
+class LRUCache(OrderedDict):
+    """Dictionary holding at most max_entries entries, evicting the least recently used. Used for the per-geometry arrays,
+    which take several arrays of the size of the detector per entry, so that long batches with many beam centers or
+    distances do not grow without bound."""
+
+    def __init__(self, max_entries):
+        super().__init__()
+        self.max_entries = max_entries
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        while len(self) > self.max_entries:
+            self.popitem(last=False)
+
+
+# Per-pixel geometry, keyed by (pixel count, distance, wavelength, center, gravity)
+geometry_cache = LRUCache(16)
+# Per-pixel 2D bin indices, keyed by the geometry key together with the number of bins
+qxy_bin_index_cache = LRUCache(16)
+
+
+def clear_geometry_cache():
+    """Removes all cached per-pixel geometries and the 2D bin indices computed from them."""
+    geometry_cache.clear()
+    qxy_bin_index_cache.clear()
+
+
+def pixel_grid(pixel_count, width=active_w):
+    """Positions (x, y) in m of the pixel centers of the square detector relative to its center, in the same
+    (spectrum) order as the rows of the intensity arrays: x varies fastest. Also returns the pixel size."""
+    n = int(round(np.sqrt(pixel_count)))
+    if n * n != pixel_count:
+        raise ValueError(f"Pixel count {pixel_count} does not describe a square detector")
+    step = width / n
+    centers = -width / 2 + step * (np.arange(n) + 0.5)
+    x, y = np.meshgrid(centers, centers)
+    return x.ravel(), y.ravel(), step
+
+
+def center_of_mass(image, positions, center, tolerance, radius, max_iterations, width):
+    """Iterates the center of mass of an image in a region around the current center, see find_beam_center."""
+    center_x, center_y = center
+    for _ in range(max_iterations):
+        in_x = np.abs(positions - center_x) <= width / 2 - abs(center_x)
+        in_y = np.abs(positions - center_y) <= width / 2 - abs(center_y)
+        x, y = positions[in_x], positions[in_y]
+        region = image[np.ix_(in_y, in_x)]
+        if radius is not None:
+            region = np.where(
+                (x[None, :] - center_x) ** 2 + (y[:, None] - center_y) ** 2 <= radius**2, region, 0
+            )
+        total = region.sum()
+        if total <= 0:
+            raise ValueError("No counts around the beam center, cannot find the center of mass")
+        new_x = region.sum(axis=0) @ x / total
+        new_y = region.sum(axis=1) @ y / total
+        shift = np.hypot(new_x - center_x, new_y - center_y)
+        center_x, center_y = new_x, new_y
+        if shift < tolerance:
+            return center_x, center_y
+    print(f"Beam center did not converge within {max_iterations} iterations")
+    return center_x, center_y
+
+
+def find_beam_center(I, tolerance=0.0005, radius=None, mask=None, max_iterations=50, width=active_w):
+    """Finds the beam center (x, y) in m relative to the detector center on a direct beam image (e.g. SansData.I, or the
+    intensities of a direct workspace), like FindCenterOfMassPosition: starting at the detector center, the center of mass
+    is computed in the largest rectangle around the current center that lies on the detector, so that a flat background
+    does not pull it towards the detector center, until it moves less than tolerance (m). If a radius (m) is given, the
+    center is then refined in the same way within a circle of that radius around it. Pixels that are masked or not finite
+    are left out."""
+    I = np.ravel(I)
+    n = int(round(np.sqrt(I.size)))
+    _, _, step = pixel_grid(I.size, width)
+    positions = -width / 2 + step * (np.arange(n) + 0.5)
+    valid = np.isfinite(I) if mask is None else np.isfinite(I) & ~np.ravel(mask)
+    # Rows of the image are y, columns x, as in pixel_grid
+    image = np.where(valid, I, 0).reshape(n, n)
+    center = center_of_mass(image, positions, (0.0, 0.0), tolerance, None, max_iterations, width)
+    if radius is not None:
+        center = center_of_mass(image, positions, center, tolerance, radius, max_iterations, width)
+    return float(center[0]), float(center[1])
+
+
+def shape_region(x, y, shape):
+    """Determines which detectors at positions (x, y) lie inside a shape. Shapes are dictionaries such as
+    {"shape": "circle", "r": 0.05}, with optional offset_x and offset_y (in m) for their center. Supported are
+    - circle: r
+    - rectangle: w, h
+    - annulus: r_inner, r_outer
+    - sector: phi_min, phi_max (degrees, counterclockwise from the x-axis) and optionally r_inner, r_outer
+    """
+    dx = x - shape.get("offset_x", 0)
+    dy = y - shape.get("offset_y", 0)
+    kind = shape["shape"]
+    if kind == "circle":
+        return dx**2 + dy**2 <= shape["r"] ** 2
+    if kind == "rectangle":
+        return (np.abs(dx) <= shape["w"] / 2) & (np.abs(dy) <= shape["h"] / 2)
+    r = np.sqrt(dx**2 + dy**2)
+    if kind == "annulus":
+        return (r >= shape["r_inner"]) & (r <= shape["r_outer"])
+    if kind == "sector":
+        phi = np.degrees(np.arctan2(dy, dx))
+        phi_min = shape["phi_min"]
+        # Sectors may wrap around 180 degrees
+        in_sector = (phi - phi_min) % 360 <= (shape["phi_max"] - phi_min) % 360
+        return (
+            in_sector
+            & (r >= shape.get("r_inner", 0))
+            & (r <= shape.get("r_outer", np.inf))
+        )
+    raise ValueError(f"Unknown mask shape {kind}")
+
+
+def geometry_arrays(pixel_count, distance, wavelength, center=(0.0, 0.0), gravity=True):
+    """Computes the momentum transfer Q and its components Qx, Qy [AA^-1] together with the solid angle [sr] of every pixel for
+    a sample to detector distance [m], wavelength [AA] and beam center [m]. When gravity is set, the line of sight is corrected
+    for the drop of the neutrons on their way to the detector as is done by AccountForGravity in Mantid. Results are cached per
+    geometry."""
+    key = (pixel_count, float(distance), float(wavelength), float(center[0]), float(center[1]), gravity)
+    if key not in geometry_cache:
+        x, y, step = pixel_grid(pixel_count)
+        # The detector is moved to put the beam center at the origin
+        x = x - center[0]
+        y = y - center[1]
+        r2 = x**2 + y**2 + distance**2
+        # Flat pixel facing the sample: area times the cosine of the incident angle over r^2
+        solid_angle = step**2 * distance / r2**1.5
+        if gravity:
+            y = y + gravity_drop_constant * wavelength**2 * r2
+        rho = np.sqrt(x**2 + y**2)
+        two_theta = np.arctan2(rho, distance)
+        Q = 4 * np.pi / wavelength * np.sin(two_theta / 2)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            cos_phi = np.where(rho > 0, x / rho, 0.0)
+            sin_phi = np.where(rho > 0, y / rho, 0.0)
+        geometry_cache[key] = {
+            "Q": Q,
+            "Qx": Q * cos_phi,
+            "Qy": Q * sin_phi,
+            "solid_angle": solid_angle,
+        }
+    return geometry_cache[key]
+
+
+def pixel_geometry(pixel_count, distance, wavelength, center=(0.0, 0.0), gravity=True):
+    """Momentum transfer Q [AA^-1] and solid angle [sr] of every pixel, see geometry_arrays."""
+    geometry = geometry_arrays(pixel_count, distance, wavelength, center, gravity)
+    return geometry["Q"], geometry["solid_angle"]
+
+
+def pixel_adj_from_efficiency(relative_pixel_efficiency):
+    """Turns a pixel efficiency array as loaded from the .npy file (n x n x (value, error)) into per-pixel adjustment
+    factors in spectrum order, replacing non-positive efficiencies by 1 as in create_pixel_adj_workspace."""
+    pixel_adj = np.array(np.reshape(relative_pixel_efficiency, (-1, 2))[:, 0], dtype=float)
+    pixel_adj[pixel_adj <= 0] = 1
+    return pixel_adj
+
+
+def maximum_Q(distance, wavelength):
+    """Q at the edge of the detector (half its width from the beam)."""
+    r = active_w / 2
+    return 4 * np.pi / wavelength * np.sin(np.arctan(r / distance) / 2)  # AA-1
+
+
+def q1d(I, dI, Q, solid_angle, bin_edges, pixel_adj=None, mask=None):
+    """Azimuthally averages intensities I with errors dI onto the given Q bins. As in Mantid Q1D, each bin is the summed
+    intensity divided by the summed solid angle times pixel adjustment of the contributing pixels. Masked pixels are excluded
+    and empty bins are NaN."""
+    norm = solid_angle if pixel_adj is None else solid_angle * pixel_adj
+    valid = np.isfinite(I) & np.isfinite(dI)
+    if mask is not None:
+        valid &= ~mask
+    number_of_bins = len(bin_edges) - 1
+    bin_index = np.searchsorted(bin_edges, Q, side="right") - 1
+    valid &= (bin_index >= 0) & (bin_index < number_of_bins)
+    bin_index = bin_index[valid]
+    intensity_sum = np.bincount(bin_index, weights=I[valid], minlength=number_of_bins)
+    variance_sum = np.bincount(bin_index, weights=dI[valid] ** 2, minlength=number_of_bins)
+    norm_sum = np.bincount(bin_index, weights=norm[valid], minlength=number_of_bins)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        I_Q = np.where(norm_sum > 0, intensity_sum / norm_sum, np.nan)
+        dI_Q = np.where(norm_sum > 0, np.sqrt(variance_sum) / norm_sum, np.nan)
+    return I_Q, dI_Q
+
+
+def reduce_arrays_1D(
+    I,
+    dI,
+    distance,
+    wavelength,
+    center=(0.0, 0.0),
+    pixel_adj=None,
+    mask=None,
+    number_of_bins=200,
+    gravity=True,
+):
+    """Performs a 1D reduction of corrected intensity and error arrays (as computed by workspace_from_measurement) without
+    Mantid, using the same binning as reduce_RIDSANS_1D. Returns the Q bin edges with the reduced intensity and error."""
+    I = np.ravel(I)
+    dI = np.ravel(dI)
+    Q, solid_angle = pixel_geometry(len(I), distance, wavelength, center, gravity)
+    bin_edges = np.linspace(0, maximum_Q(distance, wavelength), number_of_bins + 1)
+    I_Q, dI_Q = q1d(I, dI, Q, solid_angle, bin_edges, pixel_adj, mask)
+    return bin_edges, I_Q, dI_Q
+
+
+def qxy_bin_index(
+    pixel_count, distance, wavelength, center=(0.0, 0.0), number_of_bins=200, gravity=True
+):
+    """Computes the flattened (Qy, Qx) bin index of every pixel on a square grid of number_of_bins x number_of_bins bins
+    spanning [-Q_max, Q_max] in both directions, with -1 for pixels outside of the grid. Returns the bin edges together with
+    the indices, which are cached per geometry."""
+    key = (pixel_count, float(distance), float(wavelength), float(center[0]), float(center[1]), gravity, number_of_bins)
+    if key not in qxy_bin_index_cache:
+        geometry = geometry_arrays(pixel_count, distance, wavelength, center, gravity)
+        Q_max = maximum_Q(distance, wavelength)
+        bin_edges = np.linspace(-Q_max, Q_max, number_of_bins + 1)
+        ix = np.searchsorted(bin_edges, geometry["Qx"], side="right") - 1
+        iy = np.searchsorted(bin_edges, geometry["Qy"], side="right") - 1
+        inside = (ix >= 0) & (ix < number_of_bins) & (iy >= 0) & (iy < number_of_bins)
+        bin_index = np.where(inside, iy * number_of_bins + ix, -1)
+        qxy_bin_index_cache[key] = (bin_edges, bin_index)
+    return qxy_bin_index_cache[key]
+
+
+def qxy(I, dI, bin_index, norm, number_of_bins, mask=None):
+    """Regrids intensities I with errors dI onto the 2D (Qy, Qx) grid given by the per-pixel bin_index. As in Mantid Qxy,
+    each bin is the summed intensity divided by the summed normalization (e.g. solid angle times pixel adjustment) of the
+    contributing pixels. Masked pixels are excluded and empty bins are NaN."""
+    valid = (bin_index >= 0) & np.isfinite(I) & np.isfinite(dI)
+    if mask is not None:
+        valid &= ~mask
+    bin_index = bin_index[valid]
+    size = number_of_bins * number_of_bins
+    intensity_sum = np.bincount(bin_index, weights=I[valid], minlength=size)
+    variance_sum = np.bincount(bin_index, weights=dI[valid] ** 2, minlength=size)
+    norm_sum = np.bincount(bin_index, weights=norm[valid], minlength=size)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        I_Qxy = np.where(norm_sum > 0, intensity_sum / norm_sum, np.nan)
+        dI_Qxy = np.where(norm_sum > 0, np.sqrt(variance_sum) / norm_sum, np.nan)
+    shape = (number_of_bins, number_of_bins)
+    return I_Qxy.reshape(shape), dI_Qxy.reshape(shape)
+
+
+def reduce_arrays_2D(
+    I,
+    dI,
+    distance,
+    wavelength,
+    center=(0.0, 0.0),
+    pixel_adj=None,
+    mask=None,
+    number_of_bins=200,
+    gravity=True,
+    solid_angle_weighting=True,
+):
+    """Performs a 2D reduction of corrected intensity and error arrays without Mantid, using the same grid as
+    reduce_RIDSANS_2D. Returns the Q bin edges (shared by Qx and Qy) with the reduced intensity and error as
+    (Qy, Qx) arrays."""
+    I = np.ravel(I)
+    dI = np.ravel(dI)
+    bin_edges, bin_index = qxy_bin_index(
+        len(I), distance, wavelength, center, number_of_bins, gravity
+    )
+    if solid_angle_weighting:
+        norm = geometry_arrays(len(I), distance, wavelength, center, gravity)["solid_angle"]
+    else:
+        norm = np.ones(len(I))
+    if pixel_adj is not None:
+        norm = norm * pixel_adj
+    I_Qxy, dI_Qxy = qxy(I, dI, bin_index, norm, number_of_bins, mask)
+    return bin_edges, I_Qxy, dI_Qxy
@@ -0,0 +1,212 @@
+import numpy as np
+
+# Stitching of 1D reductions of several Q ranges without Mantid, following stitch_Q_ranges_1D: each Q range is trimmed to
+# its unmasked interval, all ranges are rebinned onto a common grid and every range is scaled onto the ranges stitched
+# before it (in the given order, normally Q1 to Q4) using their overlap, as Stitch1DMany does. The samples of a batch are
+# stitched together, with every array holding one row per sample.
+#
+# By default the steps of Stitch1D are reproduced: ranges are rebinned like Rebin does for distributions (bins that are
+# only partly covered by data are diluted), the overlap runs from the start of the right-hand range to the end of the
+# ranges stitched so far and only the bins of the common grid that lie completely inside it are integrated. The overlap
+# bins hold the weighted mean of both sides, bins before it the left-hand and bins after it the right-hand side. With
+# complete_bins set, partly covered bins are normalized by their covered width instead and the scale factors are taken
+# over the bins that are completely covered by both sides, which is less sensitive to the binning on steep curves.
+
+
+def rebin_matrix(old_edges, new_edges):
+    """Fraction of each old bin that falls into each new bin, as a (new bins x old bins) matrix."""
+    lower = np.maximum(old_edges[None, :-1], new_edges[:-1, None])
+    upper = np.minimum(old_edges[None, 1:], new_edges[1:, None])
+    return np.clip(upper - lower, 0, None) / np.diff(old_edges)[None, :]
+
+
+def rebin(old_edges, new_edges, I, dI, normalize=False):
+    """Rebins intensities (distributions) and their errors with one row per sample onto new bin edges like Mantid Rebin:
+    counts are divided over the new bins in proportion to their overlap and divided by the new bin width. Bins that are
+    not finite do not contribute, as Stitch1D sets them to zero. If normalize is set, new bins are divided by the width
+    that is covered by valid bins instead, so that bins at the edge of the data are not diluted. Returns the rebinned
+    intensities and errors together with the fraction of each new bin that is covered."""
+    fractions = rebin_matrix(old_edges, new_edges).T
+    old_widths = np.diff(old_edges)
+    valid = np.isfinite(I) & np.isfinite(dI)
+    counts = np.where(valid, I * old_widths, 0)
+    variances = np.where(valid, (dI * old_widths) ** 2, 0)
+    covered_widths = (valid * old_widths) @ fractions
+    if normalize:
+        norm = np.where(covered_widths > 0, covered_widths, 1)
+    else:
+        norm = np.diff(new_edges)
+    return (
+        counts @ fractions / norm,
+        np.sqrt(variances @ fractions) / norm,
+        covered_widths / np.diff(new_edges),
+    )
+
+
+def trimmed_edges(edges, first_valid_index):
+    """Bin edges of a Q range trimmed as in stitch.trim_workspaces, starting at the first bin with valid intensity and ending
+    at the lower edge of the last bin, with one more bin than remained."""
+    Q_axis = edges[:-1]
+    Q_min = Q_axis[first_valid_index]
+    Q_max = np.max(Q_axis)
+    steps = len(Q_axis) - first_valid_index + 1
+    return np.linspace(Q_min, Q_max, steps + 1)
+
+
+def bins_within(edges, start, end):
+    """Bins that lie completely within [start, end], as integrated by Mantid Integration without partial bins."""
+    tolerance = 1e-9 * (edges[-1] - edges[0])
+    return (edges[:-1] >= start - tolerance) & (edges[1:] <= end + tolerance)
+
+
+def first_valid_indices(I):
+    """Index of the first bin with an intensity that is neither NaN nor zero for every sample (0 if there is none)."""
+    valid = np.isfinite(I) & (I != 0)
+    return np.argmax(valid, axis=-1)
+
+
+def overlap_scale_factors(I_lhs, dI_lhs, I_rhs, dI_rhs, overlap, method="integral"):
+    """Scale factors that bring the right-hand side onto the left-hand side in the overlapping bins, per sample. The integral
+    method takes the ratio of the summed intensities, as Stitch1D does. The wls method fits the scale factor s by weighted
+    least squares, minimizing the sum of (I_lhs - s I_rhs)^2 / (dI_lhs^2 + s^2 dI_rhs^2), starting from the integral ratio.
+    Samples without overlap are not scaled."""
+    lhs_sum = np.sum(np.where(overlap, I_lhs, 0), axis=-1)
+    rhs_sum = np.sum(np.where(overlap, I_rhs, 0), axis=-1)
+    has_overlap = overlap.any(axis=-1) & (rhs_sum != 0)
+    if not has_overlap.all():
+        print(f"No overlap between Q ranges for {np.sum(~has_overlap)} samples, these are not scaled")
+    scale = np.where(has_overlap, lhs_sum / np.where(has_overlap, rhs_sum, 1), 1.0)
+    if method == "integral":
+        return scale
+    if method != "wls":
+        raise ValueError(f"Unknown stitching method {method}, expected 'integral' or 'wls'")
+    for _ in range(5):
+        variance = dI_lhs**2 + scale[:, None] ** 2 * dI_rhs**2
+        weights = np.where(overlap & (variance > 0), 1 / np.where(variance > 0, variance, 1), 0)
+        numerator = np.sum(weights * I_lhs * I_rhs, axis=-1)
+        denominator = np.sum(weights * I_rhs**2, axis=-1)
+        fitted = has_overlap & (denominator > 0)
+        scale = np.where(fitted, numerator / np.where(fitted, denominator, 1), scale)
+    return scale
+
+
+def merge(I_lhs, dI_lhs, covered_lhs, I_rhs, dI_rhs, covered_rhs):
+    """Combines two rebinned ranges, taking the inverse-variance weighted mean where both have data (the plain mean if an
+    error is zero) and the available one elsewhere."""
+    both = covered_lhs & covered_rhs
+    weighted = both & (dI_lhs > 0) & (dI_rhs > 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        w_lhs = np.where(weighted, 1 / dI_lhs**2, 0.5)
+        w_rhs = np.where(weighted, 1 / dI_rhs**2, 0.5)
+        I_mean = (w_lhs * I_lhs + w_rhs * I_rhs) / (w_lhs + w_rhs)
+        dI_mean = np.where(
+            weighted,
+            1 / np.sqrt(w_lhs + w_rhs),
+            np.sqrt(dI_lhs**2 + dI_rhs**2) / 2,
+        )
+    I = np.where(both, I_mean, np.where(covered_lhs, I_lhs, I_rhs))
+    dI = np.where(both, dI_mean, np.where(covered_lhs, dI_lhs, dI_rhs))
+    return I, dI, covered_lhs | covered_rhs
+
+
+def stitch_group(bin_edges, I, dI, first_indices, bins, method, complete_bins=False):
+    """Stitches samples that share the same trimmed Q intervals. Returns the common bin edges together with the stitched
+    intensities, errors and the scale factors of the Q ranges after the first."""
+    trimmed = [
+        trimmed_edges(edges, first)
+        for edges, first in zip(bin_edges, first_indices)
+    ]
+    Q_min = min(edges[0] for edges in trimmed)
+    Q_max = max(edges[-1] for edges in trimmed)
+    common_edges = np.linspace(Q_min, Q_max, bins + 1)
+
+    ranges = []
+    for edges, edges_trimmed, I_range, dI_range in zip(bin_edges, trimmed, I, dI):
+        I_trimmed, dI_trimmed, coverage = rebin(edges, edges_trimmed, I_range, dI_range, complete_bins)
+        I_trimmed[coverage == 0] = np.nan
+        ranges.append(rebin(edges_trimmed, common_edges, I_trimmed, dI_trimmed, complete_bins))
+
+    I_stitched, dI_stitched, coverage = ranges[0]
+    covered = coverage > 0
+    # Bins of the stitched ranges that are completely covered
+    complete = coverage > 1 - 1e-6
+    stitched_end = trimmed[0][-1]
+    scale_factors = []
+    for (I_range, dI_range, coverage_range), edges_trimmed in zip(ranges[1:], trimmed[1:]):
+        covered_range = coverage_range > 0
+        complete_range = coverage_range > 1 - 1e-6
+        # As in Stitch1D, the overlap runs from the start of this range to the end of the ranges stitched before it
+        in_overlap = bins_within(common_edges, edges_trimmed[0], stitched_end)
+        before_overlap = common_edges[:-1] < edges_trimmed[0]
+        if complete_bins:
+            overlap = complete & complete_range
+        else:
+            overlap = np.broadcast_to(in_overlap, I_stitched.shape)
+        scale = overlap_scale_factors(I_stitched, dI_stitched, I_range, dI_range, overlap, method)
+        scale_factors.append(scale)
+        I_merged, dI_merged, covered_merged = merge(
+            I_stitched,
+            dI_stitched,
+            covered,
+            I_range * scale[:, None],
+            dI_range * scale[:, None],
+            covered_range,
+        )
+        if complete_bins:
+            I_stitched, dI_stitched, covered = I_merged, dI_merged, covered_merged
+        else:
+            # Bins before the overlap are taken from the ranges stitched so far and bins after it from this range
+            I_stitched = np.where(
+                before_overlap, I_stitched, np.where(in_overlap, I_merged, I_range * scale[:, None])
+            )
+            dI_stitched = np.where(
+                before_overlap, dI_stitched, np.where(in_overlap, dI_merged, dI_range * scale[:, None])
+            )
+            covered = np.where(before_overlap, covered, np.where(in_overlap, covered_merged, covered_range))
+        complete |= complete_range
+        stitched_end = max(stitched_end, edges_trimmed[-1])
+    # Bins without data are zero, as in the output of Stitch1DMany
+    I_stitched = np.where(covered, I_stitched, 0)
+    dI_stitched = np.where(covered, dI_stitched, 0)
+    if not scale_factors:
+        return common_edges, I_stitched, dI_stitched, np.ones((len(I_stitched), 0))
+    return common_edges, I_stitched, dI_stitched, np.stack(scale_factors, axis=-1)
+
+
+def stitch_arrays(bin_edges, I, dI, bins=50, method="integral", complete_bins=False):
+    """Stitches the 1D reductions of several Q ranges (e.g. from reduce_arrays_1D) for a batch of samples in one call.
+    bin_edges holds the bin edges of each Q range, shared by all samples, and I and dI hold an array per Q range with a row
+    per sample (or a single row). Returns the bin edges of the stitched grid per sample (the grid starts at the lowest
+    unmasked Q, which can differ between samples) with the stitched intensities, errors and the scale factors applied to
+    the Q ranges after the first, each with a row per sample. By default this reproduces Stitch1DMany, complete_bins takes
+    the scale factors over completely covered bins only (see the top of this module)."""
+    if not len(bin_edges) == len(I) == len(dI):
+        raise ValueError(f"Got bin edges for {len(bin_edges)} Q ranges, intensities for {len(I)} and errors for {len(dI)}")
+    bin_edges = [np.asarray(edges, dtype=float) for edges in bin_edges]
+    I = [np.atleast_2d(np.asarray(x, dtype=float)) for x in I]
+    dI = [np.atleast_2d(np.asarray(x, dtype=float)) for x in dI]
+    samples = len(I[0])
+    first = np.stack([first_valid_indices(x) for x in I], axis=-1)
+
+    edges_out = np.zeros((samples, bins + 1))
+    I_out = np.zeros((samples, bins))
+    dI_out = np.zeros((samples, bins))
+    scale_out = np.ones((samples, len(I) - 1))
+    # Samples with the same masked bins share their grids and are stitched together
+    groups, group_index = np.unique(first, axis=0, return_inverse=True)
+    for g, first_indices in enumerate(groups):
+        rows = np.flatnonzero(np.ravel(group_index) == g)
+        edges, I_group, dI_group, scale = stitch_group(
+            bin_edges,
+            [x[rows] for x in I],
+            [x[rows] for x in dI],
+            first_indices,
+            bins,
+            method,
+            complete_bins,
+        )
+        edges_out[rows] = edges
+        I_out[rows] = I_group
+        dI_out[rows] = dI_group
+        scale_out[rows] = scale
+    return edges_out, I_out, dI_out, scale_out
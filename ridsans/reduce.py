@@ -1,53 +1,139 @@
+from pathlib import Path
+
 import numpy as np
 from mantid.api import *
 from mantid.kernel import *
 from mantid.simpleapi import *
 
-from ridsans.sansdata import active_w
+from ridsans.profiling import profiled
+from ridsans.qreduce import *
+
+# Detector positions relative to the detector bank, keyed by instrument name and number of histograms.
+# Relative positions do not change when the detector bank is moved to compensate for the beam center.
+detector_position_cache = LRUCache(8)
+
+
+def clear_detector_position_cache():
+    """Removes all cached detector positions."""
+    detector_position_cache.clear()
+
+
+def detector_positions(ws):
+    """Returns the positions of the detectors of all histograms of a workspace as an (N, 3) array. The positions are
+    only retrieved from Mantid once for each instrument geometry."""
+    instrument = ws.getInstrument()
+    bank_position = instrument.getComponentByName("detector-bank").getPos()
+    bank_position = np.array([bank_position.X(), bank_position.Y(), bank_position.Z()])
+    key = (instrument.getName(), ws.getNumberHistograms())
+    if key not in detector_position_cache:
+        spectrum_info = ws.spectrumInfo()
+        positions = np.empty((ws.getNumberHistograms(), 3))
+        for i in range(ws.getNumberHistograms()):
+            position = spectrum_info.position(i)
+            positions[i] = position.X(), position.Y(), position.Z()
+        detector_position_cache[key] = positions - bank_position
+    return detector_position_cache[key] + bank_position
+
+
+# Beam centers found by find_beam_center, keyed by the direct measurement file, its Q range and number of pixels
+# (see direct_file_key) together with the tolerance and radius of the search
+beam_center_cache = LRUCache(256)
+
+
+def clear_beam_center_cache():
+    """Removes all cached beam centers."""
+    beam_center_cache.clear()
+
+
+def mask_shapes(ws, shapes, negative=False):
+    """Masks all detectors outside of the union of the given shapes (see shape_region) on a workspace, or the detectors
+    inside if negative is set. The mask is computed on all detector positions at once and applied in a single call."""
+    positions = detector_positions(ws)
+    x, y = positions[:, 0], positions[:, 1]
+    region = np.zeros(len(positions), dtype=bool)
+    for shape in shapes:
+        region |= shape_region(x, y, shape)
+    mask_indices = np.flatnonzero(region if negative else ~region)
+    if mask_indices.size > 0:
+        MaskDetectors(Workspace=ws, WorkspaceIndexList=mask_indices.tolist())
 
 
 def mask_rectangle(ws, w, h, negative=False, offset_x=0, offset_y=0):
     """Masks a rectangle of a given width and height centered at an offset on a given workspace."""
-    mask_list = []
-    for i in range(ws.getNumberHistograms()):
-        detector = ws.getDetector(i)
-        # Get the position of the detector
-        position = detector.getPos()
-        if (
-            abs(position.getX() - offset_x) > w / 2
-            or abs(position.getY() - offset_y) > h / 2
-        ) == (not negative):
-            mask_list.append(i + 1)
-    MaskDetectors(Workspace=ws, SpectraList=mask_list)
+    mask_shapes(
+        ws,
+        [{"shape": "rectangle", "w": w, "h": h, "offset_x": offset_x, "offset_y": offset_y}],
+        negative,
+    )
 
 
 def mask_circle(ws, r, negative=False, offset_x=0, offset_y=0):
     """Masks a circle of a given radius centered at an offset on a given workspace."""
-    mask_list = []
-    for i in range(ws.getNumberHistograms()):
-        detector = ws.getDetector(i)
-        # Get the position of the detector
-        position = detector.getPos()
-        dist = np.sqrt(
-            (position.getX() - offset_x) ** 2 + (position.getY() - offset_y) ** 2
-        )
-        if (dist > r) == (not negative):
-            mask_list.append(i + 1)
-    MaskDetectors(Workspace=ws, SpectraList=mask_list)
+    mask_shapes(
+        ws,
+        [{"shape": "circle", "r": r, "offset_x": offset_x, "offset_y": offset_y}],
+        negative,
+    )
+
+
+def direct_file_key(ws_direct):
+    """Identifies the direct measurement of a workspace by its file (path, size and modification time) and Q range, or returns
+    None if the workspace was not created from a file."""
+    run = ws_direct.getRun()
+    if not run.hasProperty("filename"):
+        return None
+    path = Path(run.getProperty("filename").value).resolve()
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    Q_range_index = run.getProperty("Q_range_index").value if run.hasProperty("Q_range_index") else None
+    return (str(path), stat.st_size, stat.st_mtime_ns, Q_range_index, ws_direct.getNumberHistograms())
+
+
+def center_table(center_x, center_y, output_workspace="center"):
+    """Table workspace of a beam center in the form of the output of FindCenterOfMassPosition: the names X (m) and Y (m) in
+    the first column and the position in the second."""
+    table = CreateEmptyTableWorkspace(OutputWorkspace=output_workspace)
+    table.addColumn("str", "Name")
+    table.addColumn("double", "Value")
+    table.addRow(["X (m)", center_x])
+    table.addRow(["Y (m)", center_y])
+    return table
 
 
+def find_center_workspace(ws_direct, tolerance=0.0005, radius=None, output_workspace="center"):
+    """Finds the beam center on a direct measurement workspace with find_beam_center instead of FindCenterOfMassPosition and
+    returns it as a table workspace of the same form, which can be passed to reduction_setup_RIDSANS as center_workspace.
+    The center is computed once per direct file and Q range, so all rows of a Q range share one computation."""
+    key = direct_file_key(ws_direct)
+    if key is None:
+        center = find_beam_center(ws_direct.extractY()[:, 0], tolerance, radius)
+        return center_table(*center, output_workspace)
+    key = key + (tolerance, radius)
+    if key not in beam_center_cache:
+        beam_center_cache[key] = find_beam_center(ws_direct.extractY()[:, 0], tolerance, radius)
+    return center_table(*beam_center_cache[key], output_workspace)
+
+
+@profiled(file_arg="ws_sample")
 def reduction_setup_RIDSANS(
-    ws_sample, ws_direct, ROI=None, mask_workspace=None, center_workspace=None
+    ws_sample, ws_direct, ROI=None, mask_workspace=None, center_workspace=None, backend="mantid"
 ):
-    """Finds the beam center if no center_workspace is provided and optionally applies a mask"""
+    """Finds the beam center if no center_workspace is provided and optionally applies a mask. With backend="numpy", the
+    beam center is found by find_center_workspace, which computes it once per direct file and Q range."""
     # STEP 1: find beam centre from direct beam
     # Compute the center position, which will be put in a table workspace
 
     # Uses direct beam method
-    if center_workspace is None:
+    if center_workspace is not None:
+        center = center_workspace
+    elif backend == "numpy":
+        center = find_center_workspace(ws_direct)
+    elif backend == "mantid":
         center = FindCenterOfMassPosition(ws_direct, Output="center", Tolerance=0.0005)
     else:
-        center = center_workspace
+        raise ValueError(f"Unknown backend {backend}, expected 'mantid' or 'numpy'")
     center_x, center_y = center.column(1)
     print(f"(x, y) = ({center_x:.4f}, {center_y:.4f})")
 
@@ -71,10 +157,55 @@ def reduction_setup_RIDSANS(
         MaskDetectors(Workspace=ws_sample, MaskedWorkspace=mask_workspace)
 
 
+def workspace_arrays(ws_sample, ws_pixel_adj):
+    """Extracts what is needed for a reduction without Mantid from a workspace prepared by reduction_setup_RIDSANS: the intensity,
+    error, mask and pixel adjustment arrays together with the sample to detector distance, wavelength and beam center."""
+    I = ws_sample.extractY()[:, 0]
+    dI = ws_sample.extractE()[:, 0]
+    mask_ws, _ = ExtractMask(InputWorkspace=ws_sample, StoreInADS=False)
+    mask = mask_ws.extractY()[:, 0] > 0
+    pixel_adj = ws_pixel_adj.extractY()[:, 0]
+    instrument = ws_sample.getInstrument()
+    distance = -instrument.getSample().getPos().Z()
+    # reduction_setup_RIDSANS moves the detector bank by minus the beam center
+    bank_position = instrument.getComponentByName("detector-bank").getPos()
+    center = (-bank_position.X(), -bank_position.Y())
+    L_bins = ws_sample.dataX(0)
+    L0 = (L_bins[1] + L_bins[0]) / 2
+    return I, dI, mask, pixel_adj, distance, L0, center
+
+
+@profiled(file_arg="ws_sample")
 def reduce_RIDSANS_1D(
-    ws_sample, ws_pixel_adj, output_workspace=None, number_of_bins=200
+    ws_sample,
+    ws_pixel_adj,
+    output_workspace=None,
+    number_of_bins=200,
+    backend="mantid",
 ):
-    """Performs a 1D reduction of the measurement. This assumes reduction_setup_RIDSANS has been run before. The resulting workspace represents the macroscopic cross-section over sample thickness t."""
+    """Performs a 1D reduction of the measurement. This assumes reduction_setup_RIDSANS has been run before. The resulting workspace represents the macroscopic cross-section over sample thickness t.
+    With backend="numpy", the reduction is done by reduce_arrays_1D instead of Mantid Q1D, which avoids the overhead of the instrument workspace."""
+    name = ws_sample.name() + "_dSigma/dOmega_1D"
+    if output_workspace is not None:
+        name = output_workspace
+    if backend == "numpy":
+        I, dI, mask, pixel_adj, ds_dist, L0, center = workspace_arrays(
+            ws_sample, ws_pixel_adj
+        )
+        bin_edges, I_Q, dI_Q = reduce_arrays_1D(
+            I, dI, ds_dist, L0, center, pixel_adj, mask, number_of_bins
+        )
+        return CreateWorkspace(
+            OutputWorkspace=name,
+            DataX=bin_edges,
+            DataY=I_Q,
+            DataE=dI_Q,
+            NSpec=1,
+            UnitX="MomentumTransfer",
+        )
+    elif backend != "mantid":
+        raise ValueError(f"Unknown backend {backend}, expected 'mantid' or 'numpy'")
+
     # Directly get the sample position
     sample_position = ws_sample.getInstrument().getSample().getPos()
 
@@ -85,12 +216,7 @@ def reduce_RIDSANS_1D(
     L_bins = ws_sample.dataX(0)
     L0 = (L_bins[1] + L_bins[0]) / 2
     ds_dist = -sample_position.Z()
-    r = active_w / 2
-    Q_max = 4 * np.pi / L0 * np.sin(np.arctan(r / (ds_dist)) / 2)  # AA-1
-    output_binning = np.linspace(0, Q_max, number_of_bins + 1)
-    name = ws_sample.name() + "_dSigma/dOmega_1D"
-    if output_workspace is not None:
-        name = output_workspace
+    output_binning = np.linspace(0, maximum_Q(ds_dist, L0), number_of_bins + 1)
     reduced_ws_1D = Q1D(
         ws_sample,
         OutputWorkspace=name,
@@ -102,10 +228,48 @@ def reduce_RIDSANS_1D(
     return reduced_ws_1D
 
 
+def qxy_workspace(name, bin_edges, I_Qxy, dI_Qxy):
+    """Creates a Mantid workspace from a 2D reduction done without Mantid, laid out like the output of Qxy: one spectrum per
+    Qy bin with Qx along the x-axis."""
+    number_of_bins = len(bin_edges) - 1
+    return CreateWorkspace(
+        OutputWorkspace=name,
+        DataX=np.tile(bin_edges, number_of_bins),
+        DataY=np.ravel(I_Qxy),
+        DataE=np.ravel(dI_Qxy),
+        NSpec=number_of_bins,
+        UnitX="MomentumTransfer",
+        VerticalAxisUnit="MomentumTransfer",
+        VerticalAxisValues=bin_edges,
+    )
+
+
+@profiled(file_arg="ws_sample")
 def reduce_RIDSANS_2D(
-    ws_sample, ws_pixel_adj, output_workspace=None, number_of_bins=200
+    ws_sample,
+    ws_pixel_adj,
+    output_workspace=None,
+    number_of_bins=200,
+    backend="mantid",
 ):
-    """Performs a 2D reduction of the measurement. This assumes reduction_setup_RIDSANS has been run before. Assuming the sample thickness t has already been divided out of the ws_sample workspace, the output represents the macroscopic cross-section."""
+    """Performs a 2D reduction of the measurement. This assumes reduction_setup_RIDSANS has been run before. Assuming the sample thickness t has already been divided out of the ws_sample workspace, the output represents the macroscopic cross-section.
+    With backend="numpy", the reduction is done by reduce_arrays_2D instead of Mantid Qxy."""
+    name = ws_sample.name() + "_dSigma/dOmega_2D"
+    if output_workspace is not None:
+        name = output_workspace
+    if backend == "numpy":
+        I, dI, mask, pixel_adj, ds_dist, L0, center = workspace_arrays(
+            ws_sample, ws_pixel_adj
+        )
+        bin_edges, I_Qxy, dI_Qxy = reduce_arrays_2D(
+            I, dI, ds_dist, L0, center, pixel_adj, mask, number_of_bins
+        )
+        reduced_ws_2D = qxy_workspace(name, bin_edges, I_Qxy, dI_Qxy)
+        # Keeps the transmission factors, thickness and Q range with the result, as Qxy does
+        CopyLogs(InputWorkspace=ws_sample, OutputWorkspace=reduced_ws_2D)
+        return reduced_ws_2D
+    elif backend != "mantid":
+        raise ValueError(f"Unknown backend {backend}, expected 'mantid' or 'numpy'")
 
     # Directly get the sample position
     sample_position = ws_sample.getInstrument().getSample().getPos()
@@ -117,12 +281,8 @@ def reduce_RIDSANS_2D(
     L_bins = ws_sample.dataX(0)
     L0 = (L_bins[1] + L_bins[0]) / 2
     ds_dist = -sample_position.Z()
-    r = active_w / 2
-    Q_max = 4 * np.pi / L0 * np.sin(np.arctan(r / (ds_dist)) / 2)
+    Q_max = maximum_Q(ds_dist, L0)
     delta_Q = Q_max / (number_of_bins / 2)
-    name = ws_sample.name() + "_dSigma/dOmega_2D"
-    if output_workspace is not None:
-        name = output_workspace
 
     reduced_ws_2D = Qxy(
         ws_sample,
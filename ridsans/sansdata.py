@@ -1,5 +1,9 @@
+import hashlib
 import os
 import re
+import string
+import tempfile
+from functools import cached_property
 from math import pi as pi
 from pathlib import Path
 
@@ -8,6 +12,8 @@ import matplotlib.pyplot as plt
 import numpy as np
 import yaml
 
+from ridsans.mpa import *
+
 
 def load_config(filename="instrument_config.yaml"):
     """Load configuration from a YAML file."""
@@ -24,6 +30,7 @@ config = load_config()
 active_w_pixels = int(config["active_w_pixels"])
 cropped_extent = list(map(int, config["cropped_extent"]))
 crop_y_start, crop_y_end, crop_x_start, crop_x_end = cropped_extent
+rebin_factor = int(config["rebin_factor"])
 
 FZZ_map = config["FZZ_map"]
 
@@ -55,6 +62,96 @@ def rebin2d(arr, n):
     return arr.reshape(rows // n, n, cols // n, n).sum(axis=(1, 3))
 
 
+def resolve_rebin_factor(rebin):
+    """Turns the rebin option of SansData into a rebin factor: True gives the configured rebin_factor, False no rebinning
+    and an integer n groups the pixels into n x n bins."""
+    if rebin is True:
+        return rebin_factor
+    if rebin is False or rebin is None:
+        return 1
+    factor = int(rebin)
+    if factor < 1:
+        raise ValueError(f"Rebin factor should be a positive integer, got {rebin}")
+    return factor
+
+
+def rebin_pixel_efficiency(pixel_efficiencies, detectors):
+    """Brings pixel efficiencies, an n x n x 2 array of (efficiency, error) per pixel, to a square grid with the given number
+    of detectors. Going to a coarser grid averages the efficiencies of each group of pixels and combines their errors in
+    quadrature, going to a finer grid repeats every efficiency over the pixels it covers."""
+    values = np.asarray(pixel_efficiencies, dtype=float).reshape(-1, 2)
+    n = int(round(np.sqrt(len(values))))
+    m = int(round(np.sqrt(detectors)))
+    if n * n != len(values) or m * m != detectors:
+        raise ValueError(
+            f"Cannot rebin {len(values)} pixel efficiencies to {detectors} detectors, both should form a square grid"
+        )
+    grid = values.reshape(n, n, 2)
+    if n == m:
+        return grid
+    if n % m == 0:
+        k = n // m
+        blocks = grid.reshape(m, k, m, k, 2)
+        efficiency = blocks[..., 0].mean(axis=(1, 3))
+        error = np.sqrt((blocks[..., 1] ** 2).sum(axis=(1, 3))) / k**2
+        return np.stack([efficiency, error], axis=-1)
+    if m % n == 0:
+        k = m // n
+        return grid.repeat(k, axis=0).repeat(k, axis=1)
+    raise ValueError(f"Cannot rebin {n} x {n} pixel efficiencies to {m} x {m} pixels")
+
+
+# Instrument definition of which the detector grid is filled in for the used rebin factor
+instrument_definition_template = (
+    Path(__file__).resolve().parent.parent / "RIDSANS_Definition_template.xml"
+)
+# Generated instrument definitions are written here, they are kept between sessions
+instrument_definition_dir = Path(
+    os.environ.get("RIDSANS_IDF_DIR", Path(tempfile.gettempdir()) / "ridsans-idf")
+)
+# Paths of the generated instrument definitions, keyed by the number of pixels along each axis
+instrument_definition_files = {}
+
+
+def instrument_definition(pixels):
+    """Fills in the instrument definition template for a detector of pixels x pixels bins spanning the active area."""
+    template_file = instrument_definition_template
+    if not template_file.exists():
+        # Fall back to the working directory, like the static RIDSANS_Definition.xml
+        template_file = Path("RIDSANS_Definition_template.xml")
+    pixel_w = active_w / pixels
+    pixel_h = active_h / pixels
+    return string.Template(template_file.read_text()).substitute(
+        HALF_PIXEL_SIZE=pixel_w / 2,
+        PIXEL_SIZE=pixel_w,
+        DETECTOR_PIXELS_X=pixels,
+        DETECTOR_PIXELS_Y=pixels,
+        PIXEL_START_X=-active_w / 2 + pixel_w / 2,
+        PIXEL_START_Y=-active_h / 2 + pixel_h / 2,
+    )
+
+
+def instrument_definition_file(detectors):
+    """Gives the path of the instrument definition for a square detector with the given number of (rebinned) pixels. It is
+    generated from the template on first use and cached on disk, with the name depending on its contents so that changes
+    to the template or configuration never reuse an outdated file."""
+    pixels = int(round(np.sqrt(detectors)))
+    if pixels * pixels != detectors:
+        raise ValueError(f"{detectors} detectors do not form a square grid")
+    if pixels not in instrument_definition_files:
+        text = instrument_definition(pixels)
+        digest = hashlib.sha256(text.encode()).hexdigest()[:12]
+        path = instrument_definition_dir / f"RIDSANS_Definition_{pixels}x{pixels}_{digest}.xml"
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # Written through a temporary file so that concurrent processes never read a partial definition
+            tmp_path = path.with_name(f".tmp-{os.getpid()}-{path.name}")
+            tmp_path.write_text(text)
+            os.replace(tmp_path, path)
+        instrument_definition_files[pixels] = str(path)
+    return instrument_definition_files[pixels]
+
+
 def get_closest_Q_range(uncorrected_distance, tolerance=5):
     """Determines what the Q range is of the measurement"""
     # Find the key-value pair with the smallest absolute difference
@@ -151,33 +248,19 @@ class Beamstop:
             # raise (NotImplementedError("Size of small beam stop is unknown"))
 
 
-class SansData:
-    def __init__(
-        self,
-        filename,
-        log_process=False,
-        keep_all_counts=False,
-        rebin=True,
-        image_code="CDAT2",
-    ):
+class SansMetadata:
+    """Metadata of a RIDSANS measurement file: the header parameters, the monitor reading from the [SCALER A]
+    section and the measurement time and counts from the [CHN2] section. Can be obtained without decoding
+    the detector image using probe_mpa."""
+
+    def __init__(self, filename, log_process=False):
         self.monitor_value = None
         self.log_process = log_process
-        self.keep_all_counts = keep_all_counts
-        self.image_code = image_code
-        self.rebin = rebin
-        self.log(f"=== Loading RIDSANS measurement file: {filename} ===")
         self.filename = filename
         self.name = Path(filename).stem
-        if keep_all_counts:
-            self.pixel_count = 1024 * 1024
-        else:
-            if self.rebin:
-                self.pixel_count = active_w_pixels * active_w_pixels // 16
-            else:
-                self.pixel_count = active_w_pixels * active_w_pixels
-        self.load_data(filename)
-
-        self.log(f"Pixel count: {self.pixel_count}")
+        self.header_params = {}
+        self.sample = ""
+        self.thickness = None
 
     def log(self, s):
         """Prints whatever is passed to it if log_process is enabled."""
@@ -185,19 +268,20 @@ class SansData:
             # This could instead be written to a file
             print(s)
 
-    def load_data(self, filename):
-        """Main method for reading and parsing the .mpa file."""
-        with open(filename) as f:
-            lines = list(f)
-        self.filename = filename
+    def load_metadata(self, lines):
+        """Parses the metadata from the lines of the file preceding the data sequences."""
         self.load_scaler_a(lines)
+        self.load_header(lines)
+        self.load_chn2(lines)
 
+    def load_header(self, lines):
+        """Parses the header parameters preceding [MCS8A A], deriving the Q range, distance, wavelength and beamstop."""
         # https://stackoverflow.com/questions/2361426/get-the-first-item-from-an-iterable-that-matches-a-condition
         header_end = next(
             (x[0] for x in enumerate(lines) if x[1].startswith("[MCS8A A]")), None
         )
 
-        if header_end == 0:
+        if not header_end:
             self.log("No header was found, assuming this is a background measurement")
             for key in FZZ_map:
                 if key in self.filename:
@@ -249,53 +333,10 @@ class SansData:
                 self.thickness = None  
                 self.log("Thickness[cm] not found in header; defaulting to None and reading from batch")
 
-
-        # Extract CDAT2 array from remaining file as raw detector counts
-
-        # Measurement data sequences look like [CDAT2,1048576]
-        # This translates to the regular expression: \[.DAT.,\d* \]
-        r = re.compile("\[.DAT.,\d* \]")
-        sequence_headers = list(filter(lambda x: r.match(x[1]), enumerate(lines)))
-        # The CDAT2 count sequence is used to read 1024 x 1024 values
-        data_start = None
-        CDAT2_offset = None
-        CDAT2_length = 1048576  # 1024 x 1024
-
-        for line, sequence_header in sequence_headers:
-            (id, length) = re.findall(r"\[([0-9a-zA-Z]+),(\d+) \]", sequence_header)[0]
-            if id == "TDAT0":
-                data_start = line
-            if id == self.image_code:
-                CDAT2_offset = line
-                assert int(length) == CDAT2_length
-        cdat2 = np.array(
-            lines[CDAT2_offset + 1 : CDAT2_offset + 1 + CDAT2_length], dtype=np.int16
-        )
-        # Reshape 1D 1048576 array to 2D 1024 x 1024
-        cdat_2d = np.reshape(cdat2, (1024, 1024))
-        # Transpose it to switch axes (I assume because it was column-major and needs to
-        #  be row-major)
-        # self.raw_intensity = np.transpose(cdat2_2d)
-        if self.keep_all_counts:
-            self.raw_intensity = np.flip(cdat_2d, axis=0)
-        else:
-            # Selects only active detector region pixels (a 552 x 552 region)
-            self.raw_intensity = np.flip(
-                cdat_2d[crop_y_start:crop_y_end, crop_x_start:crop_x_end],
-                axis=0,
-            )
-            if self.rebin:
-                self.raw_intensity = rebin2d(self.raw_intensity, 4)
-            rows, cols = self.raw_intensity.shape
-            self.log(f"Dimension of clipped counts: {rows} x {cols}")
-            assert self.pixel_count == len(self.raw_intensity.flatten())
-
-        # The following extracts the measurement time and total counts from under the
-        # [CHN2] header
+    def load_chn2(self, lines):
+        """Extracts the measurement time and total counts from the [CHN2] section."""
         r = re.compile("\[CHN\d*\]")
-        sequence_headers = list(
-            filter(lambda x: r.match(x[1]), enumerate(lines[:data_start]))
-        )
+        sequence_headers = list(filter(lambda x: r.match(x[1]), enumerate(lines)))
         for line, sequence_header in sequence_headers:
             id = re.findall(r"\[(CHN\d*)\]", sequence_header)[0]
             if id == "CHN2":
@@ -322,10 +363,6 @@ class SansData:
                     f"\tAverage detector intensity: {self.measurement_count / self.measurement_time:.4g} n/s"
                 )
 
-        self.I = self.raw_intensity / self.measurement_time
-        # Use Poisson statistics for each pixel
-        self.dI = np.sqrt(self.raw_intensity) / self.measurement_time
-
     def load_scaler_a(self, lines):
         """Currently, the whole purpose of loading the SCALER A section is to
         extract the monitor reading."""
@@ -387,6 +424,127 @@ class SansData:
         """Loads velocity selector RPM with default of 21506 RPM."""
         return self.load_float_with_default("SpeedVS", 21506)
 
+
+def probe_mpa(filename, log_process=False):
+    """Reads only the metadata of an .mpa file, stopping at the first data sequence. This is much cheaper
+    than creating a SansData object when the detector image is not needed, e.g. to find the Q range."""
+    metadata = SansMetadata(filename, log_process)
+    metadata.load_metadata(read_mpa_header(filename))
+    return metadata
+
+
+class SansData(SansMetadata):
+    def __init__(
+        self,
+        filename,
+        log_process=False,
+        keep_all_counts=False,
+        rebin=True,
+        image_code="CDAT2",
+        dtype=np.float64,
+        lazy=False,
+    ):
+        """Reads a measurement file. If lazy is set, only the metadata is read and the detector counts are decoded when
+        raw_intensity (or I, dI) is first used, which makes objects that are only used for their metadata cheap."""
+        super().__init__(filename, log_process)
+        self.keep_all_counts = keep_all_counts
+        self.image_code = image_code
+        self.rebin = rebin
+        self.rebin_factor = resolve_rebin_factor(rebin)
+        # Floating point type of the intensities derived from the counts, float32 halves their memory use
+        self.dtype = np.dtype(dtype).name
+        self.log(f"=== Loading RIDSANS measurement file: {filename} ===")
+        if keep_all_counts:
+            self.pixel_count = 1024 * 1024
+        else:
+            self.pixel_count = (active_w_pixels // self.rebin_factor) ** 2
+        if lazy:
+            self.load_metadata(read_mpa_header(filename))
+        else:
+            self.load_data(filename)
+
+        self.log(f"Pixel count: {self.pixel_count}")
+
+    def load_data(self, filename):
+        """Main method for reading and parsing the .mpa file."""
+        # The file is parsed from its (memory-mapped) raw bytes: the data sequences are located in a single
+        # pass and only the (small) part of the file preceding them is decoded as text lines
+        with map_mpa(filename) as data:
+            sections = find_data_sections(data)
+            self.filename = filename
+            self.load_metadata(header_lines(data, sections))
+            self.raw_intensity = self.decode_image(data, sections)
+
+    def decode_image(self, data, sections):
+        """Decodes the detector counts from the raw bytes of the file, given the data sequences found in it."""
+        # Extract CDAT2 array from remaining file as raw detector counts
+
+        # The CDAT2 count sequence is used to read 1024 x 1024 values
+        CDAT2_length = 1048576  # 1024 x 1024
+        if self.image_code not in sections:
+            raise ValueError(f"No [{self.image_code},...] sequence found in {self.filename}")
+        _, CDAT2_offset, length = sections[self.image_code]
+        assert length == CDAT2_length
+        if self.keep_all_counts:
+            cdat2 = decode_counts(data, CDAT2_offset, CDAT2_length, np.uint32)
+            # Reshape 1D 1048576 array to 2D 1024 x 1024
+            cdat_2d = np.reshape(cdat2, (1024, 1024))
+            # Transpose it to switch axes (I assume because it was column-major and needs to
+            #  be row-major)
+            # self.raw_intensity = np.transpose(cdat2_2d)
+            return np.flip(cdat_2d, axis=0)
+        # Selects only active detector region pixels (a 552 x 552 region), flipped and rebinned
+        # while decoding so that the full 1024 x 1024 image is never allocated
+        raw_intensity = decode_grouped_counts(
+            data,
+            CDAT2_offset,
+            CDAT2_length,
+            1024,
+            (crop_y_start, crop_y_end),
+            (crop_x_start, crop_x_end),
+            self.rebin_factor,
+            np.uint32,
+        )
+        rows, cols = raw_intensity.shape
+        self.log(f"Dimension of clipped counts: {rows} x {cols}")
+        assert self.pixel_count == raw_intensity.size
+        return raw_intensity
+
+    @cached_property
+    def raw_intensity(self):
+        """Detector counts, which are only decoded here for objects created with lazy set or after unload."""
+        self.log(f"=== Decoding detector image of RIDSANS measurement file: {self.filename} ===")
+        with map_mpa(self.filename) as data:
+            return self.decode_image(data, find_data_sections(data))
+
+    @property
+    def loaded(self):
+        """Whether the detector counts are currently held in memory."""
+        return "raw_intensity" in vars(self)
+
+    def unload(self):
+        """Releases the detector counts and the intensities derived from them, keeping the metadata. They are decoded from
+        the file again when they are next used."""
+        for name in ["raw_intensity", "I", "dI"]:
+            vars(self).pop(name, None)
+
+    # The counts are the only array that is stored, the intensity and its error are computed on first use and
+    # then kept until they are deleted (e.g. del sansdata.I)
+    @cached_property
+    def I(self):  # noqa: E743
+        """Count rate per pixel."""
+        return np.divide(self.raw_intensity, self.measurement_time, dtype=self.dtype)
+
+    @cached_property
+    def dI(self):
+        """Error of the count rate per pixel."""
+        # Use Poisson statistics for each pixel
+        return np.divide(
+            np.sqrt(self.raw_intensity, dtype=self.dtype),
+            self.measurement_time,
+            dtype=self.dtype,
+        )
+
     def plot_integrated_intensity(
         self, intensity=None, axis=0, title="Integrated Intensity", filename=None
     ):
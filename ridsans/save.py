@@ -2,6 +2,12 @@ from mantid.api import *
 from mantid.kernel import *
 from mantid.simpleapi import *
 
+from ridsans.export import write_text_1D
+from ridsans.nxcansas import *
+from ridsans.profiling import profiled
+
+
+@profiled(file_arg="workspace")
 def save(workspace, file_name=None):
     """Wrapper around SaveCanSAS1D that appends the .xml extension to the filename if needed."""
     if file_name is None:
@@ -10,22 +16,109 @@ def save(workspace, file_name=None):
         file_name += ".xml"
     return SaveCanSAS1D(workspace, file_name)
 
-def save_2D(workspace, file_name=None):
-    """Wrapper around SaveNXcanSAS that appends the .h5 extension to the filename if needed."""
+def h5_file_name(workspace, file_name=None):
+    """Appends the .h5 extension to the filename if needed, deriving it from the workspace name if no filename is given.
+    Path separators are only replaced in names derived from workspaces. An explicit filename is used as given, so that it
+    can point into a directory (e.g. the output directory of reduce_batchfile), and any sample names put into it should
+    not contain path separators."""
     if file_name is None:
-        file_name = f"{workspace.name()}.h5"
+        # TODO: add proper file_name sanitization
+        # Workspace names like x_dSigma/dOmega_2D contain path separators
+        file_name = f"{workspace.name()}.h5".replace("/", "_").replace("\\", "_")
     elif not file_name.endswith(".h5"):
         file_name += ".h5"
-    
-    # TODO: add proper file_name sanitization
-    file_name = file_name.replace("/", "_").replace("\\", "_")
+    return file_name
+
+
+def nxcansas_sample_2D(workspace):
+    """Collects the arrays and metadata of a 2D reduced workspace (laid out as the output of Qxy) as written by
+    write_nxcansas_2D."""
+    unit = workspace.getAxis(0).getUnit().unitID()
+    if unit != "MomentumTransfer":
+        raise ValueError(f"Workspace {workspace.name()} has unit {unit}, expected MomentumTransfer")
+    sample = {
+        "name": workspace.name(),
+        "Qx_edges": np.array(workspace.readX(0)),
+        "Qy_edges": np.array(workspace.getAxis(1).extractValues()),
+        "I": workspace.extractY(),
+        "dI": workspace.extractE(),
+    }
+    sample.update(workspace_metadata(workspace))
+    return sample
+
+
+def workspace_metadata(workspace):
+    """Reads the transmission factors, thickness and Q range from the run properties of a workspace, where present."""
+    run = workspace.getRun()
+    return {
+        name: run.getProperty(name).value for name in metadata_names if run.hasProperty(name)
+    }
+
+
+def nxcansas_sample_1D(workspace):
+    """Collects the arrays and metadata of a 1D reduced (or stitched) workspace as written by write_nxcansas_1D."""
+    Q = np.array(workspace.readX(0))
+    I = np.array(workspace.readY(0))
+    sample = {
+        "name": workspace.name(),
+        # Histograms have bin edges, point data has a Q value per point
+        "Q_edges" if len(Q) == len(I) + 1 else "Q": Q,
+        "I": I,
+        "dI": np.array(workspace.readE(0)),
+    }
+    sample.update(workspace_metadata(workspace))
+    return sample
 
-    # Convert the workspace to units of momentum transfer (in case it is not already)
-    workspace = ConvertUnits(workspace,Target="MomentumTransfer")
+
+@profiled(file_arg="workspace")
+def save_2D(workspace, file_name=None, backend="mantid", compression=None):
+    """Wrapper around SaveNXcanSAS that appends the .h5 extension to the filename if needed.
+    With backend="numpy", the file is written by write_nxcansas_2D directly from the arrays of the workspace, which avoids
+    converting units and loading an instrument for every workspace and records RIDSANS as instrument together with the
+    transmission factors, thickness and Q range. The data is then optionally compressed (e.g. compression="gzip")."""
+    file_name = h5_file_name(workspace, file_name)
+    if backend == "numpy":
+        return write_nxcansas_2D(file_name, nxcansas_sample_2D(workspace), compression)
+    elif backend != "mantid":
+        raise ValueError(f"Unknown backend {backend}, expected 'mantid' or 'numpy'")
+
+    # Convert the workspace to units of momentum transfer (in case it is not already). The converted workspace is
+    # not stored in the AnalysisDataService, so that workspaces can be saved concurrently (see ridsans.export)
+    workspace = ConvertUnits(workspace,Target="MomentumTransfer",StoreInADS=False)
 
     # Not the actual instrument, might break stuff. RIDSANS is not officially known anywhere yet
     # so this needs to be set as otherwise SaveNXcanSAS complains no institute uses a RIDSANS 
     LoadInstrument(workspace,False,InstrumentName="SANS2D")
 
     # Save the file
-    SaveNXcanSAS(workspace,file_name)
\ No newline at end of file
+    SaveNXcanSAS(workspace,file_name)
+
+
+@profiled()
+def save_2D_samples(workspaces, file_name, compression=None):
+    """Writes the 2D reduced workspaces of many samples to a single NXcanSAS file in one pass, with an entry per workspace."""
+    write_nxcansas_2D(
+        h5_file_name(workspaces[0], file_name),
+        [nxcansas_sample_2D(workspace) for workspace in workspaces],
+        compression,
+    )
+
+
+@profiled()
+def save_1D_samples(workspaces, file_name, compression=None):
+    """Writes the 1D reduced workspaces of many samples to a single NXcanSAS file in one pass, with an entry per workspace,
+    instead of an XML file per workspace as save does."""
+    write_nxcansas_1D(
+        h5_file_name(workspaces[0], file_name),
+        [nxcansas_sample_1D(workspace) for workspace in workspaces],
+        compression,
+    )
+
+
+@profiled()
+def save_text_samples(workspaces, directory, suffix="_1D.txt"):
+    """Writes the 1D reduced workspaces of many samples to a text file each (columns Q, I, dI) in directory, named after the
+    workspaces. Returns the paths of the written files."""
+    return write_text_1D(
+        directory, [nxcansas_sample_1D(workspace) for workspace in workspaces], suffix
+    )
@@ -0,0 +1,166 @@
+import numpy as np
+import pandas as pd
+from numpy.lib.format import open_memmap
+
+from ridsans.sansdata import *
+
+
+def stack_metadata(sansdata):
+    """Collects the metadata of a SansData object that is stored in the metadata table of a stack."""
+    return {
+        "file": str(sansdata.filename),
+        "name": sansdata.name,
+        "sample": sansdata.sample,
+        "Q_range_index": getattr(sansdata, "Q_range_index", None),
+        "measurement_time": sansdata.measurement_time,
+        "measurement_count": sansdata.measurement_count,
+        "monitor": sansdata.monitor_value,
+        "I_0": sansdata.I_0,
+        "d": getattr(sansdata, "d", None),
+        "L0": getattr(sansdata, "L0", None),
+        "thickness": sansdata.thickness,
+    }
+
+
+class SansStack:
+    """Detector images of many measurement files stored as a single (N, rows, cols) array of counts on disk, together with a
+    metadata table holding one row per file (time, monitor, Q range, sample, ...). The counts are memory-mapped and all
+    reductions work through the stack in chunks of images, so their memory use does not depend on the number of files."""
+
+    counts_file = "counts.npy"
+    metadata_file = "metadata.csv"
+
+    def __init__(self, directory):
+        """Opens a stack that was created before with SansStack.create."""
+        self.directory = Path(directory)
+        self.metadata = pd.read_csv(self.directory / self.metadata_file)
+        self.counts = np.load(self.directory / self.counts_file, mmap_mode="r")
+
+    @classmethod
+    def create(
+        cls,
+        files,
+        directory,
+        keep_all_counts=True,
+        rebin=False,
+        image_code="CDAT2",
+        log_process=False,
+    ):
+        """Converts a list of .mpa files into a stack in the given directory. By default the full 1024 x 1024 detector images are
+        kept, otherwise the active region is stored with the given rebin option as in SansData. Files are parsed one at a time
+        and written directly to the memory-mapped array."""
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        if keep_all_counts:
+            shape = (1024, 1024)
+        else:
+            pixels = active_w_pixels // resolve_rebin_factor(rebin)
+            shape = (pixels, pixels)
+        counts = open_memmap(
+            directory / cls.counts_file,
+            mode="w+",
+            dtype=np.uint32,
+            shape=(len(files),) + shape,
+        )
+        rows = []
+        for i, file in enumerate(files):
+            sansdata = SansData(str(file), log_process, keep_all_counts, rebin, image_code)
+            counts[i] = sansdata.raw_intensity
+            rows.append(stack_metadata(sansdata))
+        counts.flush()
+        del counts
+        # The metadata table is written last, as it marks the stack as complete
+        pd.DataFrame(rows).to_csv(directory / cls.metadata_file, index=False)
+        return cls(directory)
+
+    def __len__(self):
+        return len(self.counts)
+
+    @property
+    def image_shape(self):
+        return self.counts.shape[1:]
+
+    def select(self, **conditions):
+        """Gives the indices of the images whose metadata matches all conditions, e.g. select(Q_range_index=1, sample='H2O')."""
+        selected = np.ones(len(self), dtype=bool)
+        for column, value in conditions.items():
+            selected &= (self.metadata[column] == value).to_numpy()
+        return np.flatnonzero(selected)
+
+    def normalization(self, indices, normalize=None):
+        """Gives the factor each image is divided by: 1 for raw counts, the measurement time for 'time' (giving count rates)
+        or the monitor count for 'monitor'."""
+        if normalize is None:
+            return np.ones(len(indices))
+        column = {"time": "measurement_time", "monitor": "monitor"}.get(normalize)
+        if column is None:
+            raise ValueError(
+                f"Unknown normalization {normalize}, expected None, 'time' or 'monitor'"
+            )
+        factors = self.metadata[column].to_numpy(dtype=float)[indices]
+        if not np.all(np.isfinite(factors) & (factors > 0)):
+            raise ValueError(f"Not all selected images have a valid {column} for normalization")
+        return factors
+
+    def chunks(self, indices=None, normalize=None, chunk_bytes=64 * 1024**2):
+        """Iterates over the selected images (all by default) in chunks of about chunk_bytes, yielding float64 arrays of shape
+        (images in chunk, rows, cols) that are normalized as described in normalization."""
+        indices = np.arange(len(self)) if indices is None else np.asarray(indices)
+        factors = self.normalization(indices, normalize)
+        image_bytes = np.prod(self.image_shape) * 8
+        chunk_size = max(1, int(chunk_bytes // image_bytes))
+        for start in range(0, len(indices), chunk_size):
+            chunk = np.asarray(self.counts[indices[start : start + chunk_size]], dtype=float)
+            chunk /= factors[start : start + chunk_size, None, None]
+            yield chunk
+
+    def sum(self, indices=None, normalize=None):
+        """Per-pixel sum over the selected images."""
+        total = np.zeros(self.image_shape)
+        for chunk in self.chunks(indices, normalize):
+            total += chunk.sum(axis=0)
+        return total
+
+    def mean(self, indices=None, normalize=None):
+        """Per-pixel mean over the selected images."""
+        n = len(self) if indices is None else len(indices)
+        return self.sum(indices, normalize) / n
+
+    def pixel_statistics(self, indices=None, normalize=None):
+        """Per-pixel mean, standard deviation, minimum and maximum over the selected images, computed in a single pass over the
+        stack by combining the statistics of each chunk (Chan et al.) to avoid the loss of precision of summing squares."""
+        n = 0
+        mean = np.zeros(self.image_shape)
+        m2 = np.zeros(self.image_shape)
+        minimum = np.full(self.image_shape, np.inf)
+        maximum = np.full(self.image_shape, -np.inf)
+        for chunk in self.chunks(indices, normalize):
+            k = len(chunk)
+            chunk_mean = chunk.mean(axis=0)
+            delta = chunk_mean - mean
+            m2 += ((chunk - chunk_mean) ** 2).sum(axis=0) + delta**2 * n * k / (n + k)
+            mean += delta * k / (n + k)
+            n += k
+            np.minimum(minimum, chunk.min(axis=0), out=minimum)
+            np.maximum(maximum, chunk.max(axis=0), out=maximum)
+        std = np.sqrt(m2 / (n - 1)) if n > 1 else np.zeros(self.image_shape)
+        return {"mean": mean, "std": std, "min": minimum, "max": maximum, "count": n}
+
+    def active_region(self, image):
+        """Selects the active region of a full resolution (flipped 1024 x 1024) image, as kept by SansData without keep_all_counts.
+        Images of a stack without all counts are returned as is."""
+        if image.shape[-2:] != (1024, 1024):
+            return image
+        return image[..., 1024 - crop_y_end : 1024 - crop_y_start, crop_x_start:crop_x_end]
+
+    def pixel_efficiency(self, indices=None, detectors=None):
+        """Computes a relative pixel efficiency map from (flood or water) measurements in the stack. The counts of the selected
+        images are summed per pixel over the active region and divided by their mean over the pixels that counted neutrons.
+        Returns an n x n x 2 array of (efficiency, error) as read by load_RIDSANS, rebinned to the given number of detectors
+        if passed."""
+        counts = self.active_region(self.sum(indices))
+        reference = counts[counts > 0].mean()
+        efficiency = np.stack([counts / reference, np.sqrt(counts) / reference], axis=-1)
+        if detectors is not None:
+            efficiency = rebin_pixel_efficiency(efficiency, detectors)
+        return efficiency
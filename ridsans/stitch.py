@@ -1,7 +1,11 @@
+import numpy as np
 from mantid.api import *
 from mantid.kernel import *
 from mantid.simpleapi import *
 
+from ridsans.profiling import profiled
+from ridsans.qstitch import *
+
 
 def trim_workspaces(workspaces):
     """Trims workspaces to get rid of leading and trailing zeros and NaNs."""
@@ -9,7 +13,6 @@ def trim_workspaces(workspaces):
     Q_stitched_max = -1.0
     Q_stitched_min = 10000
     for i, ws in enumerate(workspaces):
-        print(i)
         Q_axis = np.array(ws.dataX(0))[:-1]
         Iq_array = ws.dataY(0)
         # Find indices where Iq_array is not NaN and not zero.
@@ -40,13 +43,25 @@ def trim_workspaces(workspaces):
     return trimmed_workspaces, Q_stitched_min, Q_stitched_max
 
 
-def stitch_Q_ranges_1D(workspaces, bins=50):
-    """Stitches together workspaces corresponding to different Q ranges, first trimming each workspace to the unmasked Q interval."""
+def stitched_workspace_name(workspaces):
+    """Name of the stitched workspace of the Q ranges of a sample."""
+    return workspaces[0].name().rsplit("_", 1)[0] + "_stitched"
+
+
+@profiled()
+def stitch_Q_ranges_1D(workspaces, bins=50, backend="mantid", method="integral", complete_bins=False):
+    """Stitches together workspaces corresponding to different Q ranges, first trimming each workspace to the unmasked Q interval.
+    With backend="numpy", the stitching is done by stitch_arrays instead of Stitch1DMany, using the given method for the scale
+    factors ("integral" as in Stitch1DMany or "wls") and optionally only completely covered bins (see ridsans.qstitch)."""
+    if backend == "numpy":
+        return stitch_samples_1D([workspaces], bins, method, complete_bins)[0]
+    elif backend != "mantid":
+        raise ValueError(f"Unknown backend {backend}, expected 'mantid' or 'numpy'")
 
     trimmed_workspaces, Q_stitched_min, Q_stitched_max = trim_workspaces(workspaces)
     Q_stitched_step = (Q_stitched_max - Q_stitched_min) / bins
     OutScaleFactors = []
-    workspace_name = workspaces[0].name().rsplit("_", 1)[0] + "_stitched"
+    workspace_name = stitched_workspace_name(workspaces)
     st, scale_factors = Stitch1DMany(
         trimmed_workspaces,
         OutputWorkspace=workspace_name,
@@ -56,3 +71,37 @@ def stitch_Q_ranges_1D(workspaces, bins=50):
     for trimmed_ws in trimmed_workspaces:
         DeleteWorkspace(Workspace=trimmed_ws.name())
     return st, scale_factors
+
+
+@profiled()
+def stitch_samples_1D(sample_workspaces, bins=50, method="integral", complete_bins=False):
+    """Stitches the Q ranges of many samples without Mantid algorithms: sample_workspaces holds a list of 1D workspaces (one
+    per Q range, in the same order) for every sample. Samples whose Q ranges are binned the same are stitched together in one
+    call of stitch_arrays. Returns the stitched workspace and the scale factors for every sample, like stitch_Q_ranges_1D."""
+    groups = {}
+    for i, workspaces in enumerate(sample_workspaces):
+        key = tuple(np.asarray(ws.readX(0)).tobytes() for ws in workspaces)
+        groups.setdefault(key, []).append(i)
+
+    result_list = [None] * len(sample_workspaces)
+    for rows in groups.values():
+        ranges = list(zip(*[sample_workspaces[i] for i in rows]))
+        edges, I, dI, scale_factors = stitch_arrays(
+            [np.asarray(workspaces[0].readX(0)) for workspaces in ranges],
+            [np.array([ws.readY(0) for ws in workspaces]) for workspaces in ranges],
+            [np.array([ws.readE(0) for ws in workspaces]) for workspaces in ranges],
+            bins,
+            method,
+            complete_bins,
+        )
+        for k, i in enumerate(rows):
+            st = CreateWorkspace(
+                OutputWorkspace=stitched_workspace_name(sample_workspaces[i]),
+                DataX=edges[k],
+                DataY=I[k],
+                DataE=dI[k],
+                NSpec=1,
+                UnitX="MomentumTransfer",
+            )
+            result_list[i] = (st, list(scale_factors[k]))
+    return result_list
@@ -0,0 +1,201 @@
+import csv
+from pathlib import Path
+
+import numpy as np
+
+from ridsans.sansdata import *
+
+# Synthetic .mpa files with the sections read by SansData: header parameters up to [MCS8A A], the monitor in
+# [SCALER A], the measurement time and total counts in [CHN2] and the TDAT0 and CDAT2 data sequences. These are
+# used for benchmarks and for trying out the reduction without real measurement data.
+
+# Pixel of the 1024 x 1024 detector image (as stored in the file) at the center of the active region
+default_center = (
+    (crop_y_start + crop_y_end) / 2,
+    (crop_x_start + crop_x_end) / 2,
+)
+
+
+def synthetic_image(
+    background_rate=0.01,
+    scattering_counts=0.0,
+    correlation_length=40.0,
+    direct_counts=0.0,
+    beam_width=3.0,
+    beamstop_size=0,
+    center=default_center,
+    seed=None,
+):
+    """Draws a 1024 x 1024 detector image of Poisson counts, in the order in which it is stored in an .mpa file. The expected
+    counts are the sum of
+    - a flat background of background_rate counts per pixel,
+    - isotropic scattering around the beam center with a Lorentzian profile of the given correlation length (in pixels)
+      holding scattering_counts counts, of which the square of beamstop_size pixels around the center is blocked,
+    - a Gaussian direct beam of the given width (in pixels) holding direct_counts counts."""
+    rng = np.random.default_rng(seed)
+    y, x = np.ogrid[0:1024, 0:1024]
+    r2 = (y - center[0]) ** 2 + (x - center[1]) ** 2
+    expected = np.full((1024, 1024), float(background_rate))
+    if scattering_counts > 0:
+        profile = 1 / (1 + r2 / correlation_length**2)
+        if beamstop_size > 0:
+            blocked = (np.abs(y - center[0]) <= beamstop_size / 2) & (
+                np.abs(x - center[1]) <= beamstop_size / 2
+            )
+            profile[blocked] = 0
+        expected += scattering_counts * profile / profile.sum()
+    if direct_counts > 0:
+        beam = np.exp(-r2 / (2 * beam_width**2))
+        expected += direct_counts * beam / beam.sum()
+    return rng.poisson(expected).astype(np.uint32)
+
+
+def write_mpa(
+    filename,
+    image,
+    Q_range_index=3,
+    speed_vs=21506,
+    sample="",
+    thickness=None,
+    measurement_time=600.0,
+    monitor=100000,
+    beamstop=(-10.0, 40.0, 12.5),
+    header=True,
+    time_bins=4,
+    line_ending="\r\n",
+):
+    """Writes a detector image as .mpa file. The header holds the sample position of the Q range (FZZ), the velocity selector
+    speed (SpeedVS), the beamstop positions (BSXL, BSXS, BSY in mm) and the sample name and thickness if given. Leaving out
+    the header gives a file like the background measurements, whose Q range follows from its name."""
+    lines = []
+    if header:
+        lines += [
+            f"FZZ={FZZ_map[f'Q{Q_range_index}']}",
+            f"SpeedVS={speed_vs}",
+            f"BSXL={beamstop[0]}",
+            f"BSXS={beamstop[1]}",
+            f"BSY={beamstop[2]}",
+        ]
+        if sample:
+            lines.append(f"Sample={sample}")
+        if thickness is not None:
+            lines.append(f"Thickness[cm]={thickness}")
+    lines += [
+        "[MCS8A A]",
+        "range=1048576",
+        "[SCALER A]",
+        f"sc#01={monitor};monitor",
+        "sc#02=0;",
+        "",
+        "[CHN2]",
+        "range=1048576",
+        f"realtime={measurement_time:.3f}",
+        f"totalsum={int(image.sum())}",
+        "roi=0",
+        "",
+        f"[TDAT0,{time_bins} ]",
+    ]
+    lines += [str(i) for i in range(time_bins)]
+    lines.append("[CDAT2,1048576 ]")
+    with open(filename, "w", newline="") as f:
+        f.write(line_ending.join(lines) + line_ending)
+        f.write(line_ending.join(map(str, np.ravel(image).tolist())) + line_ending)
+
+
+def write_pixel_efficiency(filename, detectors=None, spread=0.0, seed=None):
+    """Writes a pixel efficiency file for a square detector (by default of the configured rebin factor) with efficiencies
+    drawn around 1 with the given relative spread."""
+    if detectors is None:
+        detectors = (active_w_pixels // rebin_factor) ** 2
+    n = int(round(np.sqrt(detectors)))
+    rng = np.random.default_rng(seed)
+    efficiency = np.zeros((n, n, 2))
+    efficiency[:, :, 0] = 1 + spread * rng.standard_normal((n, n))
+    efficiency[:, :, 1] = spread
+    np.save(filename, efficiency)
+
+
+def write_measurement_set(
+    directory,
+    samples=1,
+    Q_ranges=(1, 2, 3, 4),
+    thickness=0.025,
+    transmission=0.9,
+    can_transmission=0.95,
+    scattering_counts=2e6,
+    direct_counts=5e6,
+    background_rate=0.01,
+    measurement_time=600.0,
+    monitor=100000,
+    batch_filename="sans-batchfile.csv",
+    seed=0,
+):
+    """Writes a complete synthetic measurement set to a directory: for each Q range a scattering and transmission measurement
+    of every sample and a shared can scattering, can transmission, direct beam and background measurement, together with a
+    batchfile with a row per sample and Q range. Returns the path of the batchfile."""
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+
+    def write(name, Q_range_index, header=True, sample="", **image_options):
+        image = synthetic_image(
+            background_rate=background_rate,
+            seed=rng.integers(2**32),
+            **image_options,
+        )
+        write_mpa(
+            directory / f"{name}.mpa",
+            image,
+            Q_range_index,
+            sample=sample,
+            thickness=thickness if sample else None,
+            measurement_time=measurement_time,
+            monitor=int(rng.poisson(monitor)),
+            header=header,
+        )
+        return name
+
+    rows = []
+    for Q_range_index in Q_ranges:
+        can = write(
+            f"scattering_empty_can_Q{Q_range_index}",
+            Q_range_index,
+            scattering_counts=0.1 * scattering_counts,
+            beamstop_size=20,
+        )
+        can_trans = write(
+            f"transmission_empty_can_Q{Q_range_index}",
+            Q_range_index,
+            direct_counts=can_transmission * direct_counts,
+        )
+        direct = write(
+            f"empty_beam_no_sample_Q{Q_range_index}",
+            Q_range_index,
+            direct_counts=direct_counts,
+        )
+        background = write(f"Background_Q{Q_range_index}", Q_range_index, header=False)
+        for i in range(samples):
+            sample = f"sample_{i}"
+            scatter = write(
+                f"scattering_{sample}_Q{Q_range_index}",
+                Q_range_index,
+                sample=sample,
+                scattering_counts=scattering_counts,
+                beamstop_size=20,
+            )
+            trans = write(
+                f"transmission_{sample}_Q{Q_range_index}",
+                Q_range_index,
+                sample=sample,
+                direct_counts=transmission * can_transmission * direct_counts,
+            )
+            rows.append([scatter, trans, can, can_trans, direct, background, thickness])
+
+    batch_path = directory / batch_filename
+    with open(batch_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(
+            ["sample scatter", "sample trans", "can scatter", "can trans", "direct", "background", "t"]
+        )
+        writer.writerows(rows)
+    return batch_path
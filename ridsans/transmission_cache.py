@@ -0,0 +1,134 @@
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+
+from ridsans.export import atomic_file
+from ridsans.sansdata import *
+
+# The transmission cache is opt-in: it is only used once a file is set, either through the
+# RIDSANS_TRANSMISSION_CACHE environment variable or by calling set_transmission_cache
+transmission_cache_file = os.environ.get("RIDSANS_TRANSMISSION_CACHE")
+# Entries of the cache file as last read, together with the modification time of the file at that point
+transmission_entries = {}
+transmission_entries_mtime = None
+# Content hashes of files, keyed by their resolved path, size and modification time
+file_hashes = {}
+
+
+def set_transmission_cache(path):
+    """Enables the persistent cache of transmission factors in the given JSON file, or disables it if None is passed. Passing
+    a directory (e.g. the data directory) uses transmission-cache.json in that directory."""
+    global transmission_cache_file, transmission_entries_mtime
+    if path is not None and Path(path).is_dir():
+        path = Path(path) / "transmission-cache.json"
+    transmission_cache_file = None if path is None else str(path)
+    transmission_entries.clear()
+    transmission_entries_mtime = None
+
+
+def file_hash(filename):
+    """SHA-256 hash of the contents of a file, which is only computed again if the file was changed."""
+    path = Path(filename).resolve()
+    stat = path.stat()
+    key = (str(path), stat.st_size, stat.st_mtime_ns)
+    if key not in file_hashes:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024**2), b""):
+                digest.update(block)
+        file_hashes[key] = digest.hexdigest()
+    return file_hashes[key]
+
+
+def transmission_key(
+    sample_transmission_file, can_transmission_file, direct_file, background_file, rebin=True
+):
+    """Computes the cache key of the transmission factors of a row from the contents of its transmission, direct and background
+    files together with the detector region they are summed over."""
+    key = [
+        file_hash(sample_transmission_file),
+        None if can_transmission_file is None else file_hash(can_transmission_file),
+        file_hash(direct_file),
+        file_hash(background_file),
+        resolve_rebin_factor(rebin),
+        cropped_extent,
+    ]
+    return hashlib.sha256(json.dumps(key).encode()).hexdigest()
+
+
+def read_transmission_entries():
+    """Returns the entries of the cache file, reading it again only if it was modified since the last read."""
+    global transmission_entries_mtime
+    try:
+        mtime = os.stat(transmission_cache_file).st_mtime_ns
+    except FileNotFoundError:
+        transmission_entries.clear()
+        transmission_entries_mtime = None
+        return transmission_entries
+    if mtime != transmission_entries_mtime:
+        with open(transmission_cache_file) as f:
+            entries = json.load(f)
+        transmission_entries.clear()
+        transmission_entries.update(entries)
+        transmission_entries_mtime = mtime
+    return transmission_entries
+
+
+def lookup_transmissions(
+    sample_transmission_file, can_transmission_file, direct_file, background_file, rebin=True
+):
+    """Returns the cached (T_sample, T_can) of a row, or None if the cache is disabled or holds no entry for its files."""
+    if transmission_cache_file is None or sample_transmission_file is None:
+        return None
+    key = transmission_key(
+        sample_transmission_file, can_transmission_file, direct_file, background_file, rebin
+    )
+    entry = read_transmission_entries().get(key)
+    if entry is None:
+        return None
+    print(f"Transmission factors taken from cache (Q range {entry['Q_range_index']})")
+    return entry["T_sample"], entry["T_can"]
+
+
+def store_transmissions(
+    sample_transmission, can_transmission, direct, background, T_sample, T_can
+):
+    """Stores transmission factors computed from the given SansData objects in the cache, if it is enabled, recording the
+    files and the Q range they were computed from."""
+    global transmission_entries_mtime
+    if transmission_cache_file is None:
+        return
+    key = transmission_key(
+        sample_transmission.filename,
+        None if can_transmission is None else can_transmission.filename,
+        direct.filename,
+        background.filename,
+        sample_transmission.rebin_factor,
+    )
+    entries = read_transmission_entries()
+    entries[key] = {
+        "T_sample": float(T_sample),
+        "T_can": float(T_can),
+        "Q_range_index": getattr(sample_transmission, "Q_range_index", None),
+        "sample_transmission": str(sample_transmission.filename),
+        "can_transmission": None
+        if can_transmission is None
+        else str(can_transmission.filename),
+        "direct": str(direct.filename),
+        "background": str(background.filename),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    path = Path(transmission_cache_file)
+    content = json.dumps(entries, indent=1).encode()
+    with atomic_file(path) as tmp_path, open(tmp_path, "wb") as f:
+        f.write(content)
+    transmission_entries_mtime = os.stat(path).st_mtime_ns
+
+
+def clear_transmission_cache():
+    """Removes all entries from the transmission cache."""
+    transmission_entries.clear()
+    if transmission_cache_file is not None and os.path.exists(transmission_cache_file):
+        os.remove(transmission_cache_file)
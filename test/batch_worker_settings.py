@@ -0,0 +1,21 @@
+import tempfile
+from pathlib import Path
+
+from ridsans import cache, load_util, transmission_cache
+from ridsans.batch_reduce import worker_executor
+
+# Checks that the worker processes of reduce_batchfile use the cache settings of the parent
+# process, which spawned workers do not inherit.
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as directory:
+        directory = Path(directory)
+        cache.set_cache_dir(directory / "cache", 1024**2)
+        transmission_cache.set_transmission_cache(directory)
+        expected = load_util.loader_settings()
+        with worker_executor(2) as executor:
+            worker_settings = [executor.submit(load_util.loader_settings).result() for _ in range(2)]
+        for settings in worker_settings:
+            print(f"Worker settings: {settings}")
+            assert settings == expected
+        print("Workers use the cache settings of the parent")
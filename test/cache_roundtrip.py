@@ -0,0 +1,99 @@
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from ridsans import cache
+from ridsans.synthetic import synthetic_image, write_mpa
+
+# Checks the on-disk cache of parsed .mpa files on synthetic measurements: a cached load gives the
+# same SansData as parsing the file, changing the file invalidates its entry, no temporary files
+# are left behind, eviction removes the least recently used entries and the command line interface
+# reports and purges the cache.
+
+with tempfile.TemporaryDirectory() as directory:
+    directory = Path(directory)
+    cache_directory = directory / "cache"
+    files = []
+    for i in range(3):
+        filename = directory / f"scattering_{i}_Q{i + 1}.mpa"
+        write_mpa(
+            filename,
+            synthetic_image(scattering_counts=1e5, seed=i),
+            Q_range_index=i + 1,
+            sample=f"sample {i}",
+        )
+        files.append(filename)
+
+    cache.set_cache_dir(cache_directory, max_bytes=2 * 1024**3)
+    parsed = cache.load_sansdata(files[0])
+    cached = cache.load_sansdata(files[0])
+    assert isinstance(cached.raw_intensity, np.memmap), (
+        "second load should come from the cache"
+    )
+    assert np.array_equal(cached.raw_intensity, parsed.raw_intensity)
+    assert np.array_equal(cached.I, parsed.I) and np.array_equal(cached.dI, parsed.dI)
+    for name in [
+        "Q_range_index",
+        "d",
+        "L0",
+        "measurement_time",
+        "monitor_value",
+        "I_0",
+        "header_params",
+    ]:
+        assert getattr(cached, name) == getattr(parsed, name), name
+    assert not list(cache_directory.glob(".tmp-*")), "temporary files left in the cache"
+    # Entries get the permissions of normally created files, so a shared cache can be read by others
+    umask = os.umask(0)
+    os.umask(umask)
+    for path in cache_directory.iterdir():
+        assert path.stat().st_mode & 0o777 == 0o666 & ~umask, path
+
+    # The key follows the file, so a modified file is parsed again
+    key = cache.cache_key(files[0])
+    os.utime(files[0], ns=(time.time_ns(), time.time_ns() + 10**9))
+    assert cache.cache_key(files[0]) != key
+    assert not isinstance(cache.load_sansdata(files[0]).raw_intensity, np.memmap)
+
+    for filename in files[1:]:
+        time.sleep(0.05)
+        cache.load_sansdata(filename)
+    entries = cache.cache_entries(cache_directory)
+    assert len(entries) == 4, entries
+    # Loading files[0] again makes its entry the most recently used, leaving the stale entry of files[0]
+    # and the entry of files[1] as the least recently used
+    time.sleep(0.05)
+    cache.load_sansdata(files[0])
+    entry_size = max(size for _, size, _ in entries)
+    assert cache.evict(2 * entry_size, cache_directory) == 2
+    remaining = {key for key, _, _ in cache.cache_entries(cache_directory)}
+    assert remaining == {cache.cache_key(files[0]), cache.cache_key(files[2])}, (
+        remaining
+    )
+
+    def run_cli(*args):
+        return subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "ridsans.cache",
+                *args,
+                "--dir",
+                str(cache_directory),
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+
+    print(run_cli("info").strip())
+    assert run_cli("purge").strip() == "Removed 2 entries"
+    assert cache.cache_entries(cache_directory) == []
+    cache.set_cache_dir(None)
+
+print("Cache round trip and eviction OK")
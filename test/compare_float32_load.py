@@ -0,0 +1,48 @@
+import numpy as np
+
+from ridsans.batch_processing import *
+from ridsans.load_util import sansdata_cache
+
+# Compares loading the glassy carbon set with float32 intensities against the default float64.
+# Counts are stored once as uint32 and the intensities are derived from them on first use, so the
+# memory per SansData object is printed before and after the intensities are computed. The corrected
+# intensities should agree up to single precision rounding, which is amplified where the
+# background is subtracted from a similar intensity.
+
+tolerance = 1e-4
+
+sansdata = SansData("test-data/scattering_0_25mm_glassy_C_Q1.mpa")
+assert sansdata.raw_intensity.dtype == np.uint32
+assert "I" not in vars(sansdata) and "dI" not in vars(sansdata)
+for dtype in [np.float64, np.float32]:
+    sansdata = SansData("test-data/scattering_0_25mm_glassy_C_Q1.mpa", dtype=dtype)
+    counts_size = sansdata.raw_intensity.nbytes
+    _ = sansdata.I, sansdata.dI
+    print(
+        f"{np.dtype(dtype).name}: {counts_size / 1024:.0f} kB of counts, "
+        f"{sansdata_cache.sansdata_size(sansdata) / 1024:.0f} kB with intensities"
+    )
+
+for index in range(0, 4):
+    ws_64 = load_batchfile_index_workspaces(
+        index,
+        "pixel-efficiency.npy",
+        "test-data/test.csv",
+        directory="test-data",
+        force_reload=True,
+    )[0]
+    I_64, dI_64 = ws_64.extractY().copy(), ws_64.extractE().copy()
+    ws_32 = load_batchfile_index_workspaces(
+        index,
+        "pixel-efficiency.npy",
+        "test-data/test.csv",
+        directory="test-data",
+        force_reload=True,
+        dtype=np.float32,
+    )[0]
+    I_32, dI_32 = ws_32.extractY(), ws_32.extractE()
+    print(
+        f"{ws_32.name()}: max relative difference {np.nanmax(np.abs(I_32 - I_64) / np.abs(I_64).max()):.2e}"
+    )
+    assert np.allclose(I_32, I_64, rtol=tolerance, atol=tolerance * np.abs(I_64).max())
+    assert np.allclose(dI_32, dI_64, rtol=tolerance, atol=tolerance * np.abs(dI_64).max())
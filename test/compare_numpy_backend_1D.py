@@ -0,0 +1,41 @@
+import numpy as np
+
+from ridsans.batch_processing import *
+from ridsans.reduce import *
+
+# Compares the NumPy 1D reduction backend against Mantid Q1D on the glassy carbon set.
+# Both reduce the same prepared workspaces, so the results should agree up to differences
+# in the solid angle calculation.
+
+tolerance = 0.01
+
+workspaces = load_measurement_set_workspaces(
+    range(0, 4),
+    "pixel-efficiency.npy",
+    "test-data/test.csv",
+    directory="test-data",
+)
+for ws_sample, ws_direct, _, ws_pixel_adj, Q_range_index in workspaces:
+    mask = LoadMask(
+        "RIDSANS_Definition.xml",
+        f"Q{Q_range_index}_mask.xml",
+        OutputWorkspace=f"Q{Q_range_index}_mask",
+    )
+    reduction_setup_RIDSANS(ws_sample, ws_direct, mask_workspace=mask)
+
+    mantid_ws = reduce_RIDSANS_1D(ws_sample, ws_pixel_adj)
+    numpy_ws = reduce_RIDSANS_1D(
+        ws_sample,
+        ws_pixel_adj,
+        output_workspace=f"{ws_sample.name()}_numpy_1D",
+        backend="numpy",
+    )
+    assert np.allclose(mantid_ws.readX(0), numpy_ws.readX(0))
+    I_mantid = mantid_ws.readY(0)
+    I_numpy = numpy_ws.readY(0)
+    valid = np.isfinite(I_mantid) & np.isfinite(I_numpy) & (I_mantid != 0)
+    relative_difference = np.abs(I_numpy[valid] / I_mantid[valid] - 1)
+    print(
+        f"Q{Q_range_index}: max relative difference {np.max(relative_difference):.2e} over {valid.sum()} bins"
+    )
+    assert np.all(relative_difference < tolerance)
@@ -0,0 +1,48 @@
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+from ridsans.batch_processing import *
+from ridsans.reduce import *
+from ridsans.stitch import *
+from ridsans.synthetic import write_measurement_set, write_pixel_efficiency
+
+# Compares the NumPy stitching backend against Stitch1DMany on a synthetic measurement set.
+# Both stitch the same reduced 1D workspaces of the four Q ranges, so the scale factors and
+# the stitched intensities should agree.
+
+scale_tolerance = 1e-3
+tolerance = 0.01
+
+directory = Path(tempfile.mkdtemp())
+batch_filename = str(write_measurement_set(directory))
+efficiency_file = str(directory / "pixel-efficiency.npy")
+write_pixel_efficiency(efficiency_file)
+
+workspaces = load_measurement_set_workspaces(
+    range(0, 4),
+    efficiency_file,
+    batch_filename,
+    directory=str(directory),
+    force_reload=True,
+)
+reduced = []
+for ws_sample, ws_direct, _, ws_pixel_adj, _ in workspaces:
+    reduction_setup_RIDSANS(ws_sample, ws_direct)
+    reduced.append(reduce_RIDSANS_1D(ws_sample, ws_pixel_adj))
+
+mantid_ws, mantid_scale_factors = stitch_Q_ranges_1D(reduced)
+# The NumPy backend writes a workspace with the same name, so the Mantid results are copied first
+Q_mantid = np.array(mantid_ws.readX(0))
+I_mantid = np.array(mantid_ws.readY(0))
+numpy_ws, numpy_scale_factors = stitch_Q_ranges_1D(reduced, backend="numpy")
+
+print(f"Scale factors: Stitch1DMany {list(mantid_scale_factors)}, NumPy {numpy_scale_factors}")
+assert np.allclose(numpy_scale_factors, mantid_scale_factors, rtol=scale_tolerance)
+assert np.allclose(Q_mantid, numpy_ws.readX(0))
+I_numpy = numpy_ws.readY(0)
+valid = np.isfinite(I_mantid) & np.isfinite(I_numpy) & (I_mantid != 0)
+relative_difference = np.abs(I_numpy[valid] / I_mantid[valid] - 1)
+print(f"Max relative difference {np.max(relative_difference):.2e} over {valid.sum()} bins")
+assert np.all(relative_difference < tolerance)
@@ -0,0 +1,58 @@
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+from ridsans.batch_processing import *
+from ridsans.reduce import *
+from ridsans.save import *
+from ridsans.synthetic import write_measurement_set, write_pixel_efficiency
+
+# Compares the native NXcanSAS writer (save_2D with backend="numpy") against SaveNXcanSAS on a
+# 2D reduction of a synthetic measurement: both files are read back with LoadNXcanSAS and, if
+# sasdata is installed, with the NXcanSAS reader of SasView.
+
+tolerance = 1e-6
+
+directory = Path(tempfile.mkdtemp())
+batch_filename = str(write_measurement_set(directory, Q_ranges=(1,)))
+efficiency_file = str(directory / "pixel-efficiency.npy")
+write_pixel_efficiency(efficiency_file)
+
+ws_sample, ws_direct, _, ws_pixel_adj, _ = load_batchfile_index_workspaces(
+    0, efficiency_file, batch_filename, directory=str(directory)
+)
+reduction_setup_RIDSANS(ws_sample, ws_direct)
+reduced_ws_2D = reduce_RIDSANS_2D(ws_sample, ws_pixel_adj, number_of_bins=64)
+
+mantid_file = str(directory / "mantid_2D.h5")
+numpy_file = str(directory / "numpy_2D.h5")
+save_2D(reduced_ws_2D, mantid_file)
+save_2D(reduced_ws_2D, numpy_file, backend="numpy")
+
+mantid_ws = LoadNXcanSAS(mantid_file, OutputWorkspace="mantid_2D_loaded")
+numpy_ws = LoadNXcanSAS(numpy_file, OutputWorkspace="numpy_2D_loaded")
+assert mantid_ws.getNumberHistograms() == numpy_ws.getNumberHistograms()
+assert np.allclose(
+    mantid_ws.getAxis(1).extractValues(), numpy_ws.getAxis(1).extractValues(), rtol=tolerance
+)
+for name in ["extractX", "extractY", "extractE"]:
+    expected = getattr(mantid_ws, name)()
+    actual = getattr(numpy_ws, name)()
+    assert expected.shape == actual.shape, name
+    assert np.allclose(actual, expected, rtol=tolerance, equal_nan=True), name
+print("LoadNXcanSAS reads the native file as the output of SaveNXcanSAS")
+
+try:
+    from sasdata.dataloader.loader import Loader
+except ImportError:
+    print("sasdata is not installed, skipping the SasView reader")
+else:
+    mantid_data = Loader().load(mantid_file)[0]
+    numpy_data = Loader().load(numpy_file)[0]
+    for name in ["qx_data", "qy_data", "data", "err_data"]:
+        expected = np.asarray(getattr(mantid_data, name))
+        actual = np.asarray(getattr(numpy_data, name))
+        assert expected.shape == actual.shape, name
+        assert np.allclose(actual, expected, rtol=tolerance, equal_nan=True), name
+    print("SasView reads the native file as the output of SaveNXcanSAS")